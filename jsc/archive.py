@@ -0,0 +1,212 @@
+"""
+Streams a recipe dir as a compressed tarball, for uploads where sending one
+sequential stream beats a call per file. Also compresses on several cores
+for backups.
+"""
+import collections
+import multiprocessing
+import tarfile
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class GzipCompressor():
+    def __init__(self, level):
+        # wbits 16 + MAX_WBITS gives a gzip header and trailer.
+        self.obj = zlib.compressobj(max(1, min(level, 9)), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class ZstdCompressor():
+    def __init__(self, level):
+        self.obj = zstandard.ZstdCompressor(level=max(1, min(level, 22))).compressobj()
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class Lz4Compressor():
+    def __init__(self, level):
+        self.obj = lz4.frame.LZ4FrameCompressor(compression_level=max(0, min(level, 16)))
+        self.header = self.obj.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, ""
+        return header + self.obj.compress(data)
+
+    def flush(self):
+        header, self.header = self.header, ""
+        return header + self.obj.flush()
+
+
+def available_formats():
+    """
+    Formats this side can compress, best first. gzip is always there.
+    """
+    formats = []
+    if zstandard is not None:
+        formats.append("zstd")
+    if lz4 is not None:
+        formats.append("lz4")
+    formats.append("gzip")
+    return formats
+
+
+def compressor(fmt, level):
+    if fmt == "zstd":
+        return ZstdCompressor(level)
+    if fmt == "lz4":
+        return Lz4Compressor(level)
+    return GzipCompressor(level)
+
+
+class QueueWriter():
+    """
+    File like object that compresses what tarfile writes and hands it to the
+    reading side in chunks. Blocks when the reader falls behind.
+    """
+    def __init__(self, chunks, compressor, chunk_size, abandoned):
+        self.chunks = chunks
+        self.compressor = compressor
+        self.chunk_size = chunk_size
+        self.abandoned = abandoned
+        self.buf = []
+        self.buf_size = 0
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if len(compressed) > 0:
+            self.buf.append(compressed)
+            self.buf_size += len(compressed)
+        if self.buf_size >= self.chunk_size:
+            self._put()
+
+    def _put(self):
+        chunk = "".join(self.buf)
+        self.buf = []
+        self.buf_size = 0
+        while not self.abandoned.is_set():
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise IOError("archive stream abandoned")
+
+    def close(self):
+        self.buf.append(self.compressor.flush())
+        self._put()
+
+
+def tar_chunks(entries, fmt, level, chunk_size=2**16):
+    """
+    Yields a compressed tarball of entries, (local path, path in archive)
+    tuples, that is written by a thread while the chunks are sent.
+    """
+    chunks = queue.Queue(maxsize=16)
+    abandoned = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            writer = QueueWriter(chunks, compressor(fmt, level), chunk_size, abandoned)
+            tar = tarfile.open(fileobj=writer, mode="w|")
+            for path, arcname in entries:
+                tar.add(path, arcname=arcname, recursive=False)
+            tar.close()
+            writer.close()
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            while not abandoned.is_set():
+                try:
+                    chunks.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            try:
+                chunk = chunks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        abandoned.set()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def parallel_map(func, items, threads=0):
+    """
+    Yields func(item) for every item in order, with up to threads calls
+    running at once. Reads at most twice as many items ahead, zlib and
+    hashlib let other threads run while they work on big buffers.
+    """
+    if threads <= 0:
+        threads = multiprocessing.cpu_count()
+    pool = ThreadPool(threads)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def compress_block(fmt, data, level):
+    """
+    Compresses data into a complete gzip member or zstd frame. Blocks
+    written one after the other are a valid file of the format, and each
+    can be decompressed on its own.
+    """
+    if fmt == "zstd":
+        return zstandard.ZstdCompressor(level=max(1, min(level, 22))).compress(data)
+    compressor = GzipCompressor(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_block(fmt, data):
+    if fmt == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def block_formats():
+    """
+    Formats that compress_block can write here.
+    """
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
@@ -0,0 +1,220 @@
+"""
+Deduplicating store for backups. A backup is a tar stream that is cut into
+content defined chunks, each chunk is stored once, compressed and named by
+its checksum, and the backup keeps the list of its chunks. An index counts
+how many backups use a chunk so it can be removed with the last of them.
+
+Chunks follow the tar members, so an unchanged file ends up in the same
+chunk as in the previous backup. Small members are grouped and a group ends
+after a member whose name hashes to a cut, a changed or added file only
+changes its own group. Members bigger than CHUNK_MAX are cut where a regex
+of pseudo random byte classes matches, which finds the same cuts around an
+insert or delete.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import zlib
+
+TAR_BLOCK = 512
+CHUNK_MIN = 2**16
+CHUNK_MAX = 2**20
+# About one member in GROUP_FILES ends a group of small members.
+GROUP_FILES = 16
+
+
+def _cut_regex(width):
+    classes = []
+    for k in range(width):
+        members = [b for b in range(256) if ord(hashlib.md5(chr(k) + chr(b)).digest()[0]) & 1]
+        classes.append("[" + "".join(re.escape(chr(b)) for b in members) + "]")
+    return re.compile("".join(classes))
+
+
+# Matches with a probability of 2**-16 at every position.
+CUT_REGEX = _cut_regex(16)
+
+
+def read_exact(f, size):
+    parts = []
+    while size > 0:
+        part = f.read(size)
+        if len(part) == 0:
+            break
+        parts.append(part)
+        size -= len(part)
+    return "".join(parts)
+
+
+def tar_member_size(header):
+    field = header[124:136]
+    if ord(field[0]) & 0x80:
+        # GNU base-256 for sizes that don't fit the octal field.
+        size = ord(field[0]) & 0x7f
+        for c in field[1:]:
+            size = (size << 8) | ord(c)
+        return size
+    field = field.strip(" \0")
+    return int(field, 8) if len(field) > 0 else 0
+
+
+def content_chunks(data):
+    """
+    Cuts data at the matches of CUT_REGEX, keeping chunks between CHUNK_MIN
+    and CHUNK_MAX. The last chunk may be shorter.
+    """
+    start = 0
+    while len(data) - start > CHUNK_MAX:
+        match = CUT_REGEX.search(data, start + CHUNK_MIN, start + CHUNK_MAX)
+        end = match.end() if match is not None else start + CHUNK_MAX
+        yield data[start:end]
+        start = end
+    yield data[start:]
+
+
+def tar_chunks(f):
+    """
+    Reads a tar stream and yields it in chunks that join to the same bytes.
+    """
+    group = []
+    group_size = 0
+    while True:
+        header = read_exact(f, TAR_BLOCK)
+        if len(header) == 0:
+            break
+        group.append(header)
+        group_size += len(header)
+        if len(header) < TAR_BLOCK or header.count("\0") == TAR_BLOCK:
+            # End of archive padding.
+            continue
+        padded_size = (tar_member_size(header) + TAR_BLOCK - 1) // TAR_BLOCK * TAR_BLOCK
+        if padded_size <= CHUNK_MAX:
+            group.append(read_exact(f, padded_size))
+            group_size += padded_size
+            if zlib.crc32(header[:100]) % GROUP_FILES == 0 or group_size >= CHUNK_MAX:
+                yield "".join(group)
+                group = []
+                group_size = 0
+            continue
+        # A big member, cut its data by content. The group goes with the
+        # first chunk.
+        buf = "".join(group)
+        group = []
+        group_size = 0
+        left = padded_size
+        while left > 0:
+            data = read_exact(f, min(left, 4 * CHUNK_MAX))
+            if len(data) == 0:
+                break
+            left -= len(data)
+            buf += data
+            chunks = list(content_chunks(buf))
+            for chunk in chunks[:-1]:
+                yield chunk
+            buf = chunks[-1]
+        yield buf
+    if group_size > 0:
+        yield "".join(group)
+
+
+class ChunkStore():
+    def __init__(self, path, level=6):
+        self.path = path
+        self.objects_dir = os.path.join(path, "objects")
+        self.index_path = os.path.join(path, "index.json")
+        self.level = level
+        if not os.path.isdir(self.objects_dir):
+            os.makedirs(self.objects_dir)
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def _object_path(self, sha1):
+        return os.path.join(self.objects_dir, sha1[:2], sha1[2:])
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.index_path)
+
+    def put(self, chunk):
+        """
+        Stores a chunk unless it is there already and returns its manifest
+        entry, [sha1, size]. It is not counted as used before add_refs. May be
+        called from several threads.
+        """
+        sha1 = hashlib.sha1(chunk).hexdigest()
+        obj_path = self._object_path(sha1)
+        if not os.path.exists(obj_path):
+            try:
+                os.makedirs(os.path.dirname(obj_path))
+            except OSError:
+                pass
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(obj_path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(zlib.compress(chunk, self.level))
+            os.rename(tmp_path, obj_path)
+        return [sha1, len(chunk)]
+
+    def get(self, sha1):
+        with open(self._object_path(sha1), "rb") as f:
+            chunk = zlib.decompress(f.read())
+        if hashlib.sha1(chunk).hexdigest() != sha1:
+            raise IOError("chunk {sha1} is corrupt".format(sha1=sha1))
+        return chunk
+
+    def add_refs(self, manifest):
+        for sha1 in set(sha1 for sha1, _ in manifest):
+            if sha1 in self.index:
+                self.index[sha1][0] += 1
+            else:
+                self.index[sha1] = [1, os.path.getsize(self._object_path(sha1))]
+        self._save_index()
+
+    def release(self, manifests):
+        """
+        Drops the references of removed backups and deletes the chunks no
+        other backup uses.
+        """
+        unused = []
+        for sha1 in [sha1 for manifest in manifests for sha1 in set(sha1 for sha1, _ in manifest)]:
+            if sha1 not in self.index:
+                continue
+            self.index[sha1][0] -= 1
+            if self.index[sha1][0] <= 0:
+                del self.index[sha1]
+                unused.append(sha1)
+        # Deleted after the index is saved, a crash leaves unused files
+        # instead of references to missing ones.
+        self._save_index()
+        for sha1 in unused:
+            os.remove(self._object_path(sha1))
+
+    def gc(self):
+        """
+        Removes chunks that no backup references, left over by interrupted
+        backups.
+        """
+        for fan_dir in os.listdir(self.objects_dir):
+            fan_path = os.path.join(self.objects_dir, fan_dir)
+            for node in os.listdir(fan_path):
+                if fan_dir + node not in self.index:
+                    os.remove(os.path.join(fan_path, node))
+            if len(os.listdir(fan_path)) == 0:
+                os.rmdir(fan_path)
+
+    def unique_size(self, manifest):
+        """
+        Stored bytes that removing the backup with this manifest would free.
+        """
+        return sum(self.index[sha1][1] for sha1 in set(sha1 for sha1, _ in manifest)
+                   if sha1 in self.index and self.index[sha1][0] == 1)
+
+    def stored_size(self):
+        return sum(stored_size for _, stored_size in self.index.values())
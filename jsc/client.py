@@ -20,24 +20,29 @@ Options:
   -c --non-interactive=CMD  Execute single command
   --no-update               Do not check for updates of jsc
 """
+import archive
 import argparse
-import base64
 import choice
 import cmd
+import collections
 from docopt import docopt, DocoptExit
 import distutils.version as dist_version
 import json
+import jscignore
 import os
 import os.path
 import platform
 import shlex
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import getpass
-import re
+import hashlib
 import requests
-import fnmatch
+import delta
 import recipe
 import giturlparse
 import glob
@@ -87,55 +92,226 @@ LOCAL_JSC_PATH = os.path.expanduser("~/.jsc")
 API_KEY_FILE = os.path.join(LOCAL_JSC_PATH, "api_key")
 
 
-def get_filter(jscignore):
-    root = os.path.dirname(jscignore)
-    excluded_paths = [os.path.basename(jscignore), ".svn", ".git"]
-    jscignore_lines = []
-    if os.path.exists(jscignore):
-        with open(jscignore) as fh:
-            jscignore_lines = [x.rstrip() for x in fh.readlines() if not x.startswith("#") and len(x.rstrip()) > 0]
-    excluded_paths = list(set(excluded_paths) | set(jscignore_lines))
-    exclude_regxs = [re.compile(fnmatch.translate(os.path.join(root, x))) for x in excluded_paths]
-
-    def should_skip(fn):
-        for reobj in exclude_regxs:
-            if reobj.match(fn) is not None:
-                return True
-        return False
-    return should_skip
-
-
-def rpc_put_recipe(rpc, src, dst=NEW_RECIPE_SRC, chunk_size=2**16, should_skip=lambda x: False):
-    def put_file(fn_path_src, fn_path_dst):
-        f_stat = os.stat(fn_path_src)
-        bytes_left = f_stat.st_size
-        log.white("putting local:{src} -> remote:{dst}".format(src=fn_path_src, dst=dst))
-        with open(fn_path_src, "rb") as fo:
-            while True:
-                b64_content = base64.standard_b64encode(fo.read(chunk_size))
-                rpc.do_file_append({"path": fn_path_dst, "content": b64_content})
-                bytes_left -= chunk_size
-                if bytes_left <= 0:
-                    break
+def get_filter(jscignore_path):
+    return jscignore.JscIgnore.from_file(jscignore_path).should_skip
+
+
+def read_chunks(fo, chunk_size, sha1=None):
+    while True:
+        chunk = fo.read(chunk_size)
+        if len(chunk) == 0:
+            break
+        if sha1 is not None:
+            sha1.update(chunk)
+        yield chunk
+
+
+def rpc_put_file(rpc, fn_path_src, fn_path_dst, chunk_size=2**16, signature=None, basis=None):
+    if signature is not None:
+        # The server has an older version, only send what changed. The patch
+        # is made before the channel is taken, so other uploads go on
+        # meanwhile.
+        with open(fn_path_src, "rb") as fo, tempfile.TemporaryFile() as patch:
+            for chunk in delta.diff(fo, signature):
+                patch.write(chunk)
+            if patch.tell() < os.fstat(fo.fileno()).st_size:
+                patch.seek(0)
+                patch_args = {"path": fn_path_dst, "basis": basis, "block_size": signature["block_size"], "cache": True}
+                future = rpc.call_stream("do_file_patch", patch_args, read_chunks(patch, chunk_size))
+                if future.result()["sha1"] == delta.file_sha1(fn_path_src):
+                    return
+        # Block checksums collided or hardly anything could be copied, send
+        # all of it.
+    sha1 = hashlib.sha1()
+    with open(fn_path_src, "rb") as fo:
+        future = rpc.call_stream("do_file_stream", {"path": fn_path_dst, "cache": True}, read_chunks(fo, chunk_size, sha1))
+    if future.result()["sha1"] != sha1.hexdigest():
+        raise SshRpcCallError("checksum mismatch for {dst}".format(dst=fn_path_dst))
+
+
+def list_recipe_tree(src, should_skip, rel_dir=""):
+    """
+    Lists the recipe dir as (kind, local path, path relative to src) tuples
+    with every dir before its content.
+    """
+    entries = []
+    for fn in os.listdir(src):
+        fn_path_src = os.path.join(src, fn)
+        mode = os.lstat(fn_path_src).st_mode
+        if should_skip(fn_path_src, stat.S_ISDIR(mode)):
+            continue
+        rel_path = rel_dir + fn
+        if stat.S_ISLNK(mode):
+            entries.append(("link", fn_path_src, rel_path))
+        elif stat.S_ISREG(mode):
+            entries.append(("file", fn_path_src, rel_path))
+        elif stat.S_ISDIR(mode):
+            entries.append(("dir", fn_path_src, rel_path))
+            entries += list_recipe_tree(fn_path_src, should_skip, rel_path + "/")
+    return entries
+
+
+def rpc_fetch_cached(rpc, files, jobs):
+    """
+    Lets the server write the files, (local path, remote path) tuples, it
+    has in its upload cache and returns the ones left to upload. Fetched
+    files get the permissions of the local ones.
+    """
+    sha1s = {}
+    modes = {}
+
+    def hash_file(item):
+        sha1s[item[1]] = delta.file_sha1(item[0])
+        modes[item[1]] = stat.S_IMODE(os.stat(item[0]).st_mode)
+
+    run_parallel(hash_file, files, jobs)
+    fetched = set(rpc.do_upload_cache_fetch({"files": [[fn_path_dst, sha1s[fn_path_dst], modes[fn_path_dst]] for _, fn_path_dst in files]}))
+    return [item for item in files if item[1] not in fetched]
+
+
+def run_parallel(func, items, workers):
+    """
+    Calls func on every item from a pool of threads. The first error stops
+    the pool and is raised again here.
+    """
+    items = iter(items)
+    items_lock = threading.Lock()
+    errors = []
 
+    def worker():
+        while len(errors) == 0:
+            with items_lock:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            try:
+                func(item)
+            except BaseException as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Joining with a timeout keeps us responsive to KeyboardInterrupt.
+        while thread.is_alive():
+            thread.join(0.1)
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def rpc_put_recipe(rpc, src, dst=NEW_RECIPE_SRC, chunk_size=2**16, should_skip=lambda path, is_dir=None: False, jobs=8):
     if os.path.isfile(src) or os.path.islink(src):
-        put_file(src, dst + "/Jumpstart-Recipe")
+        entries = [("file", src, "Jumpstart-Recipe")]
     elif os.path.isdir(src):
-        for fn in os.listdir(src):
-            fn_path_src = os.path.join(src, fn)
-            if should_skip(fn_path_src):
-                continue
-            fn_path_dst = dst + "/" + fn
-            if os.path.islink(fn_path_src):
-                link_target = os.readlink(fn_path_src)
-                rpc.do_symlink({"path": fn_path_dst, "target": link_target})
-            elif os.path.isfile(fn_path_src):
-                put_file(fn_path_src, fn_path_dst)
-            elif os.path.isdir(fn_path_src):
-                rpc.do_mkdir({"path": fn_path_dst})
-                rpc_put_recipe(rpc, fn_path_src, fn_path_dst, chunk_size, should_skip)
+        entries = list_recipe_tree(src, should_skip)
     else:
         log.white("could not find recipe dir or file")
+        return
+    dirs = [dst + "/" + rel_path for kind, _, rel_path in entries if kind == "dir"]
+    symlinks = [[dst + "/" + rel_path, os.readlink(fn_path_src)] for kind, fn_path_src, rel_path in entries if kind == "link"]
+    files = [(fn_path_src, rel_path) for kind, fn_path_src, rel_path in entries if kind == "file"]
+    if len(dirs) > 0 or len(symlinks) > 0:
+        rpc.do_mktree({"dirs": dirs, "symlinks": symlinks})
+    if len(files) == 0:
+        return
+    missing = set(fn_path_dst for _, fn_path_dst in rpc_fetch_cached(rpc, [(fn_path_src, dst + "/" + rel_path) for fn_path_src, rel_path in files], jobs))
+    files = [(fn_path_src, rel_path) for fn_path_src, rel_path in files if dst + "/" + rel_path in missing]
+    if len(files) == 0:
+        return
+    signatures = rpc.do_file_signatures({"paths": [rel_path for _, rel_path in files]})
+
+    def put_file(item):
+        fn_path_src, rel_path = item
+        fn_path_dst = dst + "/" + rel_path
+        log.white("putting local:{src} -> remote:{dst}".format(src=fn_path_src, dst=fn_path_dst))
+        rpc_put_file(rpc, fn_path_src, fn_path_dst, chunk_size, signatures.get(rel_path), rel_path)
+
+    # Every worker has one file in flight, the uploads queue up on the channel
+    # instead of each waiting for the previous reply.
+    with rpc.multiplexed():
+        run_parallel(put_file, files, jobs)
+
+
+def rpc_put_recipe_archive(rpc, src, dst=NEW_RECIPE_SRC, should_skip=lambda path, is_dir=None: False, level=6):
+    """
+    Uploads the recipe as one compressed tarball that the server extracts
+    while it arrives, using the best compression both sides have.
+    """
+    if os.path.isfile(src) or os.path.islink(src):
+        entries = [("file", src, "Jumpstart-Recipe")]
+    elif os.path.isdir(src):
+        entries = list_recipe_tree(src, should_skip)
+    else:
+        log.white("could not find recipe dir or file")
+        return
+    files = [(fn_path_src, dst + "/" + rel_path) for kind, fn_path_src, rel_path in entries if kind == "file"]
+    missing = set(fn_path_dst for _, fn_path_dst in rpc_fetch_cached(rpc, files, 8))
+    entries = [(kind, fn_path_src, rel_path) for kind, fn_path_src, rel_path in entries if kind != "file" or dst + "/" + rel_path in missing]
+    cache_paths = [rel_path for kind, _, rel_path in entries if kind == "file"]
+    entries = [(fn_path_src, rel_path) for _, fn_path_src, rel_path in entries]
+    server_formats = rpc.do_archive_formats()
+    fmt = [f for f in archive.available_formats() if f in server_formats][0]
+    log.white("putting local:{src} -> remote:{dst} as {fmt} archive".format(src=src, dst=dst, fmt=fmt))
+    sha1 = hashlib.sha1()
+
+    def chunks():
+        for chunk in archive.tar_chunks(entries, fmt, level):
+            sha1.update(chunk)
+            yield chunk
+
+    resp = rpc.call_stream("do_archive_extract", {"path": dst, "format": fmt, "cache": cache_paths}, chunks()).result()
+    if resp["sha1"] != sha1.hexdigest():
+        raise SshRpcCallError("checksum mismatch for archive of {src}".format(src=src))
+
+
+def rpc_backup_pull(rpc, backup_id, path=None, chunk_size=2**18, window=8):
+    """
+    Downloads the archive of a backup with up to window reads in flight.
+    What arrived is kept in a .part file, pulling again resumes from there.
+    """
+    info = rpc.do_backup_file_info({"id": backup_id})
+    if path is None:
+        path = "backup-{id}{ext}".format(id=backup_id, ext=info["name"][len("data"):])
+    part_path = path + ".part"
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if offset > info["size"]:
+        offset = 0
+    if offset > 0:
+        log.white("resuming {path} at {offset} of {size} bytes".format(path=path, offset=offset, size=info["size"]))
+    with open(part_path, "ab") as f:
+        f.truncate(offset)
+        pending = collections.deque()
+        while offset < info["size"] or len(pending) > 0:
+            while offset < info["size"] and len(pending) < window:
+                pending.append(rpc.call_async("do_backup_read", {"id": backup_id, "offset": offset, "size": chunk_size}))
+                offset += chunk_size
+            f.write(pending.popleft().result())
+    if os.path.getsize(part_path) != info["size"] or delta.file_sha1(part_path) != info["sha1"]:
+        os.remove(part_path)
+        raise SshRpcCallError("{path} arrived damaged, pull it again".format(path=path))
+    os.rename(part_path, path)
+    return path
+
+
+def rpc_backup_push(rpc, path, chunk_size=2**16):
+    """
+    Uploads a backup archive, resuming from what the server has of it, and
+    returns the id of the new backup.
+    """
+    name = os.path.basename(path)
+    size = os.path.getsize(path)
+    offset = rpc.do_backup_push_offset({"name": name})
+    if offset > size:
+        offset = 0
+    if offset > 0:
+        log.white("resuming {path} at {offset} of {size} bytes".format(path=path, offset=offset, size=size))
+    with open(path, "rb") as fo:
+        fo.seek(offset)
+        rpc.call_stream("do_backup_push", {"name": name, "offset": offset}, read_chunks(fo, chunk_size)).result()
+    return rpc.do_backup_push_finish({"name": name, "size": size, "sha1": delta.file_sha1(path)})
 
 
 def docopt_cmd(func):
@@ -198,20 +374,65 @@ class Console(cmd.Cmd):
         """
         Usage:
           backup [ls]
-          backup new
+          backup new [--full | --dedup] [--compress=<format>] [--level=<n>] [--threads=<n>] [--background]
           backup du
-          backup rm <id>
+          backup show <id> [--path=<glob>]
+          backup rm [--with-dependents] <id>
+          backup retention [--keep-last=<n>] [--daily=<n>] [--weekly=<n>] [--max-disk=<percent>]
+          backup prune [--dry-run]
+          backup pull <id> [<file>]
+          backup push <file>
 
-        Managing backups.
+        Managing backups. A new backup only stores what changed since the
+        latest one, unless it is full or deduplicated.
 
         Arguments:
           ls        List backups.
           new       Create a new backup.
           du        Like ls, but also shows size and disk space usage.
+          show      Lists the files in a backup.
           rm        Removes backup with supplied id.
+          retention Shows or changes which backups are kept, the others
+                    are removed after each new backup.
+          prune     Removes what the retention policy doesn't keep now.
+          pull      Downloads the archive of a full backup, to
+                    backup-<id>.<ext> unless a file is given.
+          push      Uploads a backup archive as a new backup.
+
+        Options:
+          --full              Store everything instead of what changed.
+          --dedup             Store everything in the shared chunk store,
+                              where only chunks no other backup has use space.
+          --compress=<format> zstd, gzip or lzo, zstd if the assembly has it.
+                              Always gzip with --dedup.
+          --level=<n>         Compression level, the format's default if unset.
+          --threads=<n>       Cores to compress on, 0 for all. [default: 0]
+          --with-dependents   Also remove the backups that depend on it.
+          --background        Run as a job, see jobs.
+          --keep-last=<n>     Keep the last n backups, 0 turns a rule off.
+          --daily=<n>         Keep the last backup of each of the last n days.
+          --weekly=<n>        Keep the last backup of each of the last n weeks.
+          --max-disk=<percent>
+                              Remove the oldest backups while they use more
+                              of the disk, the latest one always stays.
+          --dry-run           Only show what would be removed.
+          --path=<glob>       Only files matching the glob, or in dirs that
+                              do, relative to /app/code unless absolute.
         """
-        resp = self._rpc.do_backup(args)
-        if resp is not None:
+        try:
+            if args["pull"]:
+                log.white("pulled backup {id} to {path}".format(id=args["id"], path=rpc_backup_pull(self._rpc, args["id"], args["file"])))
+                return
+            if args["push"]:
+                log.white("pushed {path} as backup {id}".format(path=args["file"], id=rpc_backup_push(self._rpc, args["file"])))
+                return
+            resp = self._rpc.do_backup(args)
+        except SshRpcCallError as e:
+            log.white(str(e))
+            return
+        if args["new"] and args["--background"]:
+            log.white("backup running as job {job_id}".format(job_id=resp["job"]))
+        elif resp is not None:
             for line in resp:
                 log.white(line)
 
@@ -219,7 +440,7 @@ class Console(cmd.Cmd):
     def do_clean(self, args):
         """
         Usage:
-          clean [--code|--state|--all]
+          clean [--code|--state|--all] [--background]
 
         Cleans all user added directories and files in the given dataset.
 
@@ -227,6 +448,8 @@ class Console(cmd.Cmd):
           --code            Cleans /app/code (default).
           --state           Cleans /app/state.
           --all             Cleans both /app/code and /app/state.
+          --background      Move everything aside and return, a job deletes
+                            it meanwhile, see jobs.
         """
         self._rpc.do_clean(args)
 
@@ -245,7 +468,7 @@ class Console(cmd.Cmd):
     def do_deploy(self, args):
         """
         Usage:
-          deploy [--dev] <path>
+          deploy [--dev] [--jobs=<n>] [--archive] [--level=<n>] <path>
 
         Deploys a recipe.
 
@@ -255,6 +478,10 @@ class Console(cmd.Cmd):
         Options:
           --dev         Uses git clone instead of git archive to keep .git.
                         This should NOT be done on an assembly that are going to be released.
+          --jobs=<n>    Number of files uploaded in parallel from a local recipe [default: 8].
+          --archive     Upload a local recipe as one compressed tarball, zstd or lz4
+                        when available on both ends and gzip otherwise.
+          --level=<n>   Compression level for --archive [default: 6].
         """
         try:
             self._rpc.do_deploy_reset_check()
@@ -262,9 +489,13 @@ class Console(cmd.Cmd):
             if not giturlparse.validate(path):
                 if not path.startswith("/"):
                     path = os.path.join(os.getcwd(), path)
-                rpc_put_recipe(self._rpc, path, should_skip=get_filter(os.path.join(path, ".jscignore")))
+                should_skip = get_filter(os.path.join(path, ".jscignore"))
+                if args['--archive']:
+                    rpc_put_recipe_archive(self._rpc, path, should_skip=should_skip, level=int(args['--level']))
+                else:
+                    rpc_put_recipe(self._rpc, path, should_skip=should_skip, jobs=int(args['--jobs']))
             rec = self._rpc.do_deploy_read_new_recipe({"path": path})
-            state = recipe.run(self._rpc, rec, args['--dev'])
+            state = recipe.run(self._rpc, rec, args['--dev'], NEW_RECIPE_SRC)
             args.update({"state": state})
             self._rpc.do_deploy_finalize(args)
         except SshRpcCallError as e:
@@ -314,18 +545,64 @@ class Console(cmd.Cmd):
         env_json = self._rpc.do_env()
         log.white(json.dumps(env_json, sort_keys=True, indent=4, separators=(',', ': ')))
 
+    @docopt_cmd
+    def do_jobs(self, args):
+        """
+        Usage:
+          jobs [ls]
+          jobs watch <id>
+          jobs cancel <id>
+
+        Backups and reverts started with --background run as jobs, while the
+        console stays free. Only their outcome is printed unless watched.
+
+        Arguments:
+          ls        List jobs with their progress.
+          watch     Prints the progress of a job until it has finished.
+          cancel    Stops a job. A cancelled backup leaves nothing behind, a
+                    cancelled revert leaves the code dir partly reverted.
+        """
+        try:
+            if args["watch"]:
+                self._rpc.followed_jobs.add(args["id"])
+                try:
+                    self._rpc.do_jobs_wait({"id": args["id"]})
+                finally:
+                    self._rpc.followed_jobs.discard(args["id"])
+            elif args["cancel"]:
+                self._rpc.do_jobs_cancel({"id": args["id"]})
+            else:
+                for job in self._rpc.do_jobs():
+                    log.white(job["message"])
+        except SshRpcCallError as e:
+            log.white(str(e))
+
     @docopt_cmd
     def do_revert(self, args):
         """
         Usage:
-          revert <id>
+          revert <id> [--path=<glob>] [--background]
 
         Reverts a backup. This will destroy any changes you've made since backup.
+        With --path only the matching files are restored, over the current ones,
+        and nothing else is touched.
 
         Arguments:
           <id>        Id of the backup to restore.
+
+        Options:
+          --path=<glob>  Files to restore, or dirs to restore everything in,
+                         relative to /app/code unless absolute.
+          --background   Run as a job, see jobs.
         """
-        self._rpc.do_revert(args)
+        try:
+            resp = self._rpc.do_revert(args)
+        except SshRpcCallError as e:
+            log.white(str(e))
+            return
+        if args["--background"]:
+            log.white("revert running as job {job_id}".format(job_id=resp["job"]))
+            return
         log.white("revert of backup done!")
 
     @docopt_cmd
@@ -336,7 +613,8 @@ class Console(cmd.Cmd):
 
         Runs /app/code/init.
         """
-        self._rpc.do_run({})
+        if self._rpc.run_pty(["{code_dir}/init".format(code_dir=CODE_DIR)]) is None:
+            self._rpc.do_run({})
 
     @docopt_cmd
     def do_ssh(self, args):
@@ -382,7 +660,8 @@ class Console(cmd.Cmd):
           -v         Be more verbose and show what jumpstart-packages are installed and
                      which git repos are checked out.
         """
-        print_status(self._ssh_username, self._rpc.do_status(), self._rpc.do_env(), verbose=args['-v'])
+        status, env = self._rpc.call_batch([("do_status", None), ("do_env", None)])
+        print_status(self._ssh_username, status.result(), env.result(), verbose=args['-v'])
 
     def do_hist(self, args):
         """Print a list of commands that have been entered"""
@@ -562,29 +841,39 @@ def main(args=None):
                 pkey = None
             except SshRpcKeyAuthFailed:
                 fail("Authentication failed!")
+        lock_content_json = {
+            "hostname": platform.node(),
+            "unix_epoch": int(time.time()),
+        }
+        lock_content = json.dumps(lock_content_json)
+        # The login calls are sent as three batches, one round trip each. The
+        # first one decides if we may go on with the init in the second, the
+        # lock taken there if we may sync in the third.
+        is_assembly, check_init = rpc.call_batch([("do_assert_is_assembly", None),
+                                                  ("do_check_init", None)])
         try:
-            is_assembly = rpc.do_assert_is_assembly()
-            if not is_assembly:
+            if not is_assembly.result():
                 fail("Container is not an assembly")
-        except SshRpcError as e:
+        except (SshRpcError, SshRpcCallError) as e:
             fail(e)
-        res = rpc.do_check_init()
-        if res['needs_init']:
+        if check_init.result()['needs_init']:
             confirm = choice.Binary('Assembly is not initialized, would you like to do it now?', False).ask()
             if not confirm:
                 stop("You choose not to init the assembly, exiting...")
-        rpc.do_init()
-        lock_content_json = {
-            "hostname": platform.node(),
-            "unix_epoch": int(time.time()),
-        }
-        lock_content = json.dumps(lock_content_json)
-        rpc.do_lock_session(lock_content)
-        rpc.do_sync()
+        login_calls = [("do_sync", None)]
+        if arguments['--non-interactive'] is None:
+            login_calls += [("do_status", None), ("do_env", None)]
+        for batch in ([("do_init", None), ("do_lock_session", lock_content)], login_calls):
+            login = rpc.call_batch(batch)
+            for call in login:
+                try:
+                    call.result()
+                except SshRpcCallError as e:
+                    fail(e)
         console = Console(ssh_username, rpc, ssh_conn_str)
         if arguments['--non-interactive'] is None:
             # Print status on login
-            print_status(ssh_username, rpc.do_status(), rpc.do_env())
+            print_status(ssh_username, login[1].result(), login[2].result())
             # Start console prompt
             console.cmdloop_with_keyboard_interrupt("Welcome to jsc!")
         else:
@@ -0,0 +1,74 @@
+"""
+Serializers for the messages on the rpc channel. Both ends offer what they
+have in the handshake and the best one they share is used, stdlib json is
+always there. Anything but json needs frames, a msgpack message may hold
+newlines.
+"""
+import json
+
+try:
+    import msgpack
+    # Without its C extension msgpack is many times slower than json.
+    if msgpack.Packer.__module__ == "msgpack.fallback":
+        msgpack = None
+except ImportError:
+    msgpack = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JsonCodec():
+    name = "json"
+
+    def dumps(self, msg):
+        return json.dumps(msg)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class UjsonCodec():
+    name = "ujson"
+
+    def dumps(self, msg):
+        return ujson.dumps(msg, ensure_ascii=True, escape_forward_slashes=False)
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+class MsgpackCodec():
+    """
+    Byte strings are carried as they are, text comes back as unicode like it
+    does from json.
+    """
+    name = "msgpack"
+
+    def dumps(self, msg):
+        return msgpack.packb(msg, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+def available_codecs():
+    """
+    Codecs this side has, best first. json is always there.
+    """
+    codecs = []
+    if msgpack is not None:
+        codecs.append("msgpack")
+    if ujson is not None:
+        codecs.append("ujson")
+    codecs.append("json")
+    return codecs
+
+
+def codec(name):
+    if name == "msgpack":
+        return MsgpackCodec()
+    if name == "ujson":
+        return UjsonCodec()
+    return JsonCodec()
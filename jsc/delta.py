@@ -0,0 +1,167 @@
+"""
+rsync style delta encoding. The side that has an old version of a file (the
+basis) sends block signatures, the side with the new version answers with a
+patch that copies the blocks it could find in the basis and carries the rest
+as literal data.
+
+Patch format, a sequence of 9 byte op headers:
+  "C" first_block count    copy count blocks from the basis
+  "D" length 0             followed by length bytes of literal data
+"""
+import hashlib
+import math
+import os
+import struct
+import zlib
+
+ADLER_MOD = 65521
+BLOCK_SIZE_MIN = 2**11
+BLOCK_SIZE_MAX = 2**17
+# Rolling byte by byte runs in python and is slow. Once this much went out as
+# literal data the file is mostly new, the rest only looks for matches on
+# block boundaries, which still finds changes that keep the size.
+ROLL_LITERAL_MAX = 2**20
+# The file is read in windows of this size.
+READ_SIZE = 2**20
+OP_HEADER = struct.Struct("!cII")
+OUT_CHUNK_SIZE = 2**16
+
+
+def block_size_for(size):
+    return max(BLOCK_SIZE_MIN, min(BLOCK_SIZE_MAX, int(math.sqrt(size))))
+
+
+def weak_sum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def strong_sum(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def file_sha1(path, chunk_size=2**16):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def signature(path):
+    size = 0
+    sha1 = hashlib.sha1()
+    blocks = []
+    block_size = block_size_for(os.path.getsize(path))
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) == 0:
+                break
+            size += len(block)
+            sha1.update(block)
+            blocks.append([weak_sum(block), strong_sum(block)])
+    return {"size": size,
+            "sha1": sha1.hexdigest(),
+            "block_size": block_size,
+            "blocks": blocks}
+
+
+def diff(f, sig):
+    """
+    Yields the patch that turns the basis described by sig into the content
+    of the file object f.
+    """
+    block_size = sig["block_size"]
+    table = {}
+    for idx, (weak, strong) in enumerate(sig["blocks"]):
+        table.setdefault(weak, []).append((idx, strong))
+    out = []
+    out_size = [0]
+    literal_size = [0]
+    # Pending run of consecutive blocks to copy, [first_block, count].
+    copy = [None, 0]
+
+    def emit(op):
+        out.append(op)
+        out_size[0] += len(op)
+
+    def flush_copy():
+        if copy[0] is not None:
+            emit(OP_HEADER.pack("C", copy[0], copy[1]))
+            copy[0], copy[1] = None, 0
+
+    def emit_literal(data, start, end):
+        if end > start:
+            flush_copy()
+            emit(OP_HEADER.pack("D", end - start, 0))
+            emit(data[start:end])
+            literal_size[0] += end - start
+
+    def find_block(weak, block):
+        strong = strong_sum(block)
+        for idx, candidate in table[weak]:
+            if candidate == strong:
+                return idx
+        return None
+
+    # The window of the file in memory, what is before literal_start has
+    # been emitted.
+    data = ""
+    eof = False
+    i = 0
+    literal_start = 0
+    weak = None
+    while True:
+        if not eof and len(data) - i <= block_size:
+            chunk = f.read(READ_SIZE)
+            eof = len(chunk) == 0
+            data = data[literal_start:] + chunk
+            i -= literal_start
+            literal_start = 0
+            continue
+        n = len(data)
+        if i >= n:
+            break
+        if weak is None:
+            weak = weak_sum(data[i:i + block_size])
+            a, b = weak & 0xffff, weak >> 16
+        idx = None
+        if weak in table:
+            idx = find_block(weak, data[i:i + block_size])
+        if idx is not None:
+            emit_literal(data, literal_start, i)
+            if copy[0] is not None and copy[0] + copy[1] == idx:
+                copy[1] += 1
+            else:
+                flush_copy()
+                copy[0], copy[1] = idx, 1
+            i = min(i + block_size, n)
+            literal_start = i
+            weak = None
+        elif literal_size[0] >= ROLL_LITERAL_MAX:
+            i = min(i + block_size, n)
+            weak = None
+        elif i + block_size >= n:
+            # The window can't roll past the end, the rest is literal.
+            break
+        else:
+            old = ord(data[i])
+            new = ord(data[i + block_size])
+            a = (a - old + new) % ADLER_MOD
+            b = (b - block_size * old + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+            i += 1
+        if i - literal_start >= OUT_CHUNK_SIZE:
+            emit_literal(data, literal_start, i)
+            literal_start = i
+        if out_size[0] >= OUT_CHUNK_SIZE:
+            yield "".join(out)
+            del out[:]
+            out_size[0] = 0
+    emit_literal(data, literal_start, len(data))
+    flush_copy()
+    if len(out) > 0:
+        yield "".join(out)
@@ -0,0 +1,110 @@
+"""
+Deletes dir trees in process on several threads, instead of forking rm -rf
+per entry. Workers list dirs and unlink what is in them, the emptied dirs
+are removed deepest first at the end. Deleting is mostly waiting on the
+file system, threads overlap that even with the GIL.
+"""
+import errno
+import multiprocessing
+import os
+import stat
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def list_dir(path):
+    """
+    Yields the names in a dir and whether each is a dir, without following
+    symlinks. scandir gets the types with the names, listdir needs an lstat
+    per entry.
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.is_dir(follow_symlinks=False)
+        return
+    for name in os.listdir(path):
+        yield name, stat.S_ISDIR(os.lstat(os.path.join(path, name)).st_mode)
+
+
+def unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def delete_trees(paths, threads=0, progress=None):
+    """
+    Deletes paths, files or dirs with everything in them. progress(count)
+    is called with the number of entries deleted as they go.
+    """
+    if threads <= 0:
+        threads = max(4, multiprocessing.cpu_count())
+    lock = threading.Lock()
+    dirs = queue.Queue()
+    emptied = []
+    errors = []
+
+    def report(count):
+        if progress is not None and count > 0:
+            with lock:
+                progress(count)
+
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            dirs.put((0, path))
+        elif os.path.lexists(path):
+            unlink(path)
+            report(1)
+
+    def work():
+        while True:
+            item = dirs.get()
+            if item is None:
+                return
+            depth, path = item
+            try:
+                count = 0
+                for name, is_dir in list_dir(path):
+                    if is_dir:
+                        dirs.put((depth + 1, os.path.join(path, name)))
+                    else:
+                        unlink(os.path.join(path, name))
+                        count += 1
+                with lock:
+                    emptied.append((depth, path))
+                report(count)
+            except BaseException as e:
+                with lock:
+                    errors.append(e)
+            finally:
+                dirs.task_done()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    dirs.join()
+    for _ in workers:
+        dirs.put(None)
+    for worker in workers:
+        worker.join()
+    if len(errors) > 0:
+        raise errors[0]
+    emptied.sort(reverse=True)
+    for _, path in emptied:
+        os.rmdir(path)
+    report(len(emptied))
@@ -0,0 +1,116 @@
+"""
+How messages are cut apart on the rpc channel.
+
+Lines, what every server speaks: a JSON message and a newline. Frames, when
+both ends agree on it in the handshake: a header with the kind of frame and
+the length of its payload, then the payload as is. Binary payloads then go
+without base64 and the reader knows up front how much is coming.
+"""
+import struct
+
+LINES = "lines"
+FRAMES = "frames"
+
+FRAME_HEADER = struct.Struct("!cI")
+# A JSON-RPC message, in the codec picked in the handshake.
+FRAME_JSON = "j"
+# The result of a call as raw bytes, after the id of the call.
+FRAME_BINARY = "b"
+# A chunk of the payload of a streaming call, an empty one ends the stream.
+FRAME_STREAM = "s"
+BINARY_ID = struct.Struct("!q")
+
+# Methods whose result is bytes, in a binary frame with frames and base64 in
+# the JSON response with lines.
+BINARY_METHODS = ("do_backup_read",)
+
+
+def frame(kind, payload):
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+def binary_frame_header(rpc_id, size):
+    """
+    Header of a binary frame with size bytes of result, the result itself
+    can be written right after it.
+    """
+    return FRAME_HEADER.pack(FRAME_BINARY, BINARY_ID.size + size) + BINARY_ID.pack(rpc_id)
+
+
+class InBuffer():
+    """
+    Bytes read from the channel and not consumed yet. New data is appended
+    in place and consumed data is dropped in one go once it is half of the
+    buffer, so a message arriving in many small reads costs time linear in
+    its size.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+        # There is no newline between pos and here.
+        self.scanned = 0
+
+    def __len__(self):
+        return len(self.buf) - self.pos
+
+    def feed(self, data):
+        if self.pos > 0 and self.pos * 2 >= len(self.buf):
+            del self.buf[:self.pos]
+            self.scanned = max(0, self.scanned - self.pos)
+            self.pos = 0
+        self.buf += data
+
+    def readline(self):
+        """
+        The next line without its newline, None when it is not complete.
+        """
+        end = self.buf.find("\n", max(self.pos, self.scanned))
+        if end < 0:
+            self.scanned = len(self.buf)
+            return None
+        line = str(self.buf[self.pos:end])
+        self.pos = self.scanned = end + 1
+        return line
+
+    def read(self, size):
+        """
+        Up to size bytes, less when no more have come yet.
+        """
+        data = str(self.buf[self.pos:self.pos + size])
+        self.pos += len(data)
+        return data
+
+    def readinto(self, view):
+        size = min(len(view), len(self))
+        view[:size] = memoryview(self.buf)[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+
+class FrameReader():
+    """
+    Reads frames out of an InBuffer. Once the header is in, the payload is
+    copied into a bytearray of its size as it arrives.
+    """
+    def __init__(self):
+        self.kind = None
+        self.payload = None
+        self.filled = 0
+
+    def read(self, buf):
+        """
+        The next frame as (kind, payload), None when it is not complete.
+        """
+        if self.kind is None:
+            if len(buf) < FRAME_HEADER.size:
+                return None
+            self.kind, size = FRAME_HEADER.unpack(buf.read(FRAME_HEADER.size))
+            self.payload = bytearray(size)
+            self.filled = 0
+        self.filled += buf.readinto(memoryview(self.payload)[self.filled:])
+        if self.filled < len(self.payload):
+            return None
+        kind, payload = self.kind, str(self.payload)
+        self.kind = None
+        self.payload = None
+        return kind, payload
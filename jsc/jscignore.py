@@ -0,0 +1,147 @@
+"""
+.jscignore matching with gitignore semantics: negation with !, patterns
+anchored with a leading or inner /, ** for any number of dirs and dir only
+patterns with a trailing /.
+
+The last pattern that matches a path decides, so the patterns are merged into
+one regex per run of patterns with the same polarity and the runs are tried
+from the end. Without negations that is a single regex. Like git, nothing
+below an ignored dir can be re-included, walkers should skip ignored dirs
+instead of listing them.
+"""
+import os
+import re
+import stat
+
+DEFAULT_PATTERNS = [".jscignore", ".svn", ".git"]
+
+
+class Pattern():
+    def __init__(self, line):
+        self.negated = False
+        self.dir_only = False
+        if line.startswith("!"):
+            self.negated = True
+            line = line[1:]
+        elif line.startswith("\\!") or line.startswith("\\#"):
+            line = line[1:]
+        if line.endswith("/"):
+            self.dir_only = True
+            line = line.rstrip("/")
+        anchored = "/" in line
+        line = line.lstrip("/")
+        self.regex = translate(line)
+        if not anchored:
+            self.regex = "(?:.*/)?" + self.regex
+
+
+def translate(pattern):
+    """
+    Translates a glob to a regex where wildcards don't cross dirs, except **.
+    """
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            # Zero or more leading dirs.
+            res.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i) and i + 2 == n and i > 0 and pattern[i - 1] == "/":
+            # Everything inside.
+            res.append(".*")
+            i += 2
+        elif c == "*":
+            while i < n and pattern[i] == "*":
+                i += 1
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+            i += 1
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                res.append("\\[")
+                i += 1
+            else:
+                body = pattern[i + 1:j].replace("\\", "\\\\")
+                if body[0] in "!^":
+                    body = "^" + body[1:]
+                res.append("(?!/)[" + body + "]")
+                i = j + 1
+        elif c == "\\" and i + 1 < n:
+            res.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            res.append(re.escape(c))
+            i += 1
+    return "".join(res)
+
+
+def parse_line(line):
+    line = line.rstrip("\n").rstrip("\r")
+    if line.startswith("#"):
+        return None
+    # Trailing spaces don't count unless escaped.
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "
+    if len(stripped) == 0:
+        return None
+    return Pattern(stripped)
+
+
+def compile_runs(patterns):
+    runs = []
+    for pattern in patterns:
+        if len(runs) > 0 and runs[-1][0] == pattern.negated:
+            runs[-1][1].append(pattern.regex)
+        else:
+            runs.append((pattern.negated, [pattern.regex]))
+    runs.reverse()
+    return [(negated, re.compile("^(?:" + "|".join(regexes) + ")$", re.DOTALL)) for negated, regexes in runs]
+
+
+class JscIgnore():
+    def __init__(self, root, lines):
+        self.root = root
+        patterns = [p for p in (parse_line(line) for line in lines) if p is not None]
+        self._dir_runs = compile_runs(patterns)
+        self._file_runs = compile_runs([p for p in patterns if not p.dir_only])
+
+    @classmethod
+    def from_file(cls, jscignore):
+        lines = list(DEFAULT_PATTERNS)
+        if os.path.exists(jscignore):
+            with open(jscignore) as fh:
+                lines += fh.readlines()
+        return cls(os.path.dirname(jscignore), lines)
+
+    def is_ignored(self, rel_path, is_dir):
+        """
+        Whether the path relative to the root, with / as separator, is
+        ignored. Ignored parent dirs are not looked at.
+        """
+        for negated, regex in (self._dir_runs if is_dir else self._file_runs):
+            if regex.match(rel_path) is not None:
+                return not negated
+        return False
+
+    def should_skip(self, path, is_dir=None):
+        """
+        Whether path is ignored. A tree walk that has the mode already passes
+        is_dir, else the path is looked up.
+        """
+        rel_path = os.path.relpath(path, self.root).replace(os.sep, "/")
+        if is_dir is None:
+            try:
+                is_dir = stat.S_ISDIR(os.lstat(path).st_mode)
+            except OSError:
+                is_dir = False
+        return self.is_ignored(rel_path, is_dir)
@@ -1,29 +1,47 @@
-from docopt import docopt, DocoptExit
+import shlex
+
+from sshrpcutil import *
+
+try:
+    import rlexer
+except ImportError:
+    from jsc import rlexer
 try:
     import logger as log
-    import rparser
 except ImportError:
-    from jsc import logger as log, rparser
+    from jsc import logger as log
+
+# Where the run statements of a recipe are run.
+RUN_DIR = "/app/code/.jsc/new-recipe/src"
 
 
 class RecipeRuntimeError(BaseException):
     pass
 
 
-def run(rpc, recipe, is_dev):
-    lc = 0
-    state = {"software_list": {}, "name": None, "is_dev": is_dev}
-    try:
-        for statement in rparser.parse(recipe):
-            # Everything after # is comment.
-            lc += 1
-            command = statement[0]
-            args = statement[1:]
-            state = rpc.call("rc_" + command, {"args": args, "state": state})
-            # recipe_execute_cmd(rpc, state, clean_line)
+def execute(rpc, statements, state, is_dev):
+    if len(statements) == 0 and state is not None:
         return state
-    except DocoptExit as e:
-        log.err('Recipe contains an invalid command at Line {line}.'.format(line=lc))
-        log.err(e)
-    except RecipeRuntimeError as e:
-        log.err('Recipe command on line {line} failed with error: {e}'.format(line=lc, e=e))
+    return rpc.call("do_deploy_execute", {"statements": statements, "state": state, "is_dev": is_dev})
+
+
+def run(rpc, recipe, is_dev, run_dir=RUN_DIR):
+    # The statements between run statements go over in one call with the
+    # line of each, the server stops at the first one that fails. Run
+    # statements get a terminal channel of their own, unless the server
+    # does not give out terminals and runs them itself.
+    state = None
+    statements = []
+    for line, statement in rlexer.statements(recipe):
+        if statement[0] == "run" and rpc.pty:
+            try:
+                args = shlex.split(statement[1])
+            except ValueError as e:
+                raise SshRpcCallError("Recipe command on line {line} failed with error: {e}".format(line=line, e=e))
+            state = execute(rpc, statements, state, is_dev)
+            statements = []
+            log.white("running command: {}".format(statement[1]))
+            if rpc.run_pty(args, run_dir) is not None:
+                continue
+        statements.append([line, statement])
+    return execute(rpc, statements, state, is_dev)
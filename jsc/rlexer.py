@@ -0,0 +1,219 @@
+"""
+Single pass lexer for recipes, a fast stand in for the pyparsing grammar
+in rparser. Statements are yielded as they are read, so a recipe can start
+running before the rest of it is looked at.
+
+It gives the same statements as rparser.parse, quirks included: tabs are
+expanded first, a statement that does not parse ends the recipe unless it
+is the first one, and options of gd are taken greedily.
+"""
+import re
+import string
+
+import pyparsing as pp
+
+# Skipped before most tokens, what rparser sets as pyparsing's whitespace.
+SPACES = re.compile(r"[ \t\r]*")
+IDENT_CHARS = frozenset(string.ascii_letters + string.digits + "_$")
+IDENT = re.compile(r"[A-Za-z0-9_$]+")
+
+UNQUOTED = re.compile(r"[^ \n]+")
+ML_QUOTED = {"'": re.compile(r"'(?:[^'\\]|(?:\\.))*'", re.DOTALL),
+             "\"": re.compile(r'"(?:[^"\\]|(?:\\.))*"', re.DOTALL)}
+SL_QUOTED = {"'": re.compile(r"'(?:[^'\n\r\\]|(?:\\.))*'"),
+             "\"": re.compile(r'"(?:[^"\n\r\\]|(?:\\.))*"')}
+UNIX_PATH = re.compile(r"(?:\\ |[^ \n])+")
+PATH_ESCAPE = re.compile(r"\\([ n])")
+QUOTE_ESCAPE = re.compile(r"\\(.)")
+QUOTE_WS_ESCAPES = ((r"\t", "\t"), (r"\n", "\n"), (r"\f", "\f"), (r"\r", "\r"))
+OPTION = re.compile(r"-+[A-Za-z0-9]+")
+# One or more spaces, \t and \r are skipped in between.
+SPACE = re.compile(r"(?:[\t\r]* +)+")
+WSPACES = re.compile(r"[\n\r\t ]+")
+WHITE = re.compile(r"[ \t\r\n]+")
+REST_OF_LINE = re.compile(r".*")
+
+
+class NoMatch(Exception):
+    pass
+
+
+def skip(s, pos):
+    return SPACES.match(s, pos).end() if pos < len(s) else pos
+
+
+def match(regex, s, pos):
+    m = regex.match(s, pos)
+    if m is None:
+        raise NoMatch()
+    return m.end(), m.group()
+
+
+def unquote(quoted):
+    text = quoted[1:-1]
+    if "\\" in text:
+        for escape, char in QUOTE_WS_ESCAPES:
+            text = text.replace(escape, char)
+        text = QUOTE_ESCAPE.sub(r"\g<1>", text)
+    return text
+
+
+def quoted(patterns, s, pos):
+    if pos < len(s) and s[pos] in patterns:
+        m = patterns[s[pos]].match(s, pos)
+        if m is not None:
+            return m.end(), unquote(m.group())
+    return None
+
+
+def string_token(s, pos):
+    """
+    A quoted string that may span lines or a word.
+    """
+    pos = skip(s, pos)
+    return quoted(ML_QUOTED, s, pos) or match(UNQUOTED, s, pos)
+
+
+def unix_path(s, pos):
+    pos, path = match(UNIX_PATH, s, skip(s, pos))
+    return pos, PATH_ESCAPE.sub(lambda m: " " if m.group(1) == " " else "\n", path)
+
+
+def option(s, pos):
+    """
+    --name, --name=value or --name value, always given as --name=value.
+    """
+    pos, name = match(OPTION, s, skip(s, pos))
+    if pos < len(s) and s[pos] in " =":
+        value = quoted(SL_QUOTED, s, pos + 1)
+        if value is None:
+            m = UNQUOTED.match(s, pos + 1)
+            value = (m.end(), m.group()) if m is not None else None
+        if value is not None:
+            return value[0], name + "=" + value[1]
+    return pos, name
+
+
+def name_stmt(s, pos):
+    pos, name = string_token(s, pos)
+    return pos, [name]
+
+
+def package_stmt(s, pos):
+    pos, packages = match(REST_OF_LINE, s, pos)
+    if len(packages) == 0:
+        raise NoMatch()
+    return pos, [package for package in packages.split(" ") if len(package) > 0]
+
+
+def gd_stmt(s, pos):
+    args = []
+    for _ in range(3):
+        m = SPACE.match(s, pos)
+        if m is None:
+            break
+        try:
+            pos, opt = option(s, m.end())
+        except NoMatch:
+            break
+        args.append(opt)
+    pos, repo = match(UNQUOTED, s, skip(s, pos))
+    pos, path = unix_path(s, pos)
+    return pos, args + [repo, path]
+
+
+def run_stmt(s, pos):
+    pos, _ = match(SPACE, s, pos)
+    pos, command = match(REST_OF_LINE, s, pos)
+    return pos, [command]
+
+
+def install_stmt(s, pos):
+    pos, src = unix_path(s, pos)
+    pos, dst = unix_path(s, pos)
+    return pos, [src, dst]
+
+
+def path_strings_stmt(count):
+    def stmt(s, pos):
+        pos, path = unix_path(s, pos)
+        args = [path]
+        for _ in range(count):
+            pos, _ = match(WSPACES, s, pos)
+            pos, text = string_token(s, pos)
+            args.append(text)
+        return pos, args
+    return stmt
+
+
+STATEMENTS = {
+    "name": name_stmt,
+    "package": package_stmt,
+    "gd": gd_stmt,
+    "run": run_stmt,
+    "install": install_stmt,
+    "append": path_strings_stmt(1),
+    "put": path_strings_stmt(1),
+    "replace": path_strings_stmt(2),
+    "insert": path_strings_stmt(2),
+    "rinsert": path_strings_stmt(2),
+}
+
+
+def statement(s, pos):
+    """
+    Reads the statement at pos, gives the position after it and its
+    tokens, None for comments and blank lines.
+    """
+    if pos >= len(s):
+        raise NoMatch()
+    if s[pos] == "#":
+        return REST_OF_LINE.match(s, pos + 1).end(), None
+    if s[pos] == "\n":
+        return WHITE.match(s, pos).end(), None
+    m = IDENT.match(s, pos)
+    if m is None or m.group() not in STATEMENTS or (pos > 0 and s[pos - 1] in IDENT_CHARS):
+        raise NoMatch()
+    end, args = STATEMENTS[m.group()](s, m.end())
+    return end, [m.group()] + args
+
+
+def statements(recipe):
+    """
+    Yields the statements of a recipe as (line number, statement) tuples,
+    the statement as a list of strings. Raises pyparsing.ParseException,
+    like rparser.parse, when not even the first statement can be read.
+    """
+    s = recipe.expandtabs()
+    pos = 0
+    line = 1
+    line_pos = 0
+    first = True
+    while True:
+        start = skip(s, pos)
+        try:
+            pos, stmt = statement(s, start)
+        except NoMatch:
+            if first:
+                raise pp.ParseException(s, start, "Expected a recipe statement")
+            return
+        first = False
+        line += s.count("\n", line_pos, start)
+        line_pos = start
+        # A statement ends at a newline, the end of the recipe or where the
+        # next one starts.
+        end = skip(s, pos)
+        if end >= len(s):
+            pos = len(s) + 1
+        elif s[end] == "\n":
+            pos = end + 1
+        if stmt is not None:
+            yield line, stmt
+
+
+def parse(recipe):
+    """
+    Yields the statements of a recipe, what rparser.parse gives.
+    """
+    for _, stmt in statements(recipe):
+        yield stmt
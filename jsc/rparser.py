@@ -1,16 +1,29 @@
+import collections
+import copy
+import hashlib
+import re
+import threading
+
 import pyparsing as pp
 
 
 pp.ParserElement.setDefaultWhitespaceChars(" \t\r")
+# Packrat is left off, the grammar hardly backtracks and memoizing every
+# attempt made parsing recipes three times slower.
+
+# Parsed recipes kept by hash, deploys parse the same recipe again and again.
+PARSE_CACHE_SIZE = 16
 
 
 def replace_lamba(find, replace):
     return lambda s, locs, toks: [toks[0].replace(find, replace)]
 
 
-def parse(recipe):
-    """ Parses recipe files
-    """
+def unescape_path(s, locs, toks):
+    return [re.sub(r"\\([ n])", lambda m: " " if m.group(1) == " " else "\n", toks[0])]
+
+
+def grammar():
     """
     sgl_quoted_string = "'", { "\'" | all characters - "'" }, '"'
     dbl_quoted_string = '"', { '\"' | all characters - '"' }, '"'
@@ -34,10 +47,7 @@ def parse(recipe):
     fn_word ::= all characters - ' ';
     unix_path ::= <escaped_space> | <fn_word>, { escaped_space | <fn_word> };
     """
-    escaped_space = pp.Regex("\\\\ ").addParseAction(replace_lamba("\\", ""))
-    escaped_newline = pp.Regex("\\\\n").addParseAction(replace_lamba('\\n', '\n'))
-    fn_word = pp.Regex("[^ \n]")
-    unix_path = pp.Combine(pp.OneOrMore(escaped_space | escaped_newline | fn_word))
+    unix_path = pp.Regex(r"(?:\\ |[^ \n])+").addParseAction(unescape_path)
 
     option_short = pp.Word("-") + pp.Word(pp.alphanums)
     option_long = pp.Combine(pp.Word("--") + pp.Word(pp.alphanums) + pp.Optional((pp.Literal(" ") | pp.Literal("=")).addParseAction(replace_lamba(" ", "=")) + sl_string))
@@ -60,22 +70,49 @@ def parse(recipe):
 
     """
     Suppresses any statement that is not on it's own line(s).
+    Every statement starts with its own keyword, so at most one of them can
+    match a line and the first match is the only one. Whitespace goes last,
+    it would otherwise take the indentation of a statement.
+    """
+    stmt = pp.MatchFirst([name_stmt,
+                          package_stmt,
+                          gd_stmt,
+                          run_stmt,
+                          install_stmt,
+                          append_stmt,
+                          put_stmt,
+                          replace_stmt,
+                          insert_stmt,
+                          rinsert_stmt,
+                          comment_stmt.suppress(),
+                          pp.White().suppress()]) + (pp.LineEnd() | ~pp.StringEnd()).suppress()
+    return pp.OneOrMore(stmt)
+
+
+RECIPE = grammar()
+parse_cache = collections.OrderedDict()
+parse_cache_lock = threading.Lock()
+
+
+def parse(recipe):
+    """ Parses recipe files
+
+    Results are cached by the hash of the recipe. Callers get a copy they
+    are free to change.
     """
-    stmt = pp.Or([name_stmt,
-                  package_stmt,
-                  gd_stmt,
-                  run_stmt,
-                  install_stmt,
-                  append_stmt,
-                  put_stmt,
-                  replace_stmt,
-                  insert_stmt,
-                  rinsert_stmt,
-                  comment_stmt.suppress(),
-                  pp.White().suppress()]) + (pp.LineEnd() | ~pp.StringEnd()).suppress()
-    calls = pp.OneOrMore(stmt).parseString(recipe)
-    return calls
+    key = hashlib.sha1(recipe.encode("utf-8") if type(recipe) is not str else recipe).hexdigest()
+    with parse_cache_lock:
+        calls = parse_cache.pop(key, None)
+        if calls is not None:
+            parse_cache[key] = calls
+            return copy.deepcopy(calls)
+    calls = RECIPE.parseString(recipe)
+    with parse_cache_lock:
+        parse_cache[key] = calls
+        while len(parse_cache) > PARSE_CACHE_SIZE:
+            parse_cache.popitem(last=False)
+    return copy.deepcopy(calls)
 
 
 #print("testparse")
-#print("{}".format(parse("install\nrun\ninstall")))
\ No newline at end of file
+#print("{}".format(parse("install\nrun\ninstall")))
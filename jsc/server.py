@@ -1,5 +1,6 @@
 import select
 import sys
+import errno
 import json
 import os
 import fcntl
@@ -9,7 +10,9 @@ import datetime
 import signal
 import pty
 import base64
+import hashlib
 import shutil
+import tempfile
 import giturlparse
 import urllib2
 import httplib
@@ -17,27 +20,141 @@ from docopt import docopt, DocoptExit
 import shlex
 from distutils.spawn import find_executable
 import termios
+import threading
+import fnmatch
+import glob
+import functools
+import itertools
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 try:
     from __init__ import __version__
 except ImportError:
     from jsc import __version__
+try:
+    import delta
+except ImportError:
+    from jsc import delta
+try:
+    import chunkstore
+except ImportError:
+    from jsc import chunkstore
+try:
+    import archive
+except ImportError:
+    from jsc import archive
+try:
+    import tarindex
+except ImportError:
+    from jsc import tarindex
+try:
+    import deltree
+except ImportError:
+    from jsc import deltree
+try:
+    import framing
+except ImportError:
+    from jsc import framing
+try:
+    import codec
+except ImportError:
+    from jsc import codec
 
 
 # Terminate if sshd dies
 signal.signal(signal.SIGHUP, lambda x, y: os._exit(1))
 
 
+# Handlers may run in threads, messages must not interleave on stdout.
+stdout_lock = threading.Lock()
+# Lines and json until the client asks for something else in do_handshake.
+channel_framing = framing.LINES
+channel_codec = codec.codec("json")
+
+# Output of a child is read in pieces of up to OUTPUT_READ_SIZE and sent in
+# notifications of up to OUTPUT_FLUSH_SIZE. What was read is held at most
+# OUTPUT_FLUSH_DELAY seconds, or until the child has been quiet for
+# OUTPUT_IDLE seconds, so echo of typing still comes back right away.
+OUTPUT_READ_SIZE = 2**16
+OUTPUT_FLUSH_SIZE = 2**16
+OUTPUT_FLUSH_DELAY = 0.05
+OUTPUT_IDLE = 0.005
+
+
+class OutputBuffer():
+    """
+    Output of a child waiting to be sent as one stdout notification, instead
+    of a notification per read. Only used with stdout_lock held.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.since = None
+
+    def add(self, data):
+        if self.since is None:
+            self.since = time.time()
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def due(self):
+        return self.size >= OUTPUT_FLUSH_SIZE or (self.since is not None and time.time() - self.since >= OUTPUT_FLUSH_DELAY)
+
+    def wait(self):
+        """
+        How long poll may wait before the output has to be sent, in ms.
+        """
+        if self.since is None:
+            return None
+        left = OUTPUT_FLUSH_DELAY - (time.time() - self.since)
+        return max(0, int(min(OUTPUT_IDLE, left) * 1000))
+
+    def take(self, everything=False):
+        """
+        The pending output as a serialized notification, "" when there is
+        none. A utf-8 sequence cut short by a read waits for its rest,
+        unless everything is asked for.
+        """
+        data = "".join(self.chunks)
+        cut = len(data) if everything else utf8_cut(data)
+        self.chunks = [data[cut:]] if cut < len(data) else []
+        self.size = len(data) - cut
+        self.since = time.time() if self.size > 0 else None
+        if cut == 0:
+            return ""
+        return serialize({"id": None, "stdout": data[:cut].decode("utf-8", "replace")})
+
+
+def utf8_cut(data):
+    """
+    Length of data without a utf-8 sequence that is cut short at its end.
+    """
+    for back in range(1, min(4, len(data)) + 1):
+        byte = ord(data[-back])
+        if byte < 0x80:
+            return len(data)
+        if byte >= 0xC0:
+            # Lead byte of a sequence of this many bytes.
+            length = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return len(data) - back if length > back else len(data)
+    return len(data)
+
+
+pending_output = OutputBuffer()
+
+
 def log(message):
-    message = json.dumps({"id": None, "stdout": str(message)+ "\n" })
-    sys.stdout.write("{message}\n".format(message=message))
-    sys.stdout.flush()
+    send_msg({"id": None, "stdout": str(message)+ "\n" })
 
 
 def fail(message):
-    message = json.dumps({"id": None, "stderr": str(message)})
-    sys.stdout.write("{message}\n".format(message=message))
-    sys.stdout.flush()
+    send_msg({"id": None, "stderr": str(message)})
     os._exit(1)
 
 # JSONRPC Defined error_codes
@@ -50,6 +167,7 @@ JSONRPC_INTERNAL_ERROR = -32604
 
 DO_REVERT_NOT_CLEAN = -31050
 DO_REVERT_INVALID_ID = -31051
+DO_REVERT_NO_MATCH = -31052
 
 DO_SYNC_NO_RECIPE_INSTALLED = -31100
 DO_SYNC_SERVER_FAILED = -31101
@@ -61,20 +179,56 @@ DO_DEPLOY_NO_NEWRECIPE = -31200
 DO_ASSERT_IS_ASSEMBLY_ERROR = -31400
 
 DO_BACKUP_NEW_IS_CLEAN = -31500
+DO_BACKUP_RM_HAS_DEPENDENTS = -31501
+DO_BACKUP_NEW_INVALID_FORMAT = -31502
+DO_BACKUP_TRANSFER_ERROR = -31503
+DO_BACKUP_NO_INDEX = -31504
 
 RC_RECIPE_RUNTIME_ERROR = -31300
+RC_RECIPE_INVALID_COMMAND = -31301
+
+DO_FILE_STREAM_ERROR = -31600
+DO_MKTREE_ERROR = -31601
+
+DO_JOB_INVALID_ID = -31700
+DO_JOB_BUSY = -31701
+DO_JOB_CANCELLED = -31702
 
 CODE_DIR = "/app/code"
 STATE_DIR = "/app/state"
 JSC_DIR = os.path.join(CODE_DIR, ".jsc")
 BACKUPS_DIR = os.path.join(JSC_DIR, "backups")
 BACKUPS_SEQ_FILE_PATH = os.path.join(BACKUPS_DIR, "seq")
+BACKUPS_CHUNKS_DIR = os.path.join(BACKUPS_DIR, "chunks")
+BACKUPS_INCOMING_DIR = os.path.join(BACKUPS_DIR, "incoming")
+BACKUPS_CATALOG_PATH = os.path.join(BACKUPS_DIR, "catalog.json")
+BACKUPS_RETENTION_PATH = os.path.join(BACKUPS_DIR, "retention.json")
+BACKUPS_TRASH_DIR = os.path.join(BACKUPS_DIR, "deleted-backups")
 NEW_BACKUP_DIR = os.path.join(BACKUPS_DIR, "new-backup")
 LOCK_FILE = os.path.join(JSC_DIR, "lock")
 RECIPE_PATH = os.path.join(JSC_DIR, "recipe")
 NEW_RECIPE_PATH = os.path.join(JSC_DIR, "new-recipe")
 NEW_RECIPE_SRC = os.path.join(NEW_RECIPE_PATH, "src")
 NEW_RECIPE_SCRIPT = os.path.join(NEW_RECIPE_SRC, "Jumpstart-Recipe")
+UPLOAD_BASIS_DIR = os.path.join(JSC_DIR, "upload-basis")
+# What clean --background removed is moved to the trash dir of its volume
+# and deleted from there by a job.
+CODE_TRASH_DIR = os.path.join(JSC_DIR, "trash")
+STATE_TRASH_DIR = os.path.join(STATE_DIR, ".jsc-trash")
+# Backups after the first are incremental on the latest one, a chain gets at
+# most this many backups so revert doesn't have to replay too many.
+BACKUP_CHAIN_MAX = 8
+# Backup archive name, the tar flags to extract it, the default level and the
+# command that decompresses it to stdout by compression format.
+BACKUP_FORMATS = {"zstd": ("data.tar.zst", ["--use-compress-program=zstd -d"], 3, ["zstd", "-q", "-d", "-c"]),
+                  "gzip": ("data.tar.gz", ["-z"], 6, ["gzip", "-d", "-c"]),
+                  "lzo": ("data.tar.lzo", ["--use-compress-program=lzop -d"], 3, ["lzop", "-d", "-c"])}
+BACKUP_BLOCK_SIZE = 2**20
+UPLOAD_CACHE_DIR = os.path.join(JSC_DIR, "upload-cache")
+UPLOAD_CACHE_OBJECTS_DIR = os.path.join(UPLOAD_CACHE_DIR, "objects")
+UPLOAD_CACHE_SIZE_MAX = 2**30
+# Seconds between the progress notifications of a job.
+PROGRESS_INTERVAL = 2
 
 
 ################################################################################
@@ -86,16 +240,209 @@ class AssemblyStateError(Exception):
     pass
 
 
+class JobCancelled(Exception):
+    pass
+
+
+class Job():
+    """
+    Progress of a backup or revert, sent as {"id": null, "progress": {...}}
+    notifications. Jobs started in the background run in a thread of their
+    own and are kept in JOBS, foreground ones have no id.
+    """
+    def __init__(self, job_id=None, description=None):
+        self.id = job_id
+        self.description = description
+        self.state = "running"
+        self.error = None
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.start_stage(None)
+
+    def start_stage(self, stage, total=None, unit=None):
+        """
+        Starts counting a new stage, in bytes unless unit names what else
+        is counted.
+        """
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self.out = None
+        self.input_wait = 0.0
+        self.stage_started = time.time()
+        self.last_notified = 0
+        if stage is not None:
+            self.notify()
+
+    def advance(self, size, out=None, input_wait=0.0):
+        """
+        Counts size more bytes done, out bytes written so far and seconds
+        spent waiting for input. Raises JobCancelled once the job is
+        cancelled, so the work stops where it reports progress.
+        """
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        self.done += size
+        if out is not None:
+            self.out = out
+        self.input_wait += input_wait
+        if time.time() - self.last_notified >= PROGRESS_INTERVAL:
+            self.notify()
+
+    def finish(self, error):
+        self.error = error
+        if error is None:
+            self.state = "done"
+        elif self.cancelled.is_set():
+            self.state = "cancelled"
+        else:
+            self.state = "failed"
+        self.finished.set()
+        self.notify()
+
+    def info(self):
+        elapsed = max(time.time() - self.stage_started, 0.001)
+        rate = self.done / elapsed
+        eta = None
+        if self.state == "running" and self.total is not None and rate > 0:
+            eta = max(0, self.total - self.done) / rate
+        return {"job": self.id,
+                "description": self.description,
+                "state": self.state,
+                "stage": self.stage,
+                "bytes": self.done,
+                "total": self.total,
+                "unit": self.unit,
+                "rate": rate,
+                "eta": eta,
+                "ratio": float(self.out) / self.done if self.out is not None and self.done > 0 else None,
+                # Near 1 when reading is what holds the stage up, near 0
+                # when it is the compression.
+                "input_wait": min(1.0, self.input_wait / elapsed),
+                "error": self.error["message"] if self.error is not None else None}
+
+    def summary(self, info):
+        def amount(num):
+            if info["unit"] is None:
+                return sizeof_fmt(num)
+            return "{num:.0f} {unit}".format(num=num, unit=info["unit"])
+
+        parts = ["{stage} {done}".format(stage=info["stage"] or "starting", done=amount(info["bytes"]))]
+        if info["total"] is not None:
+            if info["unit"] is not None:
+                # "3 of 10 files" rather than "3 files of 10 files".
+                parts[0] = "{stage} {done:.0f}".format(stage=info["stage"], done=info["bytes"])
+            parts[0] += " of {total}".format(total=amount(info["total"]))
+        parts.append("{rate}/s".format(rate=amount(info["rate"])))
+        if info["eta"] is not None:
+            parts.append("{eta} left".format(eta=datetime.timedelta(seconds=int(info["eta"]))))
+        if info["ratio"] is not None:
+            parts.append("compressed to {ratio:.0%}".format(ratio=info["ratio"]))
+        if info["stage"] == "compressing" and info["bytes"] > 0:
+            parts.append("bound by reading files" if info["input_wait"] > 0.5 else "bound by compression")
+        if info["state"] != "running":
+            parts = [info["state"]] + ([info["error"]] if info["error"] is not None else [])
+        prefix = "job {job_id} ({description}): ".format(job_id=self.id, description=self.description) if self.id is not None else ""
+        return prefix + ", ".join(parts)
+
+    def notify(self):
+        self.last_notified = time.time()
+        info = self.info()
+        info["message"] = self.summary(info)
+        send_msg({"id": None, "progress": info})
+
+
+JOBS = {}
+jobs_lock = threading.Lock()
+job_ids = itertools.count(1)
+# Held by whatever changes the backups or the code dir, see exclusive. A
+# background job takes it in job_start and releases it in its own thread,
+# which an RLock doesn't allow, exclusive_owner makes it reentrant instead.
+exclusive_lock = threading.Lock()
+exclusive_owner = threading.local()
+
+
+def exclusive(func):
+    """
+    For functions that change the backups or the code dir. Only one of them
+    runs at a time, others fail right away instead of waiting behind a
+    background job. Recipe commands sent one at a time are not guarded,
+    a whole recipe through do_deploy_execute is.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(exclusive_owner, "held", False):
+            return func(*args, **kwargs)
+        if not exclusive_lock.acquire(False):
+            return None, {"code": DO_JOB_BUSY, "message": "a background job is busy with the backups, see jobs"}
+        exclusive_owner.held = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            exclusive_owner.held = False
+            exclusive_lock.release()
+    return wrapper
+
+
+def shared(func):
+    """
+    For methods that only read, nothing in the code dir or the backups
+    changes. The main loop hands them to the worker pool as they come in, so
+    they run alongside each other and a slow exclusive method. Methods that
+    are not shared are exclusive, they run one at a time in the order they
+    came in.
+    """
+    func.shared = True
+    return func
+
+
+def job_start(description, func, *args):
+    """
+    Runs func(*args, job=job) in the background and returns the job id,
+    its outcome is the last progress notification of the job. The job holds
+    the exclusive lock from here on, so what is queued after it finds it
+    busy instead of getting in first.
+    """
+    if not exclusive_lock.acquire(False):
+        return None, {"code": DO_JOB_BUSY, "message": "a background job is busy with the backups, see jobs"}
+    job = Job(str(next(job_ids)), description)
+    with jobs_lock:
+        JOBS[job.id] = job
+
+    def run():
+        exclusive_owner.held = True
+        try:
+            _, error = func(*args, job=job)
+        except BaseException as e:
+            error = {"code": JSONRPC_INTERNAL_ERROR, "message": str(e)}
+        finally:
+            exclusive_owner.held = False
+            exclusive_lock.release()
+        job.finish(error)
+
+    worker = threading.Thread(target=run)
+    worker.daemon = True
+    worker.start()
+    return {"job": job.id}, None
+
+
 def subproc(args, wd=None):
     pid, child_fd = pty.fork()
     if pid == 0:
-        # Child process
-        if wd is not None:
-            os.chdir(wd)
-        binfile = args[0]
-        if not os.path.isfile(binfile):
-            binfile = find_executable(binfile)
-        os.execv(binfile, args)
+        # Child process, it must not get back to the main loop of the server
+        # even when the command can't be started.
+        try:
+            if wd is not None:
+                os.chdir(wd)
+            binfile = args[0]
+            if not os.path.isfile(binfile):
+                binfile = find_executable(binfile)
+            os.execv(binfile, args)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(127)
     # set up a nonblocking
     nb_child = os.dup(child_fd)
     old = termios.tcgetattr(nb_child)
@@ -104,46 +451,53 @@ def subproc(args, wd=None):
     termios.tcsetattr(nb_child, termios.TCSADRAIN, new)
     fcntl.fcntl(nb_child, fcntl.F_SETFL, os.O_NONBLOCK)
     stdin_fd = sys.stdin.fileno()
-    stdin_buffer = ""
+    stdin_buffer = framing.InBuffer()
+    stdin_frames = framing.FrameReader()
     pollfd = select.poll()
     poll_err_mask = select.POLLPRI | select.POLLERR | select.POLLHUP
     pollfd.register(stdin_fd, select.POLLIN | poll_err_mask)
     pollfd.register(nb_child, select.POLLIN | poll_err_mask)
     while True:
-        pl = dict(pollfd.poll())
+        pl = dict(pollfd.poll(pending_output.wait()))
+        if len(pl) == 0:
+            # Quiet for a moment, or output waited long enough.
+            flush_output()
+            continue
         if stdin_fd in pl:
             mask = pl[stdin_fd]
             if mask & poll_err_mask != 0:
                 terminate()
             # Check for notifications, crash on new commands.
-            new_data = sys.stdin.read()
-            stdin_buffer += new_data
-            if "\n" in stdin_buffer:
-                lines = stdin_buffer.split("\n")
-                # Last line is not complete.
-                stdin_buffer = "\n".join(lines[-1:])
-                messages = lines[0:-1]
-                for msg in messages:
-                    msg_obj = json.loads(msg)
-                    if "id" in msg_obj.keys() and msg_obj["id"] is None:
-                        # Might not write all of it.
-                        data = msg_obj[u"stdin"]
-                        os.write(child_fd, data)
-                    else:
-                        raise Exception("Should have been a notification")
+            stdin_buffer.feed(sys.stdin.read())
+            while True:
+                if channel_framing == framing.FRAMES:
+                    frame = stdin_frames.read(stdin_buffer)
+                    msg = frame[1] if frame is not None else None
+                else:
+                    msg = stdin_buffer.readline()
+                if msg is None:
+                    # Not complete yet.
+                    break
+                msg_obj = channel_codec.loads(msg)
+                if "id" in msg_obj.keys() and msg_obj["id"] is None:
+                    # Might not write all of it.
+                    data = msg_obj[u"stdin"]
+                    os.write(child_fd, data)
+                else:
+                    raise Exception("Should have been a notification")
         if nb_child in pl:
             # Forward as notification
             try:
                 mask = pl[nb_child]
-                if mask & poll_err_mask != 0:
-                    # Stdout closed, probably don't want to read anything now.
+                if mask & select.POLLIN == 0 and mask & poll_err_mask != 0:
+                    # Stdout closed and nothing left to read.
                     break
-                data = os.read(nb_child, 1024)
-                sys.stdout.write(json.dumps({"id": None, "stdout": data}) + "\n")
-                sys.stdout.flush()
+                data = os.read(nb_child, OUTPUT_READ_SIZE)
+                send_output(data)
             except OSError:
                 # The fd is probably not valid anymore because the subprocess exited.
                 break
+    flush_output(everything=True)
     os.waitpid(pid, 0)
 
 
@@ -232,69 +586,644 @@ def is_code_dir_clean():
     return True
 
 
-def backup_new():
+def backup_compress_cmd(fmt, level, threads):
+    if fmt == "zstd":
+        return ["zstd", "-q", "-c", "-{level}".format(level=max(1, min(level, 19))), "-T{threads}".format(threads=threads)]
+    # lzop has no threads.
+    return ["lzop", "-c", "-{level}".format(level=max(1, min(level, 9)))]
+
+
+def backup_compress(tar_cmd, path, fmt, level, threads, indexer, job):
+    """
+    Writes the output of tar_cmd to path, compressed on up to threads cores
+    or all of them for 0, and feeds it to indexer. Returns the uncompressed
+    size and, when the format allows it, the uncompressed and compressed
+    size of each block. Those blocks are compressed on their own by a thread
+    pool so single files can be read without decompressing what is before
+    them.
+    """
+    tar = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)
+    raw_size = [0]
+    block_sizes = None
+    proc = None
+
+    def blocks():
+        while True:
+            read_started = time.time()
+            block = tar.stdout.read(BACKUP_BLOCK_SIZE)
+            if len(block) == 0:
+                return
+            raw_size[0] += len(block)
+            indexer.feed(block)
+            job.advance(len(block), os.fstat(out.fileno()).st_size, time.time() - read_started)
+            yield block
+
+    try:
+        with open(path, "wb") as out:
+            if fmt in archive.block_formats():
+                block_sizes = []
+                for size, compressed in archive.parallel_map(lambda block: (len(block), archive.compress_block(fmt, block, level)), blocks(), threads):
+                    out.write(compressed)
+                    block_sizes.append([size, len(compressed)])
+            else:
+                cmd = backup_compress_cmd(fmt, level, threads)
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out)
+                for block in blocks():
+                    proc.stdin.write(block)
+                proc.stdin.close()
+                if proc.wait() != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, cmd[0])
+        if tar.wait() != 0:
+            raise subprocess.CalledProcessError(tar.returncode, "tar")
+    finally:
+        for running in (tar, proc):
+            if running is not None and running.poll() is None:
+                running.kill()
+                running.wait()
+    return raw_size[0], block_sizes
+
+
+def backup_archive(backup_dir):
+    """
+    The archive of a tar backup and its format.
+    """
+    for fmt, (name, _, _, _) in BACKUP_FORMATS.items():
+        path = os.path.join(backup_dir, name)
+        if os.path.isfile(path):
+            return path, fmt
+    return None, None
+
+
+def tree_size(paths):
+    size = 0
+    for path in paths:
+        if not os.path.isdir(path):
+            size += os.lstat(path).st_size
+            continue
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+    return size
+
+
+@exclusive
+def backup_new(full=False, dedup=False, fmt=None, level=None, threads=0, job=None):
+    if fmt is not None and fmt not in BACKUP_FORMATS:
+        return None, {"code": DO_BACKUP_NEW_INVALID_FORMAT, "message": "unknown compression {fmt}, use one of {formats}".format(fmt=fmt, formats=", ".join(sorted(BACKUP_FORMATS)))}
+    if dedup and fmt not in (None, "gzip"):
+        return None, {"code": DO_BACKUP_NEW_INVALID_FORMAT, "message": "chunks of a dedup backup are always gzip, {fmt} can't be used".format(fmt=fmt)}
     if is_code_dir_clean():
         return None, {"code": DO_BACKUP_NEW_IS_CLEAN, "message": "Your code dir [{code_dir}] is clean, there's nothing to backup.".format(code_dir=CODE_DIR)}
+    # Left by a backup that was killed.
+    shutil.rmtree(NEW_BACKUP_DIR, ignore_errors=True)
+    try:
+        backup_write(full, dedup, fmt, level, threads, job if job is not None else Job())
+    except BaseException as e:
+        shutil.rmtree(NEW_BACKUP_DIR, ignore_errors=True)
+        if dedup:
+            # The chunks stored so far have no references yet.
+            chunkstore.ChunkStore(BACKUPS_CHUNKS_DIR).gc()
+        if isinstance(e, JobCancelled):
+            return None, {"code": DO_JOB_CANCELLED, "message": "backup cancelled"}
+        raise
+    # Pruned right away so the code dir doesn't fill up with backups.
+    pruned = retention_prunable(retention_load())
+    if len(pruned) > 0:
+        backups_remove(pruned)
+        log("Removed backups {ids} by the retention policy".format(ids=", ".join(pruned)))
+    return None, None
+
+
+def backup_write(full, dedup, fmt, level, threads, job):
     log("Backup starting")
     recipe_dir = os.path.join(JSC_DIR, "recipe")
-    new_backup_dir = os.path.join(BACKUPS_DIR, "new-backup")
+    new_backup_dir = NEW_BACKUP_DIR
     size_file = os.path.join(new_backup_dir, "size")
+    snapshot_file = os.path.join(new_backup_dir, "snapshot")
     touch_dir(new_backup_dir)
+    seq_num = backup_next_seq()
+    parent_id = None if full or dedup else backup_latest_parent()
+    if parent_id is not None:
+        log("Changes since backup {parent_id}".format(parent_id=parent_id))
+        shutil.copyfile(os.path.join(backup_dir_by_id(parent_id), "snapshot"), snapshot_file)
+        with open(os.path.join(new_backup_dir, "parent"), "w") as f:
+            f.write(parent_id)
+    # tar only notices deletions inside the dirs it is given, revert needs
+    # to know what was at the top level.
+    top_level = [node for node in os.listdir(CODE_DIR) if not node.startswith(".") and node != "lost+found"]
+    with open(os.path.join(new_backup_dir, "top-level"), "w") as f:
+        json.dump(top_level, f)
+    if dedup:
+        # The chunk store only knows gzip.
+        fmt = "gzip"
+    elif fmt is None:
+        fmt = "zstd" if find_executable("zstd") is not None else "lzo"
+    if level is None:
+        level = BACKUP_FORMATS[fmt][2]
+    new_backup_file = os.path.join(new_backup_dir, BACKUP_FORMATS[fmt][0])
+    pacman_dir = os.path.join(CODE_DIR, ".pacman")
+    jsc_recipe_dir = os.path.join(JSC_DIR, "recipe")
+    paths = [os.path.join(CODE_DIR, node) for node in top_level]
+    for path in (pacman_dir, jsc_recipe_dir):
+        if os.path.isdir(path):
+            paths.append(path)
+    tar_args = ["tar",
+                "--exclude={code_dir}/.pacman/cache".format(code_dir=CODE_DIR),
+                "--exclude={code_dir}/.pacman/db/sync".format(code_dir=CODE_DIR),
+                "--exclude=lost+found"]
+    indexer = tarindex.TarIndexer()
+    # Only changed files go into an incremental backup, there's no telling
+    # how much that is beforehand.
+    job.start_stage("compressing", tree_size(paths) if parent_id is None else None)
+    if dedup:
+        log("Storing chunks as gzip level {level}".format(level=level))
+        store = chunkstore.ChunkStore(BACKUPS_CHUNKS_DIR, level)
+        proc = subprocess.Popen(tar_args + ["-cf", "-"] + paths, stdout=subprocess.PIPE)
+        manifest = []
+        try:
+            for entry in archive.parallel_map(store.put, chunkstore.tar_chunks(tarindex.TeeReader(proc.stdout, indexer)), threads):
+                manifest.append(entry)
+                job.advance(entry[1])
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, "tar")
+        with open(os.path.join(new_backup_dir, "chunks"), "w") as f:
+            json.dump(manifest, f)
+        with open(size_file, "w+") as f:
+            f.write(str(sum(size for _, size in manifest)))
+        # Counted before the backup shows up, a crash leaks chunks instead
+        # of leaving a backup whose chunks can be collected.
+        store.add_refs(manifest)
+    else:
+        raw_size, block_sizes = backup_compress(tar_args + ["--listed-incremental={snapshot_file}".format(snapshot_file=snapshot_file), "--no-check-device",
+                                                            "-cf", "-"] + paths, new_backup_file, fmt, level, threads, indexer, job)
+        with open(size_file, "w+") as f:
+            f.write(str(raw_size))
+        if block_sizes is not None:
+            with open(os.path.join(new_backup_dir, "blocks"), "w") as f:
+                json.dump(block_sizes, f)
+    backup_write_index(new_backup_dir, indexer)
+    log("Saving recipe")
+    if os.path.isdir(recipe_dir):
+        subprocess.check_call("cp -r {recipe_dir} {new_backup_dir}".format(recipe_dir=recipe_dir, new_backup_dir=new_backup_dir), shell=True)
+    log("Finnishing up")
+    backup_commit(new_backup_dir, seq_num)
+
+
+def backup_next_seq():
     with open(BACKUPS_SEQ_FILE_PATH) as f:
         seq_num = int(f.read())
     with open(BACKUPS_SEQ_FILE_PATH, "w") as f:
         f.truncate(0)
         f.write(str(seq_num + 1))
         f.flush()
-    log("Compressing")
-    new_backup_file = os.path.join(new_backup_dir, "data.tar.lzo")
-    pacman_dir = os.path.join(CODE_DIR, ".pacman")
-    jsc_recipe_dir = os.path.join(JSC_DIR, "recipe")
-    if not os.path.isdir(pacman_dir):
-        pacman_dir = ""
-    subprocess.check_call("tar --use-compress-program=lzop --exclude='{code_dir}/.pacman/cache' --exclude='{code_dir}/.pacman/db/sync' --exclude='lost+found' -cf {new_backup_file} {code_dir}/* {pacman_dir} {jsc_recipe_dir}".format(new_backup_file=new_backup_file, code_dir=CODE_DIR, pacman_dir=pacman_dir, jsc_recipe_dir=jsc_recipe_dir), shell=True)
-    lzop_info = subprocess.check_output("lzop --info {new_backup_file}".format(new_backup_file=new_backup_file).split(" ")).decode("utf-8")
-    for entry in lzop_info.split(" "):
-        # the first digit we find is the uncompressed size
-        if entry.isdigit():
-            with open(size_file, "w+") as f:
-                f.truncate(0)
-                f.write(entry)
-                f.flush()
-            break
-    log("Saving recipe")
-    if os.path.isdir(recipe_dir):
-        subprocess.check_call("cp -r {recipe_dir} {new_backup_dir}".format(recipe_dir=recipe_dir, new_backup_dir=new_backup_dir), shell=True)
+    return seq_num
+
+
+def backup_commit(new_backup_dir, seq_num):
+    """
+    Moves a finished backup into place, it is listed from then on.
+    """
     sync_dir(CODE_DIR)
     created_time = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SUTC")
     backup_target_dir = os.path.join(BACKUPS_DIR, "{seq_num}@{created_time}".format(seq_num=seq_num, created_time=created_time))
-    log("Finnishing up")
     subprocess.check_call("mv {new_backup_dir} {backup_target_dir}".format(new_backup_dir=new_backup_dir, backup_target_dir=backup_target_dir), shell=True)
+    catalog_add(backup_target_dir)
+    return backup_target_dir
+
+
+def backup_archive_sha1(archive_path):
+    """
+    Checksum of a backup archive, computed once and kept next to it.
+    """
+    sha1_file = archive_path + ".sha1"
+    if os.path.isfile(sha1_file):
+        with open(sha1_file) as f:
+            return f.read().strip()
+    sha1 = delta.file_sha1(archive_path, BACKUP_BLOCK_SIZE)
+    with open(sha1_file, "w") as f:
+        f.write(sha1)
+    return sha1
+
+
+def backup_raw_size(archive_path, fmt, indexer):
+    """
+    Decompresses an archive to count its uncompressed size, which also
+    finds archives that are broken, and feeds it to indexer.
+    """
+    with open(archive_path, "rb") as f:
+        try:
+            proc = subprocess.Popen(BACKUP_FORMATS[fmt][3], stdin=f, stdout=subprocess.PIPE)
+        except OSError as e:
+            raise IOError("{fmt} archives can't be read here, {tool}: {e}".format(
+                fmt=fmt, tool=BACKUP_FORMATS[fmt][3][0], e=e.strerror))
+        raw_size = 0
+        while True:
+            block = proc.stdout.read(BACKUP_BLOCK_SIZE)
+            if len(block) == 0:
+                break
+            raw_size += len(block)
+            indexer.feed(block)
+    if proc.wait() != 0:
+        raise IOError("{archive_path} is not a valid {fmt} archive".format(archive_path=archive_path, fmt=fmt))
+    return raw_size
+
+
+def backup_incoming_path(name):
+    """
+    Where a pushed archive is received, name has to end like a backup
+    archive so its format is known.
+    """
+    name = os.path.basename(name)
+    for fmt, (archive_name, _, _, _) in BACKUP_FORMATS.items():
+        if name.endswith(archive_name[len("data"):]):
+            return os.path.join(BACKUPS_INCOMING_DIR, name), fmt
+    return None, None
+
+
+re_backup_name = re.compile(r"(\d+)@(\d{4}-\d{2}-\d{2})T(\d{2}:\d{2}:\d{2})([\w\-\+]+)")
+
+
+def backup_entry(backup_dir):
+    """
+    Catalog entry of a backup, read from its dir.
+    """
+    match = re.match(re_backup_name, os.path.basename(backup_dir))
+    jumpstart_recipe_path = os.path.join(backup_dir, "recipe", "src", "Jumpstart-Recipe")
+    m_recipe_name = "<broken/unknown>"
+    if os.path.isfile(jumpstart_recipe_path):
+        with open(jumpstart_recipe_path) as f:
+            for line in f.readlines():
+                if line.startswith("name"):
+                    m_recipe_name = line.split(" ")[1].strip()
+                    break
+    deduplicated = os.path.isfile(os.path.join(backup_dir, "chunks"))
+    archive_path, _ = backup_archive(backup_dir)
+    raw_size = 0
+    if os.path.isfile(os.path.join(backup_dir, "size")):
+        with open(os.path.join(backup_dir, "size")) as f:
+            raw_size = int(f.read())
+    return {"id": match.group(1),
+            "dir": os.path.basename(backup_dir),
+            "date": match.group(2),
+            "time": match.group(3),
+            "tz": match.group(4),
+            "recipe_name": m_recipe_name,
+            "parent": backup_parent(backup_dir),
+            "deduplicated": deduplicated,
+            # Deduplicated backups share their chunks, what they use alone
+            # changes with the other backups.
+            "size": os.path.getsize(archive_path) if archive_path is not None else None,
+            "raw_size": raw_size}
+
+
+# Held from reading the catalog to writing it back, shared methods may
+# rebuild it while a backup is added or removed.
+catalog_lock = threading.RLock()
+
+
+def catalog_write(catalog):
+    fd, tmp_path = tempfile.mkstemp(dir=BACKUPS_DIR, prefix="catalog.", suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(catalog, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, BACKUPS_CATALOG_PATH)
+
+
+def catalog_rebuild():
+    with catalog_lock:
+        catalog = {}
+        for node in os.listdir(BACKUPS_DIR):
+            if re.match(re_backup_name, node) is not None:
+                entry = backup_entry(os.path.join(BACKUPS_DIR, node))
+                catalog[entry["id"]] = entry
+        catalog_write(catalog)
+    return catalog
+
+
+def catalog_load():
+    """
+    All backups by id, from the catalog so listing them doesn't have to
+    look into every backup dir.
+    """
+    try:
+        with open(BACKUPS_CATALOG_PATH) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return catalog_rebuild()
 
 
-re_backup_name = re.compile(r"(\d)+@(\d{4}-\d{2}-\d{2})T(\d{2}:\d{2}:\d{2})([\w\-\+]+)")
+def catalog_check():
+    """
+    Rebuilds the catalog if the backup dirs don't match it, after a crash
+    between moving a backup dir and updating the catalog.
+    """
+    with catalog_lock:
+        nodes = set(node for node in os.listdir(BACKUPS_DIR) if re.match(re_backup_name, node) is not None)
+        if nodes != set(entry["dir"] for entry in catalog_load().values()):
+            catalog_rebuild()
+
+
+def catalog_add(backup_dir):
+    with catalog_lock:
+        catalog = catalog_load()
+        entry = backup_entry(backup_dir)
+        catalog[entry["id"]] = entry
+        catalog_write(catalog)
+
+
+def catalog_remove(backup_ids):
+    with catalog_lock:
+        catalog = catalog_load()
+        for backup_id in backup_ids:
+            catalog.pop(backup_id, None)
+        catalog_write(catalog)
+
+
+def backup_dirs():
+    """
+    The dirs of all backups by id.
+    """
+    return dict((m_id, os.path.join(BACKUPS_DIR, entry["dir"])) for m_id, entry in catalog_load().items())
+
+
+def backup_dir_by_id(backup_id):
+    return backup_dirs().get(backup_id)
+
+
+def backup_parent(backup_dir):
+    """
+    The id of the backup this one is incremental on, None for full backups.
+    """
+    parent_file = os.path.join(backup_dir, "parent")
+    if not os.path.isfile(parent_file):
+        return None
+    with open(parent_file) as f:
+        return f.read().strip()
+
+
+def backup_chain(backup_id):
+    """
+    The dirs of the backups that have to be extracted in order to get back
+    to backup_id, starting with its full backup.
+    """
+    dirs = backup_dirs()
+    chain = []
+    while backup_id is not None:
+        if backup_id not in dirs:
+            raise AssemblyStateError("backup {backup_id} is missing from its chain".format(backup_id=backup_id))
+        chain.insert(0, dirs[backup_id])
+        backup_id = backup_parent(dirs[backup_id])
+    return chain
+
+
+def backup_dependents(backup_id):
+    """
+    Ids of the backups that need backup_id for a revert.
+    """
+    parents = dict((m_id, entry["parent"]) for m_id, entry in catalog_load().items())
+    dependents = []
+    for m_id in parents:
+        parent_id = parents[m_id]
+        while parent_id is not None and parent_id != backup_id:
+            parent_id = parents.get(parent_id)
+        if parent_id == backup_id:
+            dependents.append(m_id)
+    return sorted(dependents, key=int)
+
+
+def backup_latest_parent():
+    """
+    The latest backup that a new one can be incremental on, if there is one
+    and its chain isn't full yet.
+    """
+    dirs = backup_dirs()
+    for m_id in sorted(dirs, key=int, reverse=True):
+        if os.path.isfile(os.path.join(dirs[m_id], "snapshot")):
+            if len(backup_chain(m_id)) < BACKUP_CHAIN_MAX:
+                return m_id
+            return None
+    return None
+
+
+def backup_manifest(backup_dir):
+    """
+    The chunks of a deduplicated backup, None for tar backups.
+    """
+    manifest_file = os.path.join(backup_dir, "chunks")
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def backup_kind(entry):
+    if entry["deduplicated"]:
+        return "deduplicated"
+    if entry["parent"] is None:
+        return "full"
+    return "incremental on {parent_id}".format(parent_id=entry["parent"])
+
+
+def backup_write_index(backup_dir, indexer):
+    with open(os.path.join(backup_dir, "index.json"), "w") as f:
+        json.dump({"incremental": indexer.incremental, "members": indexer.members}, f)
+
+
+def backup_index(backup_dir):
+    """
+    The members of the tar stream of a backup, None for backups made before
+    they were indexed.
+    """
+    index_file = os.path.join(backup_dir, "index.json")
+    if not os.path.isfile(index_file):
+        return None
+    with open(index_file) as f:
+        return json.load(f)
+
+
+def backup_read_ranges(backup_dir, ranges):
+    """
+    Yields the (start, end) ranges, sorted, of the tar stream of a backup.
+    Chunks and blocks that were compressed on their own are only read where
+    they hold a range, other archives are decompressed up to the last range.
+    """
+    manifest = backup_manifest(backup_dir)
+    if manifest is not None:
+        store = chunkstore.ChunkStore(BACKUPS_CHUNKS_DIR)
+        blocks = []
+        offset = 0
+        for sha1, size in manifest:
+            blocks.append((offset, offset + size, sha1))
+            offset += size
+        for piece in tarindex.read_ranges(blocks, store.get, ranges):
+            yield piece
+        return
+    archive_path, fmt = backup_archive(backup_dir)
+    blocks_file = os.path.join(backup_dir, "blocks")
+    with open(archive_path, "rb") as f:
+        if os.path.isfile(blocks_file):
+            with open(blocks_file) as blocks_f:
+                block_sizes = json.load(blocks_f)
+            blocks = []
+            offset, compressed_offset = 0, 0
+            for size, compressed_size in block_sizes:
+                blocks.append((offset, offset + size, (compressed_offset, compressed_size)))
+                offset += size
+                compressed_offset += compressed_size
+
+            def load(key):
+                f.seek(key[0])
+                return archive.decompress_block(fmt, f.read(key[1]))
+
+            for piece in tarindex.read_ranges(blocks, load, ranges):
+                yield piece
+            return
+        proc = subprocess.Popen(BACKUP_FORMATS[fmt][3], stdin=f, stdout=subprocess.PIPE)
+
+        def stream_blocks():
+            offset = 0
+            while True:
+                block = proc.stdout.read(BACKUP_BLOCK_SIZE)
+                if len(block) == 0:
+                    return
+                yield offset, offset + len(block), block
+                offset += len(block)
+
+        try:
+            for piece in tarindex.read_ranges(stream_blocks(), lambda block: block, ranges):
+                yield piece
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+
+
+def backup_files(backup_id):
+    """
+    The files backup_id gives back, by name in the archive, as (member, dir
+    of the backup that has its data). Files of incremental backups are
+    looked up along the chain. None if a backup of the chain isn't indexed.
+    """
+    chain = backup_chain(backup_id)
+    files = {}
+    for chain_dir in chain:
+        index = backup_index(chain_dir)
+        if index is None:
+            return None
+        for member in index["members"]:
+            files[member["name"]] = (member, chain_dir)
+    if index["incremental"]:
+        # Files deleted since an earlier backup of the chain are gone from
+        # the dir listings of the last one.
+        present = set()
+        top_level_file = os.path.join(chain[-1], "top-level")
+        if os.path.isfile(top_level_file):
+            with open(top_level_file) as f:
+                present.update(os.path.join(CODE_DIR, node).lstrip("/") for node in json.load(f))
+        for member in index["members"]:
+            if member["type"] == "D":
+                present.add(member["name"])
+                present.update(member["name"] + "/" + entry[1:] for entry in member["contents"])
+        files = dict((name, found) for name, found in files.items() if name in present)
+    return files
+
+
+def backup_path_matches(name, pattern):
+    """
+    Whether an archive member or a dir it is in matches a glob, which is
+    relative to the code dir unless it starts with /.
+    """
+    pattern = os.path.join(CODE_DIR, pattern)
+    path = "/" + name
+    while path != "/":
+        if fnmatch.fnmatch(path, pattern):
+            return True
+        path = os.path.dirname(path)
+    return False
+
+
+def backup_show(backup_id, pattern=None):
+    if backup_dir_by_id(backup_id) is None:
+        return None, {"code": DO_REVERT_INVALID_ID, "message": "backup id does not exist"}
+    files = backup_files(backup_id)
+    if files is None:
+        return None, {"code": DO_BACKUP_NO_INDEX, "message": "backup {backup_id} was made before backups had a file index, its files can't be listed".format(backup_id=backup_id)}
+    file_list = []
+    for name in sorted(files):
+        member, _ = files[name]
+        if pattern is not None and not backup_path_matches(name, pattern):
+            continue
+        is_dir = member["type"] in ("5", "D")
+        file_list.append("{mtime} {size:>9} /{name}{slash}".format(mtime=datetime.datetime.utcfromtimestamp(member["mtime"]).strftime("%Y-%m-%d %H:%M"),
+                                                                   size="-" if is_dir else sizeof_fmt(member["size"]), name=name, slash="/" if is_dir else ""))
+    return file_list, None
+
+
+def tar_extract(chunks, job, tar_args=()):
+    """
+    Extracts the tar stream in chunks at /, counting the chunks as done for
+    job.
+    """
+    proc = subprocess.Popen(["tar", "-xf", "-", "-C", "/"] + list(tar_args), stdin=subprocess.PIPE)
+    try:
+        for chunk in chunks:
+            proc.stdin.write(chunk)
+            job.advance(len(chunk))
+        proc.stdin.close()
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, "tar")
+
+
+def file_chunks(path, chunk_size):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+
+def backup_extract(backup_id, pattern, job):
+    """
+    Restores the files of a backup that match pattern over what is there
+    now, leaving everything else alone.
+    """
+    if backup_dir_by_id(backup_id) is None:
+        return None, {"code": DO_REVERT_INVALID_ID, "message": "backup id does not exist"}
+    files = backup_files(backup_id)
+    if files is None:
+        return None, {"code": DO_BACKUP_NO_INDEX, "message": "backup {backup_id} was made before backups had a file index, it can only be reverted whole".format(backup_id=backup_id)}
+    selected = [(member, chain_dir) for name, (member, chain_dir) in files.items()
+                if member["type"] not in ("5", "D") and backup_path_matches(name, pattern)]
+    if len(selected) == 0:
+        return None, {"code": DO_REVERT_NO_MATCH, "message": "no file in backup {backup_id} matches {pattern}".format(backup_id=backup_id, pattern=pattern)}
+    job.start_stage("extracting", sum(member["end"] - member["start"] for member, _ in selected))
+    for chain_dir in backup_chain(backup_id):
+        ranges = sorted((member["start"], member["end"]) for member, member_dir in selected if member_dir == chain_dir)
+        if len(ranges) == 0:
+            continue
+        # The members cut out of the archive make a tar of their own.
+        tar_extract(itertools.chain(backup_read_ranges(chain_dir, ranges), [tarindex.END_OF_ARCHIVE]), job)
+    log("Restored {count} files from backup {backup_id}".format(count=len(selected), backup_id=backup_id))
+    return None, None
 
 
 def backup_ls():
     backup_list = []
-    for node in os.listdir(BACKUPS_DIR):
-        match = re.match(re_backup_name, node)
-        if match is not None:
-            m_id = match.group(1)
-            m_date = match.group(2)
-            m_time = match.group(3)
-            m_tz = match.group(4)
-            backup_dir = os.path.join(BACKUPS_DIR, node)
-            jumpstart_recipe_path = os.path.join(backup_dir, "recipe", "src", "Jumpstart-Recipe")
-            if os.path.isfile(jumpstart_recipe_path):
-                with open(jumpstart_recipe_path) as f:
-                    for line in f.readlines():
-                        if line.startswith("name"):
-                            m_recipe_name = line.split(" ")[1].strip()
-                            break
-            else:
-                m_recipe_name = "<broken/unknown>"
-            backup_list.append("{id}: {date} {time} {tz}, {recipe_name}".format(id=m_id, date=m_date, time=m_time, tz=m_tz, recipe_name=m_recipe_name))
+    for entry in sorted(catalog_load().values(), key=lambda entry: int(entry["id"])):
+        backup_list.append("{id}: {date} {time} {tz}, {recipe_name}, {kind}".format(kind=backup_kind(entry), **entry))
     return backup_list
 
 
@@ -311,72 +1240,389 @@ def backup_du():
     stat_code_dir = os.statvfs(CODE_DIR)
     code_dir_total_b = stat_code_dir.f_frsize * stat_code_dir.f_blocks
     backup_list = []
-    for node in os.listdir(BACKUPS_DIR):
-        match = re.match(re_backup_name, node)
-        if match is not None:
-            m_id = match.group(1)
-            m_date = match.group(2)
-            m_time = match.group(3)
-            m_tz = match.group(4)
-            backup_dir = os.path.join(BACKUPS_DIR, node)
-            jumpstart_recipe_path = os.path.join(backup_dir, "recipe", "src", "Jumpstart-Recipe")
-            if os.path.isfile(jumpstart_recipe_path):
-                with open(jumpstart_recipe_path) as f:
-                    for line in f.readlines():
-                        if line.startswith("name"):
-                            m_recipe_name = line.split(" ")[1].strip()
-                            break
-            else:
-                m_recipe_name = "<broken/unknown>"
-            backup_file = os.path.join(backup_dir, "data.tar.lzo")
-            backup_file_stat = os.stat(backup_file)
-            percent_of_total = "{:.1%}".format(backup_file_stat.st_size / code_dir_total_b)
-            backup_file_size = sizeof_fmt(backup_file_stat.st_size)
-            with open(os.path.join(backup_dir, "size")) as f:
-                backup_file_raw_size = sizeof_fmt(int(f.read()))
-            backup_list.append("{id}: {date} {time} {tz}, {recipe_name}, {backup_file_size} ({percent_of_total} of disk) ({backup_file_raw_size} raw)"
-                               .format(id=m_id, date=m_date, time=m_time, tz=m_tz, recipe_name=m_recipe_name, backup_file_size=backup_file_size, percent_of_total=percent_of_total, backup_file_raw_size=backup_file_raw_size))
+    store = None
+    if os.path.isdir(BACKUPS_CHUNKS_DIR):
+        store = chunkstore.ChunkStore(BACKUPS_CHUNKS_DIR)
+    for entry in sorted(catalog_load().values(), key=lambda entry: int(entry["id"])):
+        if entry["deduplicated"]:
+            # Chunks shared with other backups don't count, they stay when
+            # this one is removed.
+            stored_size = store.unique_size(backup_manifest(os.path.join(BACKUPS_DIR, entry["dir"])))
+            size_note = "unique"
+        else:
+            stored_size = entry["size"]
+            size_note = "archive"
+        percent_of_total = "{:.1%}".format(float(stored_size) / code_dir_total_b)
+        backup_list.append("{id}: {date} {time} {tz}, {recipe_name}, {kind}, {backup_file_size} {size_note} ({percent_of_total} of disk) ({backup_file_raw_size} raw)"
+                           .format(kind=backup_kind(entry), backup_file_size=sizeof_fmt(stored_size), size_note=size_note, percent_of_total=percent_of_total, backup_file_raw_size=sizeof_fmt(entry["raw_size"]), **entry))
+    if store is not None:
+        backup_list.append("chunk store: {chunks} chunks, {store_size} ({percent_of_total} of disk)"
+                           .format(chunks=len(store.index), store_size=sizeof_fmt(store.stored_size()), percent_of_total="{:.1%}".format(float(store.stored_size()) / code_dir_total_b)))
+    cache_objects = upload_cache_objects()
+    cache_size = sum(size for _, size, _ in cache_objects)
+    backup_list.append("upload cache: {cache_files} files, {cache_size} ({percent_of_total} of disk)"
+                       .format(cache_files=len(cache_objects), cache_size=sizeof_fmt(cache_size), percent_of_total="{:.1%}".format(float(cache_size) / code_dir_total_b)))
     return backup_list
 
 
-def backup_rm(backup_id):
-    for node in os.listdir(BACKUPS_DIR):
-        match = re.match(re_backup_name, node)
-        if match is not None:
-            m_id = match.group(1)
-            if m_id == backup_id:
-                backup_dir = os.path.join(BACKUPS_DIR, node)
-                deleted_backup_dir = os.path.join(BACKUPS_DIR, "deleted-backup")
-                subprocess.check_call("mv {backup_dir} {deleted_backup_dir}".format(backup_dir=backup_dir, deleted_backup_dir=deleted_backup_dir), shell=True)
-                sync_dir(CODE_DIR)
-                subprocess.check_call("rm -rf {deleted_backup_dir}".format(deleted_backup_dir=deleted_backup_dir), shell=True)
+@exclusive
+def backup_rm(backup_id, with_dependents=False):
+    """
+    Removes a backup. Later backups that are incremental on it can't be
+    reverted to without it, they are only removed along with it when asked.
+    """
+    dependents = backup_dependents(backup_id)
+    if len(dependents) > 0 and not with_dependents:
+        return None, {"code": DO_BACKUP_RM_HAS_DEPENDENTS,
+                      "message": "backups {dependents} depend on backup {backup_id}, remove them too with --with-dependents".format(dependents=", ".join(dependents), backup_id=backup_id)}
+    backups_remove([backup_id] + dependents)
+    return None, None
+
+
+def backups_remove(backup_ids):
+    """
+    Removes backups in one batch, the dirs are moved away, then the dir, the
+    catalog and the chunk store are written once for all of them.
+    """
+    dirs = backup_dirs()
+    touch_dir(BACKUPS_TRASH_DIR)
+    # Newest first, so an interrupted removal never leaves a broken chain.
+    for backup_id in sorted(backup_ids, key=int, reverse=True):
+        if backup_id in dirs:
+            os.rename(dirs[backup_id], os.path.join(BACKUPS_TRASH_DIR, os.path.basename(dirs[backup_id])))
+    sync_dir(BACKUPS_DIR)
+    catalog_remove(backup_ids)
+    backups_trash_empty()
+
+
+def backups_trash_empty():
+    """
+    Deletes removed backups and the chunks only they used.
+    """
+    manifests = [manifest for manifest in (backup_manifest(os.path.join(BACKUPS_TRASH_DIR, node)) for node in os.listdir(BACKUPS_TRASH_DIR))
+                 if manifest is not None]
+    if len(manifests) > 0:
+        store = chunkstore.ChunkStore(BACKUPS_CHUNKS_DIR)
+        store.release(manifests)
+        store.gc()
+    deltree.delete_trees([BACKUPS_TRASH_DIR])
+
+
+def retention_load():
+    """
+    The retention policy, rules that are off are missing.
+    """
+    try:
+        with open(BACKUPS_RETENTION_PATH) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def retention_set(changes):
+    """
+    Changes rules of the retention policy, 0 turns a rule off.
+    """
+    policy = retention_load()
+    for rule, value in changes.items():
+        if value == 0:
+            policy.pop(rule, None)
+        else:
+            policy[rule] = value
+    tmp_path = BACKUPS_RETENTION_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(policy, f)
+    os.rename(tmp_path, BACKUPS_RETENTION_PATH)
+    return policy
+
+
+def retention_describe(policy):
+    if len(policy) == 0:
+        return ["no retention policy, all backups are kept"]
+    rules = []
+    if "keep_last" in policy:
+        rules.append("the last {n} backups".format(n=policy["keep_last"]))
+    if "daily" in policy:
+        rules.append("the last backup of each of the last {n} days with backups".format(n=policy["daily"]))
+    if "weekly" in policy:
+        rules.append("the last backup of each of the last {n} weeks with backups".format(n=policy["weekly"]))
+    lines = ["keeping " + ", ".join(rules) if len(rules) > 0 else "keeping all backups"]
+    if "max_disk" in policy:
+        lines.append("removing the oldest while backups use more than {percent:g}% of the disk".format(percent=policy["max_disk"]))
+    return lines
+
+
+def retention_keep(catalog, policy):
+    """
+    Ids of the backups the keep rules keep, along with the backups their
+    chains need. The latest backup is always kept.
+    """
+    entries = sorted(catalog.values(), key=lambda entry: int(entry["id"]), reverse=True)
+    if len(entries) == 0:
+        return set()
+    if not any(rule in policy for rule in ("keep_last", "daily", "weekly")):
+        return set(catalog)
+    keep = set(entry["id"] for entry in entries[:policy.get("keep_last", 0)])
+    keep.add(entries[0]["id"])
+    buckets = {"daily": lambda entry: entry["date"],
+               "weekly": lambda entry: datetime.datetime.strptime(entry["date"], "%Y-%m-%d").isocalendar()[:2]}
+    for rule, bucket in buckets.items():
+        seen = set()
+        for entry in entries:
+            if bucket(entry) in seen:
+                continue
+            if len(seen) >= policy.get(rule, 0):
                 break
+            seen.add(bucket(entry))
+            keep.add(entry["id"])
+    for backup_id in list(keep):
+        parent_id = catalog[backup_id]["parent"]
+        while parent_id is not None and parent_id in catalog:
+            keep.add(parent_id)
+            parent_id = catalog[parent_id]["parent"]
+    return keep
+
+
+def backups_disk_usage(catalog, backup_ids, store):
+    """
+    Bytes the backups with these ids take, chunks they share count once.
+    """
+    size = 0
+    chunks = set()
+    for backup_id in backup_ids:
+        entry = catalog[backup_id]
+        if entry["deduplicated"]:
+            chunks.update(sha1 for sha1, _ in backup_manifest(os.path.join(BACKUPS_DIR, entry["dir"])))
+        else:
+            size += entry["size"] or 0
+    if store is not None:
+        size += sum(store.index[sha1][1] for sha1 in chunks if sha1 in store.index)
+    return size
+
+
+def retention_prunable(policy):
+    """
+    Ids of the backups the retention policy removes, oldest first.
+    """
+    catalog = catalog_load()
+    keep = retention_keep(catalog, policy)
+    if "max_disk" in policy and len(keep) > 0:
+        stat_code_dir = os.statvfs(CODE_DIR)
+        limit = stat_code_dir.f_frsize * stat_code_dir.f_blocks * policy["max_disk"] / 100.0
+        store = chunkstore.ChunkStore(BACKUPS_CHUNKS_DIR) if os.path.isdir(BACKUPS_CHUNKS_DIR) else None
+        latest_id = max(keep, key=int)
+        while backups_disk_usage(catalog, keep, store) > limit:
+            # The oldest goes, with whatever depends on it, unless that
+            # takes the latest backup too.
+            oldest_id = min(keep, key=int)
+            removed = set([oldest_id] + backup_dependents(oldest_id)) & keep
+            if latest_id in removed:
+                break
+            keep -= removed
+    return sorted(set(catalog) - keep, key=int)
+
+
+@exclusive
+def backup_prune(dry_run=False):
+    pruned = retention_prunable(retention_load())
+    if len(pruned) == 0:
+        return ["nothing to prune"], None
+    if not dry_run:
+        backups_remove(pruned)
+    return ["{verb} backups {ids}".format(verb="would remove" if dry_run else "removed", ids=", ".join(pruned))], None
+
+
+# Held while the trash dirs are listed or filled, see trash.
+reclaim_lock = threading.Lock()
+reclaim_running = [False]
+
 
+def trash(paths, trash_dir):
+    """
+    Moves paths into trash_dir for reclaim_start to delete. What can't be
+    renamed there, being on another file system, is deleted right away.
+    """
+    touch_dir(trash_dir)
+    left = []
+    for path in paths:
+        if not os.path.lexists(path):
+            continue
+        try:
+            # A reclaim listing the trash in between would delete the dir
+            # before the path is in it.
+            with reclaim_lock:
+                os.rename(path, os.path.join(tempfile.mkdtemp(dir=trash_dir), os.path.basename(path)))
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            left.append(path)
+    deltree.delete_trees(left)
+
+
+def reclaim_start():
+    """
+    Deletes what is in the trash dirs in a job, unless one is at it.
+    """
+    with reclaim_lock:
+        if reclaim_running[0]:
+            return
+        reclaim_running[0] = True
+    job = Job(str(next(job_ids)), "reclaiming space")
+    with jobs_lock:
+        JOBS[job.id] = job
+
+    def run():
+        error = None
+        try:
+            job.start_stage("deleting", unit="files")
+            while True:
+                with reclaim_lock:
+                    paths = [os.path.join(trash_dir, node) for trash_dir in (CODE_TRASH_DIR, STATE_TRASH_DIR)
+                             if os.path.isdir(trash_dir) for node in os.listdir(trash_dir)]
+                    if len(paths) == 0:
+                        reclaim_running[0] = False
+                        break
+                deltree.delete_trees(paths, progress=job.advance)
+        except BaseException as e:
+            with reclaim_lock:
+                reclaim_running[0] = False
+            error = {"code": JSONRPC_INTERNAL_ERROR, "message": str(e)}
+        job.finish(error)
+
+    worker = threading.Thread(target=run)
+    worker.daemon = True
+    worker.start()
+
+
+def clean(datasets, background=False):
+    job = Job()
+    if not background:
+        job.start_stage("deleting", unit="files")
+
+    def remove(paths, trash_dir):
+        if background:
+            trash(paths, trash_dir)
+        else:
+            deltree.delete_trees(paths, progress=job.advance)
 
-def clean(datasets):
     for dataset in datasets:
         if dataset == "state":
             log("cleaning {dataset}".format(dataset=dataset))
-            for node in os.listdir(STATE_DIR):
-                if node != "lost+found":
-                    node_path = os.path.join(STATE_DIR, node)
-                    subprocess.check_call("rm -rf {node_path}".format(node_path=node_path), shell=True)
+            remove([os.path.join(STATE_DIR, node) for node in os.listdir(STATE_DIR)
+                    if node not in ("lost+found", os.path.basename(STATE_TRASH_DIR))], STATE_TRASH_DIR)
             log("{dataset} was cleaned".format(dataset=dataset))
         elif dataset == "code":
             log("cleaning {dataset}".format(dataset=dataset))
-            pacman_db_dir = os.path.join(STATE_DIR, ".pacman", "db")
-            subprocess.check_call("rm -rf {pacman_db_dir}".format(pacman_db_dir=pacman_db_dir), shell=True)
-            for node in os.listdir(CODE_DIR):
-                if node not in ("lost+found", ".jsc", ".pacman", ".config"):
-                    node_path = os.path.join(CODE_DIR, node)
-                    subprocess.check_call("rm -rf {node_path}".format(node_path=node_path), shell=True)
+            remove([os.path.join(STATE_DIR, ".pacman", "db")], STATE_TRASH_DIR)
+            remove([os.path.join(CODE_DIR, node) for node in os.listdir(CODE_DIR)
+                    if node not in ("lost+found", ".jsc", ".pacman", ".config")], CODE_TRASH_DIR)
             recipe_reset()
             do_init({})
             do_sync({})
             log("{dataset} was cleaned".format(dataset=dataset))
+    if background:
+        reclaim_start()
+
+
+def save_upload_basis():
+    """
+    Keeps the sources of the latest deploy around so the next upload only
+    has to send what changed.
+    """
+    for src in (NEW_RECIPE_SRC, os.path.join(RECIPE_PATH, "src")):
+        if os.path.isdir(src) and len(os.listdir(src)) > 0:
+            if os.path.exists(UPLOAD_BASIS_DIR):
+                shutil.rmtree(UPLOAD_BASIS_DIR)
+            os.rename(src, UPLOAD_BASIS_DIR)
+            return
+
+
+def upload_cache_path(sha1):
+    return os.path.join(UPLOAD_CACHE_OBJECTS_DIR, sha1[:2], sha1[2:])
+
+
+def upload_cache_insert(path, sha1):
+    """
+    Adds an uploaded file to the cache under its checksum. The file is
+    hardlinked when possible, what comes out of the cache is always a copy
+    that is checked against the checksum.
+    """
+    obj_path = upload_cache_path(sha1)
+    if os.path.exists(obj_path):
+        os.utime(obj_path, None)
+        return
+    touch_dir(os.path.dirname(obj_path))
+    tmp_path = obj_path + ".tmp"
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        shutil.copyfile(path, tmp_path)
+    os.rename(tmp_path, obj_path)
+
+
+def upload_cache_fetch(path, sha1, mode=None):
+    """
+    Writes the cached file with the given checksum to path with the given
+    permissions, returns False if it isn't cached.
+    """
+    obj_path = upload_cache_path(sha1)
+    try:
+        src = open(obj_path, "rb")
+    except IOError:
+        return False
+    touch_dir(os.path.dirname(path))
+    with src:
+        sink = FileSink(path)
+        while True:
+            chunk = src.read(2**20)
+            if len(chunk) == 0:
+                break
+            sink.write(chunk)
+        result, _ = sink.close()
+    if result["sha1"] != sha1:
+        # Changed in place through a hardlink, it's useless now.
+        os.remove(obj_path)
+        os.remove(path)
+        return False
+    if mode is not None:
+        os.chmod(path, mode)
+    # The mtime is the last use for evicting.
+    os.utime(obj_path, None)
+    return True
+
+
+def upload_cache_objects():
+    objects = []
+    if os.path.isdir(UPLOAD_CACHE_OBJECTS_DIR):
+        for fan_dir in os.listdir(UPLOAD_CACHE_OBJECTS_DIR):
+            fan_path = os.path.join(UPLOAD_CACHE_OBJECTS_DIR, fan_dir)
+            for node in os.listdir(fan_path):
+                if node.endswith(".tmp"):
+                    continue
+                obj_path = os.path.join(fan_path, node)
+                obj_stat = os.stat(obj_path)
+                objects.append((obj_stat.st_mtime, obj_stat.st_size, obj_path))
+    return objects
+
+
+def upload_cache_evict(size_max=UPLOAD_CACHE_SIZE_MAX):
+    """
+    Removes the least recently used files until the cache fits in size_max,
+    and what interrupted inserts left.
+    """
+    for tmp_path in glob.glob(os.path.join(UPLOAD_CACHE_OBJECTS_DIR, "*", "*.tmp")):
+        os.remove(tmp_path)
+    objects = upload_cache_objects()
+    total_size = sum(size for _, size, _ in objects)
+    for _, size, obj_path in sorted(objects):
+        if total_size <= size_max:
+            break
+        os.remove(obj_path)
+        total_size -= size
 
 
 def recipe_reset():
+    save_upload_basis()
     if os.path.exists(RECIPE_PATH):
         shutil.rmtree(RECIPE_PATH)
     # For consecutive deploys to work we need to clear every time.
@@ -512,6 +1758,143 @@ def sync_software_list(url, session_key, software_list):
         return None, {"code": DO_SYNC_HTTP_ERROR, "message": "an error occured communicating with the server"}
 
 
+class FileSink():
+    """
+    Receives the payload of a streaming upload into a file that is opened
+    once. Replies with the checksum of what was written and adds the file to
+    the upload cache if asked to.
+    """
+    def __init__(self, path, mode="wb", cache=False):
+        self.path = path
+        self.cache = cache
+        self.f = open(path, mode)
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.sha1.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self.f.close()
+        sha1 = self.sha1.hexdigest()
+        if self.cache:
+            upload_cache_insert(self.path, sha1)
+        return {"sha1": sha1, "size": self.size}, None
+
+
+class PatchSink():
+    """
+    Receives a patch made by delta.diff and writes the file it describes,
+    copying blocks from the basis file.
+    """
+    def __init__(self, path, basis_path, block_size, cache=False):
+        self.basis = open(basis_path, "rb")
+        self.out = FileSink(path, cache=cache)
+        self.block_size = block_size
+        self.buf = ""
+        self.literal_left = 0
+
+    def write(self, data):
+        self.buf += data
+        while True:
+            if self.literal_left > 0:
+                if len(self.buf) == 0:
+                    return
+                literal = self.buf[:self.literal_left]
+                self.buf = self.buf[len(literal):]
+                self.literal_left -= len(literal)
+                self.out.write(literal)
+                continue
+            if len(self.buf) < delta.OP_HEADER.size:
+                return
+            op, first, count = delta.OP_HEADER.unpack(self.buf[:delta.OP_HEADER.size])
+            self.buf = self.buf[delta.OP_HEADER.size:]
+            if op == "C":
+                self.basis.seek(first * self.block_size)
+                left = count * self.block_size
+                while left > 0:
+                    block = self.basis.read(min(left, 2**20))
+                    if len(block) == 0:
+                        break
+                    self.out.write(block)
+                    left -= len(block)
+            elif op == "D":
+                self.literal_left = first
+            else:
+                raise IOError("invalid patch op {op!r}".format(op=op))
+
+    def close(self):
+        self.basis.close()
+        if len(self.buf) > 0 or self.literal_left > 0:
+            self.out.close()
+            raise IOError("patch ended in the middle of an op")
+        return self.out.close()
+
+
+# How tar is told to decompress each archive upload format.
+ARCHIVE_FORMATS = {"zstd": ["--use-compress-program=zstd -d"],
+                   "lz4": ["--use-compress-program=lz4 -d"],
+                   "gzip": ["-z"]}
+
+
+class TarExtractSink():
+    """
+    Receives a compressed tarball and extracts it into a dir as it arrives,
+    keeping permissions and symlinks. The files in cache_paths, relative to
+    path, are added to the upload cache afterwards.
+    """
+    def __init__(self, path, fmt, cache_paths=()):
+        self.path = path
+        self.cache_paths = cache_paths
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(["tar", "-x", "-p", "--no-same-owner", "-C", path, "-f", "-"] + ARCHIVE_FORMATS[fmt],
+                                     stdin=subprocess.PIPE, stderr=self.stderr)
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.broken = False
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.size += len(data)
+        if not self.broken:
+            try:
+                self.proc.stdin.write(data)
+            except IOError:
+                # tar gave up, its stderr tells why once the stream has ended.
+                self.broken = True
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        if self.proc.wait() != 0:
+            self.stderr.seek(0)
+            return None, {"code": DO_FILE_STREAM_ERROR, "message": "extracting archive failed: {e}".format(e=self.stderr.read().strip())}
+        for rel_path in self.cache_paths:
+            path = os.path.join(self.path, rel_path)
+            if os.path.isfile(path) and not os.path.islink(path):
+                upload_cache_insert(path, delta.file_sha1(path))
+        return {"sha1": self.sha1.hexdigest(), "size": self.size}, None
+
+
+class DiscardSink():
+    """
+    Swallows the payload of a streaming upload that can't be written, the
+    stream has to be consumed before the error is sent anyway.
+    """
+    def __init__(self, error):
+        self.error = error
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        return None, self.error
+
+
 ################################################################################
 ############################### Recipe functions ###############################
 ################################################################################
@@ -683,6 +2066,7 @@ def rc_rinsert(state, args):
 ############################### Regular commands ###############################
 ################################################################################
 
+@shared
 def do_assert_is_assembly(args):
     if not env_json()["ident"]["container"]["is_assembly"]:
         return False, {"code": DO_ASSERT_IS_ASSEMBLY_ERROR, "message": "You tried to connect to a non-assembly container"}
@@ -691,29 +2075,126 @@ def do_assert_is_assembly(args):
 
 def do_backup(args):
     if args["new"]:
-        backup_new()
-        return None, None
+        level = args.get("--level")
+        new_args = (args.get("--full", False), args.get("--dedup", False), args.get("--compress"),
+                    int(level) if level is not None else None, int(args.get("--threads") or 0))
+        if args.get("--background"):
+            return job_start("backup", backup_new, *new_args)
+        return backup_new(*new_args)
     elif args["du"]:
         return backup_du(), None
+    elif args.get("show"):
+        return backup_show(args["id"], args.get("--path"))
+    elif args.get("retention"):
+        changes = dict((rule, parse(args[option])) for rule, option, parse in (("keep_last", "--keep-last", int), ("daily", "--daily", int),
+                                                                                  ("weekly", "--weekly", int), ("max_disk", "--max-disk", float))
+                       if args.get(option) is not None)
+        policy = retention_set(changes) if len(changes) > 0 else retention_load()
+        return retention_describe(policy), None
+    elif args.get("prune"):
+        return backup_prune(args.get("--dry-run", False))
     elif args["rm"]:
         backup_id = args["id"]
-        backup_rm(backup_id)
-        return None, None
+        return backup_rm(backup_id, args.get("--with-dependents", False))
     else:
         return backup_ls(), None
 
 
+def do_backup_file_info(args):
+    """
+    Name, size and checksum of the archive of a backup, for pulling it.
+    """
+    backup_dir = backup_dir_by_id(args["id"])
+    if backup_dir is None:
+        return None, {"code": DO_BACKUP_TRANSFER_ERROR, "message": "backup id does not exist"}
+    entry = catalog_load()[args["id"]]
+    if entry["deduplicated"] or entry["parent"] is not None:
+        return None, {"code": DO_BACKUP_TRANSFER_ERROR, "message": "backup {backup_id} is {kind}, only full backups can be pulled, make one with backup new --full".format(backup_id=args["id"], kind=backup_kind(entry))}
+    archive_path, fmt = backup_archive(backup_dir)
+    return {"name": os.path.basename(archive_path),
+            "size": entry["size"],
+            "sha1": backup_archive_sha1(archive_path),
+            "raw_size": entry["raw_size"]}, None
+
+
+@shared
+def do_backup_read(args):
+    backup_dir = backup_dir_by_id(args["id"])
+    if backup_dir is None:
+        return None, {"code": DO_BACKUP_TRANSFER_ERROR, "message": "backup id does not exist"}
+    archive_path, _ = backup_archive(backup_dir)
+    with open(archive_path, "rb") as f:
+        f.seek(args["offset"])
+        return f.read(args["size"]), None
+
+
+@shared
+def do_backup_push_offset(args):
+    """
+    How much of a pushed archive has arrived, pushing resumes from there.
+    """
+    path, _ = backup_incoming_path(args["name"])
+    if path is None or not os.path.isfile(path):
+        return 0, None
+    return os.path.getsize(path), None
+
+
+def do_backup_push(args):
+    path, _ = backup_incoming_path(args["name"])
+    if path is None:
+        return None, {"code": DO_BACKUP_TRANSFER_ERROR, "message": "{name} is not named like a backup archive, use one of {names}".format(name=args["name"], names=", ".join("*" + name[len("data"):] for name, _, _, _ in BACKUP_FORMATS.values()))}
+    touch_dir(BACKUPS_INCOMING_DIR)
+    offset = args["offset"]
+    if offset > (os.path.getsize(path) if os.path.isfile(path) else 0):
+        return None, {"code": DO_BACKUP_TRANSFER_ERROR, "message": "can't resume {name} at {offset}".format(name=args["name"], offset=offset)}
+    with open(path, "ab") as f:
+        f.truncate(offset)
+    return FileSink(path, "ab"), None
+
+
+@exclusive
+def do_backup_push_finish(args):
+    """
+    Checks a pushed archive and turns it into a full backup.
+    """
+    path, fmt = backup_incoming_path(args["name"])
+    if path is None or not os.path.isfile(path):
+        return None, {"code": DO_BACKUP_TRANSFER_ERROR, "message": "nothing was pushed as {name}".format(name=args["name"])}
+    if os.path.getsize(path) != args["size"] or delta.file_sha1(path, BACKUP_BLOCK_SIZE) != args["sha1"]:
+        os.remove(path)
+        return None, {"code": DO_BACKUP_TRANSFER_ERROR, "message": "{name} arrived damaged, push it again".format(name=args["name"])}
+    indexer = tarindex.TarIndexer()
+    try:
+        raw_size = backup_raw_size(path, fmt, indexer)
+    except (IOError, OSError) as e:
+        os.remove(path)
+        return None, {"code": DO_BACKUP_TRANSFER_ERROR, "message": str(e)}
+    pushed_backup_dir = os.path.join(BACKUPS_DIR, "pushed-backup")
+    if os.path.exists(pushed_backup_dir):
+        shutil.rmtree(pushed_backup_dir)
+    touch_dir(pushed_backup_dir)
+    os.rename(path, os.path.join(pushed_backup_dir, BACKUP_FORMATS[fmt][0]))
+    with open(os.path.join(pushed_backup_dir, "size"), "w") as f:
+        f.write(str(raw_size))
+    backup_write_index(pushed_backup_dir, indexer)
+    seq_num = backup_next_seq()
+    backup_commit(pushed_backup_dir, seq_num)
+    return str(seq_num), None
+
+
+@exclusive
 def do_clean(args):
     if args["--all"]:
         datasets = ["state", "code"]
     else:
-        datasets = [item[2:] for item in args if args[item] is True]
+        datasets = [item[2:] for item in ("--code", "--state") if args.get(item) is True]
     if len(datasets) == 0:
         datasets = ["code"]
-    clean(datasets)
+    clean(datasets, args.get("--background", False))
     return None, None
 
 
+@shared
 def do_check_init(args):
     for node in (JSC_DIR, BACKUPS_DIR):
         if not os.path.exists(node):
@@ -756,6 +2237,8 @@ def do_deploy_read_new_recipe(args):
         rmtree(os.path.join(NEW_RECIPE_SRC, ".git"))
         # 3. A disk sync is performed on /app/code.
         sync_dir("/")
+    # The upload is done, what it added to the upload cache counts now.
+    upload_cache_evict()
     # 4. Syncing the jumpstart repo so it"s up to date.
     # Not needed, jumpstart -Sy is a better solution
     # 5. The recipe (.jsc/new-recipe/src/Jumpstart-Recipe) is executed by
@@ -766,6 +2249,42 @@ def do_deploy_read_new_recipe(args):
     return recipe_script, None
 
 
+@exclusive
+def do_deploy_execute(args):
+    """
+    Runs a whole parsed recipe, [line, statement] pairs, in one call instead
+    of a call per statement. The state stays here until the end and only the
+    final one is sent back. Stops at the first statement that fails. A state
+    from an earlier call picks up where that one left off, the client runs
+    the run statements in between on a terminal channel.
+    """
+    statements = args["statements"]
+    state = args.get("state")
+    if state is None:
+        state = {"software_list": {}, "name": None, "is_dev": args["is_dev"]}
+    job = Job()
+    job.start_stage("running recipe", total=len(statements), unit="statements")
+    for line, statement in statements:
+        command = statement[0]
+        func = globals().get("rc_" + command)
+        if func is None:
+            return None, {"code": RC_RECIPE_INVALID_COMMAND,
+                          "message": "Recipe contains an invalid command at line {line}.".format(line=line)}
+        try:
+            result, err = func({"args": statement[1:], "state": state})
+        except DocoptExit as e:
+            return None, {"code": RC_RECIPE_INVALID_COMMAND,
+                          "message": "Recipe contains an invalid command at line {line}.\n{e}".format(line=line, e=e)}
+        if err is not None:
+            return None, {"code": err["code"],
+                          "message": "Recipe command on line {line} failed with error: {e}".format(line=line, e=err["message"])}
+        state = result
+        job.advance(1)
+    job.notify()
+    return state, None
+
+
+@exclusive
 def do_deploy_finalize(args):
     is_dev_flag = "1" if args["--dev"] else "0"
     state = args["state"]
@@ -802,6 +2321,7 @@ def do_deploy_finalize(args):
     return None, None
 
 
+@shared
 def do_env(args):
     return env_json(), None
 
@@ -813,7 +2333,14 @@ def do_init(args):
     if not os.path.exists(BACKUPS_SEQ_FILE_PATH):
         with open(BACKUPS_SEQ_FILE_PATH, "w+") as f:
             f.write("1")
+    catalog_check()
+    if os.path.exists(BACKUPS_TRASH_DIR):
+        backups_trash_empty()
+    # Trash left by a clean --background that was cut short.
+    if any(os.path.isdir(trash_dir) and len(os.listdir(trash_dir)) > 0 for trash_dir in (CODE_TRASH_DIR, STATE_TRASH_DIR)):
+        reclaim_start()
     if os.path.exists(NEW_RECIPE_PATH):
+        save_upload_basis()
         shutil.rmtree(NEW_RECIPE_PATH)
     if os.path.exists(NEW_BACKUP_DIR):
         shutil.rmtree(NEW_BACKUP_DIR)
@@ -837,22 +2364,56 @@ def do_lock_session(lock_content):
 
 def do_revert(args):
     backup_id = args["id"]
+    if args.get("--background"):
+        return job_start("revert {backup_id}".format(backup_id=backup_id), revert, backup_id, args.get("--path"))
+    return revert(backup_id, args.get("--path"))
+
+
+@exclusive
+def revert(backup_id, pattern=None, job=None):
+    if job is None:
+        job = Job()
+    try:
+        if pattern is not None:
+            return backup_extract(backup_id, pattern, job)
+        return revert_whole(backup_id, job)
+    except JobCancelled:
+        return None, {"code": DO_JOB_CANCELLED, "message": "revert cancelled, {code_dir} is partly reverted".format(code_dir=CODE_DIR)}
+
+
+def revert_whole(backup_id, job):
     if not is_code_dir_clean():
         return None, {"code": DO_REVERT_NOT_CLEAN, "message": "{code_dir} is not clean".format(code_dir=CODE_DIR)}
     reverted = False
-    for backup_dir in os.listdir(BACKUPS_DIR):
-        match = re.match(re_backup_name, backup_dir)
-        if match is not None:
-            m_id = match.group(1)
-            if m_id == backup_id:
-                backup_dir_path = os.path.join(BACKUPS_DIR, backup_dir)
-                backup_archive = os.path.join(backup_dir_path, "data.tar.lzo")
-                subprocess.check_call("tar -xf {backup_archive} -C /".format(backup_archive=backup_archive), shell=True)
-                recipe_file_path = os.path.join(backup_dir_path, "recipe")
-                if os.path.isfile(recipe_file_path):
-                    subprocess.call("mv {recipe_file_path {jsc_dir}/new-recipe".format(recipe_file_path=recipe_file_path, jsc_dir=JSC_DIR), shell=True)
-                reverted = True
-                break
+    backup_dir_path = backup_dir_by_id(backup_id)
+    if backup_dir_path is not None:
+        chain = backup_chain(backup_id)
+        catalog = catalog_load()
+        job.start_stage("extracting", sum(entry["raw_size"] if entry["deduplicated"] else entry["size"]
+                                          for entry in catalog.values() if os.path.join(BACKUPS_DIR, entry["dir"]) in chain))
+        # Replay the chain from its full backup, extracting in incremental
+        # mode also removes what was deleted in between.
+        for chain_dir in chain:
+            manifest = backup_manifest(chain_dir)
+            if manifest is not None:
+                store = chunkstore.ChunkStore(BACKUPS_CHUNKS_DIR)
+                tar_extract((store.get(sha1) for sha1, _ in manifest), job)
+            else:
+                archive_path, fmt = backup_archive(chain_dir)
+                tar_args = BACKUP_FORMATS[fmt][1]
+                if os.path.isfile(os.path.join(chain_dir, "snapshot")):
+                    tar_args = tar_args + ["--listed-incremental=/dev/null"]
+                tar_extract(file_chunks(archive_path, BACKUP_BLOCK_SIZE), job, tar_args)
+        top_level_file = os.path.join(backup_dir_path, "top-level")
+        if os.path.isfile(top_level_file):
+            with open(top_level_file) as f:
+                top_level = json.load(f)
+            deltree.delete_trees([os.path.join(CODE_DIR, node) for node in os.listdir(CODE_DIR)
+                                  if node not in top_level and not node.startswith(".") and node != "lost+found"])
+        recipe_file_path = os.path.join(backup_dir_path, "recipe")
+        if os.path.isfile(recipe_file_path):
+            subprocess.call("mv {recipe_file_path {jsc_dir}/new-recipe".format(recipe_file_path=recipe_file_path, jsc_dir=JSC_DIR), shell=True)
+        reverted = True
     if reverted:
         is_software_list_synced_file = os.path.join(JSC_DIR, "recipe", "is-software-list-synced")
         if os.path.isfile(is_software_list_synced_file):
@@ -865,6 +2426,44 @@ def do_revert(args):
     return None, {"code": DO_REVERT_INVALID_ID, "message": "backup id does not exist"}
 
 
+@shared
+def do_jobs(args):
+    with jobs_lock:
+        jobs = sorted(JOBS.values(), key=lambda job: int(job.id))
+    job_list = []
+    for job in jobs:
+        info = job.info()
+        info["message"] = job.summary(info)
+        job_list.append(info)
+    return job_list, None
+
+
+@shared
+def do_jobs_cancel(args):
+    """
+    Asks a job to stop, it does at its next progress update.
+    """
+    job = JOBS.get(args["id"])
+    if job is None:
+        return None, {"code": DO_JOB_INVALID_ID, "message": "job id does not exist"}
+    job.cancelled.set()
+    return None, None
+
+
+@shared
+def do_jobs_wait(args):
+    """
+    Returns the outcome of a job when it has finished, its progress
+    notifications are sent meanwhile.
+    """
+    job = JOBS.get(args["id"])
+    if job is None:
+        return None, {"code": DO_JOB_INVALID_ID, "message": "job id does not exist"}
+    job.notify()
+    job.finished.wait()
+    return job.info(), None
+
+
 def do_run(args):
     args = ["{code_dir}/init".format(code_dir=CODE_DIR)]
     subproc(args)
@@ -892,6 +2491,7 @@ def do_sync(args):
     return None, None
 
 
+@shared
 def do_status(args):
     output = {}
     code_total_size, code_used_size, code_percent_used = disk_usage_stats_pretty(CODE_DIR)
@@ -928,6 +2528,7 @@ def do_status(args):
     return output, None
 
 
+@exclusive
 def do_file_append(args):
     path = args["path"]
     content = base64.standard_b64decode(args["content"])
@@ -936,6 +2537,80 @@ def do_file_append(args):
     return None, None
 
 
+@exclusive
+def do_file_stream(args):
+    path = args["path"]
+    try:
+        return FileSink(path, cache=args.get("cache", False)), None
+    except IOError as e:
+        return None, {"code": DO_FILE_STREAM_ERROR, "message": "could not open {path}: {e}".format(path=path, e=e.strerror)}
+
+
+@shared
+def do_file_signatures(args):
+    """
+    Block signatures of the files in the upload basis that the client is
+    about to upload, keyed by their path relative to the recipe root.
+    """
+    signatures = {}
+    for rel_path in args["paths"]:
+        basis_path = os.path.join(UPLOAD_BASIS_DIR, rel_path)
+        if os.path.isfile(basis_path) and not os.path.islink(basis_path):
+            try:
+                signatures[rel_path] = delta.signature(basis_path)
+            except IOError:
+                pass
+    return signatures, None
+
+
+@exclusive
+def do_upload_cache_fetch(args):
+    """
+    Writes the files of an upload that are in the upload cache, given as
+    [path, sha1, mode] lists, and replies with the paths that were written.
+    The rest has to be uploaded. Without a mode the default permissions are
+    used.
+    """
+    fetched = []
+    for item in args["files"]:
+        path, sha1 = item[:2]
+        mode = item[2] if len(item) > 2 else None
+        try:
+            if upload_cache_fetch(path, sha1, mode):
+                fetched.append(path)
+        except (IOError, OSError) as e:
+            log("upload cache: {path}: {e}".format(path=path, e=e))
+    return fetched, None
+
+
+@exclusive
+def do_file_patch(args):
+    path = args["path"]
+    basis_path = os.path.join(UPLOAD_BASIS_DIR, args["basis"])
+    try:
+        return PatchSink(path, basis_path, args["block_size"], args.get("cache", False)), None
+    except IOError as e:
+        return None, {"code": DO_FILE_STREAM_ERROR, "message": "could not patch {path}: {e}".format(path=path, e=e.strerror)}
+
+
+@shared
+def do_archive_formats(args):
+    formats = ["gzip"]
+    for fmt in ("zstd", "lz4"):
+        if find_executable(fmt) is not None:
+            formats.append(fmt)
+    return formats, None
+
+
+@exclusive
+def do_archive_extract(args):
+    fmt = args["format"]
+    if fmt not in ARCHIVE_FORMATS:
+        return None, {"code": DO_FILE_STREAM_ERROR, "message": "unknown archive format {fmt}".format(fmt=fmt)}
+    return TarExtractSink(args["path"], fmt, args.get("cache", [])), None
+
+
+@exclusive
 def do_symlink(args):
     path = args["path"]
     target = args["target"]
@@ -943,71 +2618,370 @@ def do_symlink(args):
     return None, None
 
 
+@exclusive
 def do_mkdir(args):
     path = args["path"]
     os.mkdir(path)
     return None, None
 
 
+@exclusive
+def do_mktree(args):
+    """
+    Creates all dirs, parents first, and then all symlinks of an upload.
+    """
+    path = None
+    try:
+        for path in args["dirs"]:
+            os.mkdir(path)
+        for path, target in args["symlinks"]:
+            os.symlink(target, path)
+    except OSError as e:
+        return None, {"code": DO_MKTREE_ERROR, "message": "{path}: {e}".format(path=path, e=e.strerror)}
+    return None, None
+
+
 ################################################################################
 ############################### Server main loop ###############################
 ################################################################################
 
+# Threads running shared methods, see shared.
+SHARED_WORKERS = 8
+
+# Methods that read stdin themselves to forward it to a child, they run on
+# the main loop so nothing else reads it meanwhile.
+INTERACTIVE_METHODS = ("do_run", "rc_run", "do_deploy_execute")
+
+
+class Dispatcher():
+    """
+    Runs requests off the main loop, which keeps reading meanwhile.
+    Exclusive work goes through one thread in the order it came in, shared
+    methods to a pool of threads. Each response goes out with the id of its
+    request when it is done, so shared ones may overtake.
+    """
+    def __init__(self, workers=SHARED_WORKERS):
+        self.exclusive = queue.Queue()
+        self.shared = queue.Queue()
+        for work, count in ((self.exclusive, 1), (self.shared, workers)):
+            for _ in range(count):
+                worker = threading.Thread(target=self._work, args=(work,))
+                worker.daemon = True
+                worker.start()
+
+    def _work(self, work):
+        while True:
+            func, args = work.get()
+            try:
+                func(*args)
+            finally:
+                work.task_done()
+
+    def submit(self, func, *args):
+        self.exclusive.put((func, args))
+
+    def submit_shared(self, func, *args):
+        self.shared.put((func, args))
+
+    def drain(self):
+        """
+        Waits for the exclusive work submitted so far.
+        """
+        self.exclusive.join()
+
+
+def is_shared(method):
+    return method[0:3] in ["do_", "rc_"] and getattr(globals().get(method), "shared", False)
+
+
+# Methods whose request is followed by a chunked payload on stdin. With lines
+# each chunk is its length in hex and a newline followed by the raw bytes, a
+# zero length chunk ends the stream. With frames each chunk is a stream frame.
+# The method returns a sink that is fed the payload and only one response is
+# sent, when the stream has ended.
+STREAM_METHODS = ("do_file_stream", "do_file_patch", "do_archive_extract", "do_backup_push")
+
+
+class StreamUpload():
+    def __init__(self, method, params, rpc_id):
+        self.rpc_id = rpc_id
+        self.chunk_left = None
+        self.finished = False
+        sink, error = dispatch_stream(method, params)
+        self.sink = sink if error is None else DiscardSink(error)
+
+    def feed(self, buf):
+        """
+        Consumes as much of the InBuffer buf as belongs to the stream.
+        """
+        while not self.finished:
+            if self.chunk_left is None:
+                header = buf.readline()
+                if header is None:
+                    break
+                self.chunk_left = int(header, 16)
+                if self.chunk_left == 0:
+                    self.finished = True
+                    break
+            if len(buf) == 0:
+                break
+            chunk = buf.read(self.chunk_left)
+            self.chunk_left -= len(chunk)
+            if self.chunk_left == 0:
+                self.chunk_left = None
+            self.write(chunk)
+
+    def write(self, chunk):
+        try:
+            self.sink.write(chunk)
+        except (IOError, OSError) as e:
+            self.sink = DiscardSink({"code": DO_FILE_STREAM_ERROR, "message": str(e)})
+
+    def response(self):
+        try:
+            result, error = self.sink.close()
+        except (IOError, OSError) as e:
+            result, error = None, {"code": DO_FILE_STREAM_ERROR, "message": str(e)}
+        return {"id": self.rpc_id,
+                "result": result,
+                "error": error}
+
+
+def serialize(msg):
+    """
+    msg as it goes on stdout, in the framing of the channel.
+    """
+    if channel_framing == framing.FRAMES:
+        return framing.frame(framing.FRAME_JSON, channel_codec.dumps(msg))
+    return channel_codec.dumps(msg) + "\n"
+
+
 def send_msg(msg):
-    msg_str = json.dumps(msg) + "\n"
-    sys.stdout.write(msg_str)
-    sys.stdout.flush()
+    msg_str = serialize(msg)
+    with stdout_lock:
+        # Output still held goes first, it was written before msg.
+        sys.stdout.write(pending_output.take() + msg_str)
+        sys.stdout.flush()
 
 
-def execute(method, params, rpc_id):
+def send_output(data):
+    """
+    Sends output of a child, held in pending_output until enough of it has
+    come or it has waited long enough.
+    """
+    with stdout_lock:
+        pending_output.add(data)
+        if pending_output.due():
+            sys.stdout.write(pending_output.take())
+            sys.stdout.flush()
+
+
+def send_binary(rpc_id, data):
+    """
+    Sends data as the result of call rpc_id in a binary frame.
+    """
+    with stdout_lock:
+        sys.stdout.write(pending_output.take() + framing.binary_frame_header(rpc_id, len(data)))
+        sys.stdout.write(data)
+        sys.stdout.flush()
+
+
+def flush_output(everything=False):
+    with stdout_lock:
+        msg_str = pending_output.take(everything)
+        if len(msg_str) > 0:
+            sys.stdout.write(msg_str)
+            sys.stdout.flush()
+
+
+def do_handshake(args):
+    """
+    Picks the framing and codec for the rest of the session, the first ones
+    the client offers that we have. Anything but json needs frames. The
+    response still goes in lines and json.
+    """
+    picked = {"framing": framing.LINES, "codec": "json"}
+    for offered in args["framing"]:
+        if offered in (framing.FRAMES, framing.LINES):
+            picked["framing"] = offered
+            break
+    if picked["framing"] == framing.FRAMES:
+        for offered in args.get("codec", []):
+            if offered in codec.available_codecs():
+                picked["codec"] = offered
+                break
+    return picked, None
+
+
+def dispatch(method, params, rpc_id, raw=False):
+    """
+    Runs method. Results of binary methods are base64 unless raw.
+    """
     method_prefix = method[0:3]
+    if method in STREAM_METHODS:
+        return {"id": rpc_id,
+                "result": None,
+                "error": {
+                    "code": JSONRPC_INVALID_REQUEST,
+                    "message": "streaming method without a stream"}}
     if method_prefix in ["do_", "rc_"] and method in globals().keys():
         f = globals()[method]
-        result, error = f(params)
-        send_msg({"id": rpc_id,
-                  "result": result,
-                  "error": error})
+        try:
+            result, error = f(params)
+        except BaseException as e:
+            # Off the main loop nothing else would answer the call.
+            return {"id": rpc_id,
+                    "result": None,
+                    "error": {
+                        "code": JSONRPC_INTERNAL_ERROR,
+                        "message": str(e)}}
+        if method in framing.BINARY_METHODS and result is not None and not raw:
+            result = base64.standard_b64encode(result)
+        return {"id": rpc_id,
+                "result": result,
+                "error": error}
+    return {"id": rpc_id,
+            "result": None,
+            "error": {
+                "code": JSONRPC_METHOD_NOT_FOUND,
+                "message": "method not found"}}
+
+
+def dispatch_stream(method, params):
+    """
+    Opens the sink of a streaming method. An error ends up in a DiscardSink,
+    so the stream is still read and answered.
+    """
+    if method in STREAM_METHODS:
+        try:
+            return globals()[method](params)
+        except BaseException as e:
+            return None, {"code": JSONRPC_INTERNAL_ERROR, "message": str(e)}
+    return None, {"code": JSONRPC_METHOD_NOT_FOUND,
+                  "message": "method not found"}
+
+
+def execute(method, params, rpc_id):
+    binary = method in framing.BINARY_METHODS and channel_framing == framing.FRAMES and type(rpc_id) in (int, long)
+    response = dispatch(method, params, rpc_id, raw=binary)
+    if binary and response["error"] is None and response["result"] is not None:
+        send_binary(rpc_id, response["result"])
     else:
-        send_msg({"id": rpc_id,
+        send_msg(response)
+
+
+def execute_batch(cmd_objs):
+    """
+    Runs a JSON-RPC batch in order and replies with all responses in a
+    single array. Notifications in the batch get no response.
+    """
+    if len(cmd_objs) == 0:
+        send_msg({"id": None,
                   "result": None,
                   "error": {
-                      "code": JSONRPC_METHOD_NOT_FOUND,
-                      "message": "method not found"}})
+                      "code": JSONRPC_INVALID_REQUEST,
+                      "message": "empty batch"}})
+        return
+    responses = []
+    for cmd_obj in cmd_objs:
+        if type(cmd_obj) != dict or "method" not in cmd_obj:
+            responses.append({"id": None,
+                              "result": None,
+                              "error": {
+                                  "code": JSONRPC_INVALID_REQUEST,
+                                  "message": "invalid request"}})
+            continue
+        response = dispatch(cmd_obj["method"], cmd_obj.get("params"), cmd_obj.get("id"))
+        if cmd_obj.get("id") is not None:
+            responses.append(response)
+    if len(responses) > 0:
+        send_msg(responses)
 
 
 def main(in_ch):
+    global channel_framing, channel_codec
     if len(sys.argv) > 1 and sys.argv[1] == "--version":
         print(__version__)
         return
     channels = [in_ch]
-    inbuf = ""
+    dispatcher = Dispatcher()
+    inbuf = framing.InBuffer()
+    frames = framing.FrameReader()
+    upload = None
     while True:
         rl, _, xl = select.select(channels, [], channels)
         if len(xl) > 0:
             if in_ch in xl:
                 # Stdin is closed
+                dispatcher.drain()
                 exit(0)
         elif len(rl) > 0:
             new_data = in_ch.read()
             if len(new_data) == 0:
-                # stdin is closed
+                # stdin is closed, what was asked for still gets done.
+                dispatcher.drain()
                 exit(0)
-            inbuf += new_data
-            if "\n" in inbuf:
-                lines = inbuf.split("\n")
-                # Last line is not complete.
-                inbuf = "\n".join(lines[-1:])
-                commands = lines[0:-1]
-                for cmd_str in commands:
-                    cmd_obj = json.loads(cmd_str)
-                    if type(cmd_obj) != dict:
-                        raise TypeError("Invalid json-rpc")
-                    if "method" in cmd_obj:
-                        execute(cmd_obj["method"], cmd_obj["params"], cmd_obj["id"])
+            inbuf.feed(new_data)
+            while True:
+                if channel_framing == framing.FRAMES:
+                    frame = frames.read(inbuf)
+                    if frame is None:
+                        break
+                    kind, cmd_str = frame
+                    if kind == framing.FRAME_STREAM:
+                        if upload is None:
+                            # What is left of a stream that was refused.
+                            continue
+                        if len(cmd_str) > 0:
+                            upload.write(cmd_str)
+                            continue
+                        send_msg(upload.response())
+                        upload = None
+                        continue
+                else:
+                    if upload is not None:
+                        upload.feed(inbuf)
+                        if not upload.finished:
+                            break
+                        send_msg(upload.response())
+                        upload = None
+                    cmd_str = inbuf.readline()
+                    if cmd_str is None:
+                        # Last line is not complete.
+                        break
+                cmd_obj = channel_codec.loads(cmd_str)
+                if type(cmd_obj) == list:
+                    dispatcher.submit(execute_batch, cmd_obj)
+                    continue
+                if type(cmd_obj) != dict:
+                    raise TypeError("Invalid json-rpc")
+                if "method" in cmd_obj:
+                    method = cmd_obj["method"]
+                    if method in STREAM_METHODS:
+                        # The stream is read here, its sink may depend on
+                        # what came before it.
+                        dispatcher.drain()
+                        upload = StreamUpload(cmd_obj["method"], cmd_obj["params"], cmd_obj["id"])
+                    elif method == "do_handshake":
+                        # Answered in the old framing and codec, the new
+                        # ones start right after.
+                        dispatcher.drain()
+                        response = dispatch(cmd_obj["method"], cmd_obj["params"], cmd_obj["id"])
+                        send_msg(response)
+                        if response["error"] is None:
+                            channel_framing = response["result"]["framing"]
+                            channel_codec = codec.codec(response["result"]["codec"])
+                    elif method in INTERACTIVE_METHODS:
+                        dispatcher.drain()
+                        execute(method, cmd_obj["params"], cmd_obj["id"])
+                    elif is_shared(method):
+                        dispatcher.submit_shared(execute, method, cmd_obj["params"], cmd_obj["id"])
                     else:
-                        # This is probably a notification recieved for the
-                        # previous command, could contain sensitive information.
-                        pass
+                        dispatcher.submit(execute, method, cmd_obj["params"], cmd_obj["id"])
+                else:
+                    # This is probably a notification recieved for the
+                    # previous command, could contain sensitive information.
+                    pass
 
 
 def test():
@@ -1,12 +1,15 @@
 import paramiko
 import threading
-import json
+import base64
 import os
 import os.path
+import pipes
+import sys
 import inspect
 import server_updater
 import select
 import socket
+import contextlib
 from sshrpcutil import *
 
 try:
@@ -18,14 +21,89 @@ try:
     import logger as log
 except ImportError:
     from jsc import logger as log
+try:
+    import framing
+except ImportError:
+    from jsc import framing
+try:
+    import codec
+except ImportError:
+    from jsc import codec
+
+RECV_SIZE = 2**16
+
+
+class SshRpcFuture():
+    """
+    Pending result of a call. Resolved by whoever reads the response from the
+    channel, either a blocking call or the multiplexed reader thread.
+    """
+    def __init__(self, rpc_id, method, waiter, callback=None):
+        self.rpc_id = rpc_id
+        self.method = method
+        self._waiter = waiter
+        self._callback = callback
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def set_response(self, resp):
+        if resp.get("error") is not None:
+            self._exception = SshRpcCallError(resp["error"]["message"])
+        else:
+            self._result = resp.get("result")
+        self._resolve()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._resolve()
+
+    def _resolve(self):
+        self._done.set()
+        if self._callback is not None:
+            self._callback(self)
+
+    def exception(self):
+        self.wait()
+        return self._exception
+
+    def wait(self):
+        if not self.done():
+            self._waiter(self)
+
+    def result(self):
+        self.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
 
 
 class SshJsonRpc():
     rpc_id = 0
+    rpc_id_lock = threading.Lock()
 
     def __init__(self, username, password=None, key_filename=None, host=DEFAULT_SSH_HOST, port=DEFAULT_SSH_PORT):
         pkey = os.path.expanduser(key_filename) if key_filename is not None else None
         self.send_lock = threading.Lock()
+        self.ssh_channel = None
+        # Calls in flight keyed by rpc id.
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._recv_buf = framing.InBuffer()
+        self._frames = framing.FrameReader()
+        self.framing = framing.LINES
+        self.codec = codec.codec("json")
+        self._reader = None
+        self._reader_stop = threading.Event()
+        # Cleared once the server refuses a terminal, interactive commands
+        # then go through the server over the rpc channel.
+        self.pty = True
+        # Background jobs whose progress is printed, the others only say
+        # when they are done.
+        self.followed_jobs = set()
         self.ssh_client = paramiko.SSHClient()
         self.ssh_client.load_system_host_keys()
         self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -55,7 +133,6 @@ class SshJsonRpc():
             os._exit(1)
         self.ssh_transport = self.ssh_client.get_transport()
         self.ssh_transport.set_keepalive(30)
-        self.ssh_channel = None
         self._server_update()
 
     def _server_update(self):
@@ -85,37 +162,277 @@ class SshJsonRpc():
             self.ssh_channel.setblocking(0)
             self.ssh_channel.exec_command('/tmp/server')
             self.stdout_file = self.ssh_channel.makefile("r", 0)
+            self._recv_buf = framing.InBuffer()
+            self._frames = framing.FrameReader()
+            self.framing = framing.LINES
+            self.codec = codec.codec("json")
         except paramiko.ssh_exception.SSHException:
             log.white("Connection lost, make sure the assembly is running, then reconnect.")
             os._exit(1)
+        self._handshake()
 
+    def _handshake(self):
+        """
+        Asks for frames and the best codec we have, servers that don't know
+        the handshake keep to lines and json. The server reads whatever
+        follows the handshake in the new framing and codec, so nothing else
+        goes out until the answer is in, not even stdin.
+        """
+        future = self._register("do_handshake", None)
+        offer = {"framing": [framing.FRAMES, framing.LINES], "codec": codec.available_codecs()}
+        with self.send_lock:
+            self.ssh_channel.sendall(self._encode(self.rpc("do_handshake", offer, future.rpc_id)))
+            while not future.done():
+                if self._reader is None:
+                    select.select([self.ssh_channel], [], [], 0.1)
+                    self._recv()
+                else:
+                    future._done.wait(0.1)
+            try:
+                picked = future.result()
+            except SshRpcCallError:
+                return
+            self.framing = picked["framing"]
+            self.codec = codec.codec(picked.get("codec", "json"))
 
-    def _sendall(self, rpc):
+    def _open_pty(self, args, cwd, width, height):
+        """
+        Starts args in a terminal on a channel of its own, raw terminal bytes
+        go both ways on it. None when the server does not hand out terminals.
+        """
+        command = "exec " + " ".join(pipes.quote(arg) for arg in args)
+        if cwd is not None:
+            command = "cd {cwd} && {command}".format(cwd=pipes.quote(cwd), command=command)
+        try:
+            channel = self.ssh_transport.open_session()
+        except paramiko.ssh_exception.SSHException:
+            log.white("Connection lost, make sure the assembly is running, then reconnect.")
+            os._exit(1)
+        try:
+            channel.get_pty(term=os.environ.get("TERM", "vt100"), width=width, height=height)
+        except paramiko.ssh_exception.SSHException:
+            channel.close()
+            self.pty = False
+            return None
+        channel.exec_command(command)
+        return channel
+
+    def run_pty(self, args, cwd=None):
+        """
+        Runs args interactively in cwd with the local terminal attached.
+        Gives the exit status, None when the server would not give us a
+        terminal and the command did not run.
+        """
+        raise NotImplementedError()
+
+    def _ensure_channel(self):
         if self.ssh_channel is None or self.ssh_channel.exit_status_ready():
+            self._fail_pending(SshRpcError("channel closed"))
             self._open_channel()
+
+    def _close_channel(self):
+        self.ssh_channel.shutdown(2)
+        self.ssh_channel = None
+        self._fail_pending(SshRpcError("channel closed"))
+
+    def _encode(self, rpc):
+        if self.framing == framing.FRAMES:
+            return framing.frame(framing.FRAME_JSON, rpc)
+        return "{rpc}\n".format(rpc=rpc)
+
+    def _encode_chunk(self, chunk):
+        if self.framing == framing.FRAMES:
+            return framing.frame(framing.FRAME_STREAM, chunk)
+        return "{size:x}\n{chunk}".format(size=len(chunk), chunk=chunk)
+
+    def _sendall(self, rpc):
+        self._ensure_channel()
         with self.send_lock:
-            self.ssh_channel.sendall("{rpc}\n".format(rpc=rpc))
+            self.ssh_channel.sendall(self._encode(rpc))
 
-    def call(self, method, args):
+    def _fail_pending(self, exception):
+        with self._pending_lock:
+            pending = self._pending.values()
+            self._pending = {}
+        for future in pending:
+            future.set_exception(exception)
+
+    def _print_stdout(self, data):
+        log.white(data, f=sys.stdout)
+
+    def _print_progress(self, info):
+        if info["job"] is None or info["job"] in self.followed_jobs or info["state"] != "running":
+            log.white(info["message"])
+
+    def _dispatch(self, line):
+        resp = self.codec.loads(line)
+        if type(resp) == list:
+            # Batch response
+            for entry in resp:
+                self._resolve(entry)
+        elif "stdout" in resp:
+            self._print_stdout(resp["stdout"])
+        elif "stderr" in resp:
+            log.white(resp["stderr"], f=sys.stderr)
+        elif "progress" in resp:
+            self._print_progress(resp["progress"])
+        elif "result" in resp:
+            self._resolve(resp)
+
+    def _resolve(self, resp, raw=False):
+        with self._pending_lock:
+            future = self._pending.pop(resp.get("id"), None)
+        if future is not None:
+            if future.method in framing.BINARY_METHODS and resp.get("result") is not None and not raw:
+                resp["result"] = base64.standard_b64decode(resp["result"])
+            future.set_response(resp)
+
+    def _feed(self, data):
+        self._recv_buf.feed(data)
+        while True:
+            if self.framing == framing.FRAMES:
+                frame = self._frames.read(self._recv_buf)
+                if frame is None:
+                    break
+                kind, payload = frame
+                if kind == framing.FRAME_BINARY:
+                    rpc_id, = framing.BINARY_ID.unpack_from(payload)
+                    self._resolve({"id": rpc_id, "result": payload[framing.BINARY_ID.size:]}, raw=True)
+                    continue
+                self._dispatch(payload)
+            else:
+                line = self._recv_buf.readline()
+                if line is None:
+                    # Not complete yet.
+                    break
+                self._dispatch(line)
+
+    def _recv(self):
+        if self.ssh_channel.recv_ready():
+            self._feed(self.ssh_channel.recv(RECV_SIZE))
+        if self.ssh_channel.recv_stderr_ready():
+            log.white("{}".format(self.ssh_channel.recv_stderr(4096)))
+        if self.ssh_channel.exit_status_ready():
+            raise SshRpcError()
+
+    def _wait(self, future):
+        """
+        Reads the channel until future is resolved, platform specific since
+        stdin is forwarded to the server while waiting.
+        """
         raise NotImplementedError()
 
+    def _wait_for(self, future):
+        if self._reader is None:
+            self._wait(future)
+        else:
+            # The reader thread resolves it. Waiting with a timeout keeps us
+            # responsive to KeyboardInterrupt.
+            while not future._done.wait(0.1):
+                pass
+
+    def _reader_loop(self):
+        try:
+            while not self._reader_stop.is_set():
+                rl, _, _ = select.select([self.ssh_channel], [], [], 0.1)
+                if len(rl) > 0:
+                    self._recv()
+        except SshRpcError as e:
+            self._fail_pending(e)
+
+    @contextlib.contextmanager
+    def multiplexed(self):
+        """
+        Lets many calls be in flight at once on the channel. Responses are
+        read by a background thread and resolve the futures from call_async
+        in whatever order they arrive. Stdin is not forwarded meanwhile, so
+        interactive calls (run) don't belong in here.
+        """
+        if self._reader is not None:
+            yield self
+            return
+        self._ensure_channel()
+        self._reader_stop.clear()
+        self._reader = threading.Thread(target=self._reader_loop)
+        self._reader.daemon = True
+        self._reader.start()
+        try:
+            yield self
+        finally:
+            self._reader_stop.set()
+            self._reader.join()
+            self._reader = None
+
+    def _register(self, method, args, callback=None):
+        with SshJsonRpc.rpc_id_lock:
+            rpc_id = SshJsonRpc.rpc_id
+            SshJsonRpc.rpc_id += 1
+        future = SshRpcFuture(rpc_id, method, self._wait_for, callback)
+        self._ensure_channel()
+        with self._pending_lock:
+            self._pending[rpc_id] = future
+        return future
+
+    def call_async(self, method, args=None, callback=None):
+        future = self._register(method, args, callback)
+        self._sendall(self.rpc(method, args, future.rpc_id))
+        return future
+
+    def call_batch(self, calls):
+        """
+        Sends calls, a list of (method, args), as one JSON-RPC batch. The
+        server runs them in order and answers with a single array, so the
+        whole batch costs one round trip. Returns a future per call.
+        """
+        futures = [self._register(method, args) for method, args in calls]
+        self._sendall(self.codec.dumps([{"id": future.rpc_id,
+                                         "method": future.method,
+                                         "params": args}
+                                        for future, (_, args) in zip(futures, calls)]))
+        return futures
+
+    def call_stream(self, method, args, chunks):
+        """
+        Calls a streaming method, the raw byte strings from chunks follow the
+        request on the channel without any reply in between. The channel is
+        blocking meanwhile so the SSH window does the flow control.
+        """
+        future = self._register(method, args)
+        rpc_json = self.rpc(method, args, future.rpc_id)
+        with self.send_lock:
+            self.ssh_channel.settimeout(None)
+            try:
+                self.ssh_channel.sendall(self._encode(rpc_json))
+                try:
+                    for chunk in chunks:
+                        if len(chunk) > 0:
+                            self.ssh_channel.sendall(self._encode_chunk(chunk))
+                finally:
+                    # The server waits for the end of the stream, even if
+                    # producing the chunks failed.
+                    self.ssh_channel.sendall(self._encode_chunk(""))
+            finally:
+                self.ssh_channel.setblocking(0)
+        return future
+
+    def call(self, method, args):
+        return self.call_async(method, args).result()
+
     def _notify(self, **kwargs):
         if len(kwargs) > 0:
             notify_dict = {"id": None}
             notify_dict.update(kwargs)
-            rpc_json = json.dumps(notify_dict)
+            rpc_json = self.codec.dumps(notify_dict)
             self._sendall(rpc_json)
 
-    def rpc(self, method, params):
-        rpc_json = json.dumps({"id": SshJsonRpc.rpc_id,
-                               "method": method,
-                               "params": params})
-        SshJsonRpc.rpc_id += 1
-        return rpc_json
+    def rpc(self, method, params, rpc_id):
+        return self.codec.dumps({"id": rpc_id,
+                                 "method": method,
+                                 "params": params})
 
     def stdin(self, data):
-        return json.dumps({"id":None,
-                           "stdin": data})
+        return self.codec.dumps({"id":None,
+                                 "stdin": data})
 
     def __getattr__(self, item):
         def wrapper(args=None):
@@ -1,24 +1,39 @@
+import errno
 import select
 import os
-import json
 import os.path
+import signal
+import struct
 import sys
 import fcntl
 import termios
+import tty
 from sshrpcutil import *
 import sshjsonrpc
 
-try:
-    import logger as log
-except ImportError:
-    from jsc import logger as log
+PTY_READ_SIZE = 2**15
+
+
+def terminal_size(fd):
+    """
+    (columns, rows) of the terminal on fd, 80x24 when it is not one.
+    """
+    try:
+        rows, columns, _, _ = struct.unpack("hhhh", fcntl.ioctl(fd, termios.TIOCGWINSZ, "\0" * 8))
+    except IOError:
+        return 80, 24
+    if rows <= 0 or columns <= 0:
+        return 80, 24
+    return columns, rows
+
+
+def write_all(fd, data):
+    while len(data) > 0:
+        data = data[os.write(fd, data):]
 
 
 class SshJsonRpcPosix(sshjsonrpc.SshJsonRpc):
-    def call(self, method, args):
-        rpc_cmd = self.rpc(method, args)
-        self._sendall(rpc_cmd)
-        recv_buf = ""
+    def _wait(self, future):
         stdin_fd = os.dup(sys.stdin.fileno())
         flags = fcntl.fcntl(stdin_fd, fcntl.F_GETFL, 0)
         flags |= os.O_NONBLOCK
@@ -35,42 +50,65 @@ class SshJsonRpcPosix(sshjsonrpc.SshJsonRpc):
             new[3] &= ~termios.ICANON  # 3 == 'lflags'
             tcsetattr_flags = termios.TCSADRAIN
             termios.tcsetattr(stdin_fd, tcsetattr_flags, new)
-            while True:
+            while not future.done():
                 rl, _, xl = select.select([self.ssh_channel, stdin_fd], [], [])
                 if self.ssh_channel in rl:
-                    if self.ssh_channel.recv_ready():
-                        new_data = self.ssh_channel.recv(4096)
-                        recv_buf += new_data
-                        if "\n" in recv_buf:
-                            lines = recv_buf.split("\n")
-                            # Last line is either not complete or empty string.
-                            # ("x\nnot compl".split("\n") => ['x', 'not compl'] or "x\n".split("\n") => ['x', ''])
-                            # so we put it back in recv_buf for next iteration
-                            recv_buf = lines.pop()
-                            for line in lines:
-                                resp = json.loads(line)
-                                if "stdout" in resp:
-                                    log.white(resp["stdout"], f=sys.stdout)
-                                elif "stderr" in resp:
-                                    log.white(resp["stderr"], f=sys.stderr)
-                                elif "result" in resp:
-                                    if resp['error'] is not None:
-                                        raise SshRpcCallError(resp['error']['message'])
-                                    return resp["result"]
-                    if self.ssh_channel.recv_stderr_ready():
-                        log.white("{}".format(self.ssh_channel.recv_stderr(4096)))
-                    if self.ssh_channel.exit_status_ready():
-                        raise SshRpcError()
+                    self._recv()
                 if stdin_fd in rl:
                     new_stdin_data = tty.read()
                     self._sendall(self.stdin(new_stdin_data))
         except (KeyboardInterrupt, SshRpcError):
             # stdin_g.kill()
-            self.ssh_channel.shutdown(2)
-            self.ssh_channel = None
+            self._close_channel()
             raise KeyboardInterrupt()
         finally:
             termios.tcsetattr(stdin_fd, tcsetattr_flags, old)
             tty.flush()  # issue7208
             flags &= ~os.O_NONBLOCK
             fcntl.fcntl(stdin_fd, fcntl.F_SETFL, flags)
+
+    def run_pty(self, args, cwd=None):
+        stdin_fd = sys.stdin.fileno()
+        stdout_fd = sys.stdout.fileno()
+        channel = self._open_pty(args, cwd, *terminal_size(stdout_fd))
+        if channel is None:
+            return None
+        sys.stdout.flush()
+        is_tty = os.isatty(stdin_fd)
+        resized = []
+        old_winch = signal.signal(signal.SIGWINCH, lambda signum, frame: resized.append(True))
+        old = termios.tcgetattr(stdin_fd) if is_tty else None
+        # Keystrokes go over as they are, the remote terminal does the echo
+        # and line editing. Stdin stops being read once it is at its end.
+        readers = [channel, stdin_fd]
+        try:
+            if is_tty:
+                tty.setraw(stdin_fd, termios.TCSADRAIN)
+            while True:
+                if len(resized) > 0:
+                    del resized[:]
+                    channel.resize_pty(*terminal_size(stdout_fd))
+                try:
+                    rl, _, _ = select.select(readers, [], [])
+                except select.error as e:
+                    # The window size changed.
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if channel in rl:
+                    data = channel.recv(PTY_READ_SIZE)
+                    if len(data) == 0:
+                        break
+                    write_all(stdout_fd, data)
+                if stdin_fd in rl:
+                    data = os.read(stdin_fd, PTY_READ_SIZE)
+                    if len(data) == 0:
+                        readers.remove(stdin_fd)
+                    else:
+                        channel.sendall(data)
+            return channel.recv_exit_status()
+        finally:
+            if is_tty:
+                termios.tcsetattr(stdin_fd, termios.TCSADRAIN, old)
+            signal.signal(signal.SIGWINCH, old_winch)
+            channel.close()
@@ -1,15 +1,13 @@
+import contextlib
 import select
-import json
 import sys
 from multiprocessing import Process, Event
 import socket
 from sshrpcutil import *
 import sshjsonrpc
 import msvcrt
-try:
-    import logger as log
-except ImportError:
-    from jsc import logger as log
+
+PTY_READ_SIZE = 2**15
 
 
 def input_reader(port, event):
@@ -25,7 +23,16 @@ def input_reader(port, event):
 
 
 class SshJsonRpcWin(sshjsonrpc.SshJsonRpc):
-    def call(self, method, args):
+    def _print_stdout(self, data):
+        sys.stdout.write(data)
+        sys.stdout.flush()
+
+    @contextlib.contextmanager
+    def _input_socket(self):
+        """
+        Keys pressed come in on the yielded socket, msvcrt can't be selected
+        on so a process reads them and forwards them over localhost.
+        """
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         for port in range(14000, 62000):
             try:
@@ -39,48 +46,46 @@ class SshJsonRpcWin(sshjsonrpc.SshJsonRpc):
         input_thread.start()
         (input_socket, _) = server_socket.accept()
         input_socket.setblocking(0)
-        rpc_cmd = self.rpc(method, args)
-        self._sendall(rpc_cmd)
-        recv_buf = ""
         try:
-            while True:
-                rl, _, xl = select.select([self.ssh_channel, input_socket], [], [])
-                if self.ssh_channel in rl:
-                    if self.ssh_channel.recv_ready():
-                        new_data = self.ssh_channel.recv(4096)
-                        recv_buf += new_data
-                        if "\n" in recv_buf:
-                            lines = recv_buf.split("\n")
-                            # Last line is either not complete or empty string.
-                            # ("x\nnot compl".split("\n") => ['x', 'not compl'] or "x\n".split("\n") => ['x', ''])
-                            # so we put it back in recv_buf for next iteration
-                            recv_buf = lines.pop()
-                            for line in lines:
-                                resp = json.loads(line)
-                                if "stdout" in resp:
-                                    sys.stdout.write(resp["stdout"])
-                                    sys.stdout.flush()
-                                elif "stderr" in resp:
-                                    log.white(resp["stderr"], f=sys.stderr)
-                                elif "result" in resp:
-                                    if resp['error'] is not None:
-                                        raise SshRpcCallError(resp['error']['message'])
-                                    #print("ending",method)
-                                    return resp["result"]
-                    if self.ssh_channel.recv_stderr_ready():
-                        log.white("{}".format(self.ssh_channel.recv_stderr(4096)))
-                    if self.ssh_channel.exit_status_ready():
-                        raise SshRpcError()
-                if input_socket in rl:
-                    new_stdin_data = input_socket.recv(1024)
-                    self._sendall(self.stdin(new_stdin_data))
-        except (KeyboardInterrupt, SshRpcError):
-            self.ssh_channel.shutdown(2)
-            self.ssh_channel = None
-            raise KeyboardInterrupt()
+            yield input_socket
         finally:
             ev.set()
             input_thread.terminate()
             input_thread.join()
             del input_socket
             del server_socket
+
+    def _wait(self, future):
+        with self._input_socket() as input_socket:
+            try:
+                while not future.done():
+                    rl, _, xl = select.select([self.ssh_channel, input_socket], [], [])
+                    if self.ssh_channel in rl:
+                        self._recv()
+                    if input_socket in rl:
+                        new_stdin_data = input_socket.recv(1024)
+                        self._sendall(self.stdin(new_stdin_data))
+            except (KeyboardInterrupt, SshRpcError):
+                self._close_channel()
+                raise KeyboardInterrupt()
+
+    def run_pty(self, args, cwd=None):
+        # No window size changes to follow here, the console has no SIGWINCH.
+        channel = self._open_pty(args, cwd, 80, 24)
+        if channel is None:
+            return None
+        try:
+            with self._input_socket() as input_socket:
+                while True:
+                    rl, _, _ = select.select([channel, input_socket], [], [])
+                    if channel in rl:
+                        data = channel.recv(PTY_READ_SIZE)
+                        if len(data) == 0:
+                            break
+                        sys.stdout.write(data)
+                        sys.stdout.flush()
+                    if input_socket in rl:
+                        channel.sendall(input_socket.recv(PTY_READ_SIZE))
+            return channel.recv_exit_status()
+        finally:
+            channel.close()
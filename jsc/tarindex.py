@@ -0,0 +1,171 @@
+"""
+Index of the members of a tar stream, made while a backup is written, so
+the backup can be listed and single files taken out of it without reading
+the whole archive.
+
+Every member is recorded with the offsets of its first header, including
+long name and pax headers, and of the end of its data in the uncompressed
+stream. Cutting those ranges out and appending the end of archive blocks
+gives a tar that extracts just those members. The dumpdir members of GNU
+incremental archives keep the list of what their dir contained.
+"""
+try:
+    import chunkstore
+except ImportError:
+    from jsc import chunkstore
+
+TAR_BLOCK = 512
+END_OF_ARCHIVE = "\0" * (2 * TAR_BLOCK)
+# Types whose data describes the next member or the archive.
+EXTENSION_TYPES = ("L", "K", "x", "g")
+
+
+def padded(size):
+    return (size + TAR_BLOCK - 1) // TAR_BLOCK * TAR_BLOCK
+
+
+def parse_pax(data):
+    records = {}
+    while len(data) > 0:
+        length = data.split(" ", 1)[0]
+        record = data[len(length) + 1:int(length)]
+        data = data[int(length):]
+        if "=" in record:
+            key, value = record.rstrip("\n").split("=", 1)
+            records[key] = value
+    return records
+
+
+class TarIndexer():
+    """
+    Fed the tar stream in pieces of any size, collects its members in
+    members.
+    """
+    def __init__(self):
+        self.members = []
+        self.incremental = False
+        self.buf = ""
+        # Read position in buf, slicing buf per member would copy it.
+        self.buf_pos = 0
+        self.pos = 0
+        self.skip = 0
+        # Header of a member whose data has to be read, not skipped.
+        self.pending = None
+        self.member_start = None
+        self.long_name = None
+
+    def _left(self):
+        return len(self.buf) - self.buf_pos
+
+    def _consume(self, size):
+        data = self.buf[self.buf_pos:self.buf_pos + size]
+        self.buf_pos += len(data)
+        self.pos += len(data)
+        return data
+
+    def feed(self, data):
+        self.buf = self.buf[self.buf_pos:] + data
+        self.buf_pos = 0
+        while True:
+            if self.skip > 0:
+                skipped = min(self.skip, self._left())
+                self.buf_pos += skipped
+                self.pos += skipped
+                self.skip -= skipped
+                if self.skip > 0:
+                    return
+            if self.pending is not None:
+                header, header_pos = self.pending
+                size = chunkstore.tar_member_size(header)
+                if self._left() < padded(size):
+                    return
+                self.pending = None
+                self._member(header, header_pos, self._consume(padded(size))[:size])
+                continue
+            if self._left() < TAR_BLOCK:
+                return
+            header_pos = self.pos
+            header = self._consume(TAR_BLOCK)
+            if header.count("\0") == TAR_BLOCK:
+                continue
+            if self.member_start is None:
+                self.member_start = header_pos
+            if header[156] in EXTENSION_TYPES or header[156] == "D":
+                self.pending = (header, header_pos)
+            else:
+                self._member(header, header_pos, None)
+                self.skip = padded(chunkstore.tar_member_size(header))
+
+    def _member(self, header, header_pos, data):
+        typeflag = header[156]
+        if typeflag == "L":
+            self.long_name = data.rstrip("\0")
+            return
+        if typeflag == "x":
+            self.long_name = parse_pax(data).get("path", self.long_name)
+            return
+        if typeflag == "K":
+            return
+        if typeflag == "g":
+            self.member_start = None
+            return
+        name = self.long_name
+        if name is None:
+            name = header[:100].split("\0", 1)[0]
+            if header[257:263] == "ustar\0":
+                prefix = header[345:500].split("\0", 1)[0]
+                if len(prefix) > 0:
+                    name = prefix + "/" + name
+        mtime = header[136:148].strip(" \0")
+        size = chunkstore.tar_member_size(header)
+        member = {"name": name.rstrip("/"),
+                  "type": typeflag,
+                  "size": size if typeflag in ("0", "\0", "7") else 0,
+                  "mtime": int(mtime, 8) if len(mtime) > 0 else 0,
+                  "start": self.member_start,
+                  "end": header_pos + TAR_BLOCK + padded(size)}
+        if typeflag == "D":
+            # What the dir held, each name after a Y (in this archive),
+            # N (unchanged) or D (a dir) flag.
+            self.incremental = True
+            member["contents"] = [entry for entry in data.split("\0") if len(entry) > 1]
+        self.members.append(member)
+        self.member_start = None
+        self.long_name = None
+
+
+class TeeReader():
+    """
+    File like object that hands what is read from f to an indexer.
+    """
+    def __init__(self, f, indexer):
+        self.f = f
+        self.indexer = indexer
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.indexer.feed(data)
+        return data
+
+
+def read_ranges(blocks, load, ranges):
+    """
+    Yields the bytes of the sorted (start, end) ranges of a stream stored
+    in blocks, (start, end, key) tuples in order, where load(key) gives a
+    block's bytes. Only the blocks that overlap a range are loaded and
+    blocks after the last range are not asked for.
+    """
+    blocks = iter(blocks)
+    block = None
+    for start, end in ranges:
+        while start < end:
+            if block is None or block[1] <= start:
+                found = next(blocks, None)
+                if found is None:
+                    return
+                block_start, block_end, key = found
+                block = (block_start, block_end, load(key)) if block_end > start else None
+                continue
+            piece_end = min(end, block[1])
+            yield block[2][start - block[0]:piece_end - block[0]]
+            start = piece_end
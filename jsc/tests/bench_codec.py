@@ -0,0 +1,68 @@
+"""
+Per message cost of the codecs on the rpc channel, for the messages that
+make up most of the traffic. Codecs that are not installed are skipped.
+
+    python -m jsc.tests.bench_codec
+"""
+import base64
+import os
+import timeit
+
+import jsc.codec
+import jsc.server
+
+
+def state_dict():
+    software_list = {"package": {}, "gd": {}}
+    for i in range(40):
+        software_list["package"]["package-{i}".format(i=i)] = {"version": "1.{i}.0-1".format(i=i)}
+    for i in range(5):
+        software_list["gd"]["/app/code/src/repo-{i}".format(i=i)] = {
+            "commit": "3f2a9c8e4b1d6f7a0c5e9b2d8f4a1c6e7b0d3f5a",
+            "repo": "https://github.com/example/repo-{i}.git".format(i=i)}
+    return {"software_list": software_list, "name": "example", "is_dev": False}
+
+
+def messages():
+    chunk = os.urandom(2**16)
+    output = ("".join("line {i} of the build output\r\n".format(i=i) for i in range(3000)))[:jsc.server.OUTPUT_FLUSH_SIZE]
+    state = state_dict()
+    yield "do_file_append 64k", {"id": 1, "method": "do_file_append",
+                                 "params": {"path": "/app/code/.jsc/new-recipe/src/f",
+                                            "content": base64.standard_b64encode(chunk)}}
+    # What msgpack could carry instead, the chunk without base64.
+    yield "do_file_append 64k raw", {"id": 1, "method": "do_file_append",
+                                     "params": {"path": "/app/code/.jsc/new-recipe/src/f",
+                                                "content": chunk}}
+    yield "rc_put request", {"id": 2, "method": "rc_put",
+                             "params": {"args": ["/app/code/conf", "listen 80;\n"], "state": state}}
+    yield "rc state response", {"id": 2, "result": state, "error": None}
+    yield "stdout 64k", {"id": None, "stdout": output.decode("utf-8")}
+    yield "stdout echo", {"id": None, "stdout": u"a"}
+
+
+def bench(codec, msg, rounds=5):
+    data = codec.dumps(msg)
+    number = max(1, min(20000, 2**24 // max(1, len(data))))
+    encode = min(timeit.Timer(lambda: codec.dumps(msg)).repeat(rounds, number)) / number
+    decode = min(timeit.Timer(lambda: codec.loads(data)).repeat(rounds, number)) / number
+    return len(data), encode, decode
+
+
+def main():
+    print("{shape:24} {codec:8} {size:>8} {encode:>11} {decode:>11}".format(
+        shape="message", codec="codec", size="bytes", encode="encode us", decode="decode us"))
+    for shape, msg in messages():
+        for name in jsc.codec.available_codecs():
+            codec = jsc.codec.codec(name)
+            try:
+                size, encode, decode = bench(codec, msg)
+            except (TypeError, ValueError, OverflowError):
+                # Raw bytes don't go in json.
+                continue
+            print("{shape:24} {codec:8} {size:8d} {encode:11.1f} {decode:11.1f}".format(
+                shape=shape, codec=name, size=size, encode=encode * 1e6, decode=decode * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,17 @@ import json
 import platform
 import time
 import subprocess
+import sys
 import pwd
 import pyparsing
 import signal
+import hashlib
+import StringIO
+import tarfile
+import gzip
+import tempfile
+import random
+import threading
 
 import fake_sync_endpoint
 
@@ -16,6 +24,14 @@ import jsc.client
 import jsc.server
 import jsc.recipe
 import jsc.rparser as rp
+import jsc.rlexer
+import jsc.delta
+import jsc.jscignore
+import jsc.chunkstore
+import jsc.archive
+import jsc.deltree
+import jsc.framing
+import jsc.codec
 
 
 CODE_DIR = jsc.server.CODE_DIR
@@ -46,6 +62,11 @@ def touch_file(file_path):
         f.write("")
 
 
+def write_file(file_path, content):
+    with open(file_path, "w") as f:
+        f.write(content)
+
+
 def add_garbage():
     touch_dir(os.path.join(CODE_DIR, "garb"))
     touch_dir(os.path.join(CODE_DIR, ".pacman", "db"))
@@ -151,6 +172,14 @@ class TestClient(unittest.TestCase):
             "--code": False,
             "--state": True
         })
+        add_garbage()
+        self._rpc.do_clean({
+            "--all": False,
+            "--code": False,
+            "--state": False,
+            "--background": True
+        })
+        assert is_code_dir_clean()
 
     def test_do_sync(self):
         self.add_env("env_assembly.json")
@@ -215,6 +244,127 @@ class TestClient(unittest.TestCase):
                 "id": b_id
             })
 
+    def test_backup_incremental(self):
+        self.add_env("env_assembly.json")
+        backup_new = {"new": True, "du": False, "ls": False, "rm": False}
+        touch_dir(os.path.join(CODE_DIR, "dir"))
+        touch_file(os.path.join(CODE_DIR, "dir", "deleted"))
+        touch_file(os.path.join(CODE_DIR, "top"))
+        self._rpc.do_backup(backup_new)
+        os.remove(os.path.join(CODE_DIR, "dir", "deleted"))
+        os.remove(os.path.join(CODE_DIR, "top"))
+        touch_file(os.path.join(CODE_DIR, "dir", "added"))
+        self._rpc.do_backup(backup_new)
+        assert jsc.server.backup_parent(jsc.server.backup_dir_by_id("2")) == "1"
+        self.do_clean_all()
+        self._rpc.do_revert({"id": "2"})
+        assert os.listdir(os.path.join(CODE_DIR, "dir")) == ["added"]
+        assert not os.path.exists(os.path.join(CODE_DIR, "top"))
+        try:
+            self._rpc.do_backup({"new": False, "du": False, "ls": False, "rm": True, "id": "1"})
+            # shouldn't reach this
+            assert False
+        except jsc.client.SshRpcCallError:
+            pass
+        self._rpc.do_backup({"new": False, "du": False, "ls": False, "rm": True, "id": "1", "--with-dependents": True})
+        assert jsc.server.backup_dirs() == {}
+
+    def test_backup_catalog(self):
+        self.add_env("env_assembly.json")
+        add_garbage()
+        backup_ls = {"new": False, "du": False, "ls": True, "rm": False}
+        self._rpc.do_backup({"new": True, "du": False, "ls": False, "rm": False})
+        with open(os.path.join(BACKUPS_DIR, "catalog.json")) as f:
+            assert json.load(f)["1"]["raw_size"] > 0
+        listed = self._rpc.do_backup(backup_ls)
+        os.remove(os.path.join(BACKUPS_DIR, "catalog.json"))
+        assert self._rpc.do_backup(backup_ls) == listed
+        self._rpc.do_backup({"new": False, "du": False, "ls": False, "rm": True, "id": "1"})
+        assert self._rpc.do_backup(backup_ls) == []
+
+    def test_backup_dedup_format(self):
+        self.add_env("env_assembly.json")
+        add_garbage()
+        backup_new = {"new": True, "du": False, "ls": False, "rm": False, "--dedup": True}
+        try:
+            self._rpc.do_backup(dict(backup_new, **{"--compress": "zstd"}))
+            assert False, "dedup chunks are gzip only"
+        except jsc.client.SshRpcCallError:
+            pass
+        self._rpc.do_backup(dict(backup_new, **{"--compress": "gzip", "--level": "1"}))
+        assert len(self._rpc.do_backup({"new": False, "du": False, "ls": True, "rm": False})) == 1
+
+    def test_backup_pull_push(self):
+        self.add_env("env_assembly.json")
+        add_garbage()
+        self._rpc.do_backup({"new": True, "du": False, "ls": False, "rm": False, "--full": True})
+        # The default name keeps the suffix of the format the assembly wrote.
+        path = jsc.client.rpc_backup_pull(self._rpc, "1")
+        with open(path, "rb") as f:
+            data = f.read()
+        with open(path + ".part", "wb") as f:
+            f.write(data[:100])
+        # Resumes from the .part file.
+        assert jsc.client.rpc_backup_pull(self._rpc, "1", path) == path
+        with open(path, "rb") as f:
+            assert f.read() == data
+        assert jsc.client.rpc_backup_push(self._rpc, path) == "2"
+        os.remove(path)
+
+    def test_backup_show_revert_path(self):
+        self.add_env("env_assembly.json")
+        backup_new = {"new": True, "du": False, "ls": False, "rm": False}
+        touch_dir(os.path.join(CODE_DIR, "dir"))
+        write_file(os.path.join(CODE_DIR, "dir", "kept"), "1")
+        write_file(os.path.join(CODE_DIR, "dir", "changed"), "1")
+        self._rpc.do_backup(backup_new)
+        write_file(os.path.join(CODE_DIR, "dir", "changed"), "2")
+        self._rpc.do_backup(backup_new)
+        shown = self._rpc.do_backup({"new": False, "du": False, "ls": False, "rm": False, "show": True, "id": "2", "--path": "dir/*"})
+        assert [line.split()[-1] for line in shown] == ["/app/code/dir/changed", "/app/code/dir/kept"]
+        write_file(os.path.join(CODE_DIR, "dir", "kept"), "clobbered")
+        write_file(os.path.join(CODE_DIR, "dir", "changed"), "clobbered")
+        self._rpc.do_revert({"id": "2", "--path": "dir/kept"})
+        with open(os.path.join(CODE_DIR, "dir", "kept")) as f:
+            assert f.read() == "1"
+        with open(os.path.join(CODE_DIR, "dir", "changed")) as f:
+            assert f.read() == "clobbered"
+        self._rpc.do_revert({"id": "2", "--path": "/app/code/dir"})
+        with open(os.path.join(CODE_DIR, "dir", "changed")) as f:
+            assert f.read() == "2"
+
+    def test_backup_background_job(self):
+        self.add_env("env_assembly.json")
+        add_garbage()
+        job = self._rpc.do_backup({"new": True, "du": False, "ls": False, "rm": False, "--background": True})["job"]
+        assert self._rpc.do_jobs_wait({"id": job})["state"] == "done"
+        assert [info["state"] for info in self._rpc.do_jobs()] == ["done"]
+        assert len(self._rpc.do_backup({"new": False, "du": False, "ls": True, "rm": False})) == 1
+        job = self._rpc.do_backup({"new": True, "du": False, "ls": False, "rm": False, "--background": True})["job"]
+        self._rpc.do_jobs_cancel({"id": job})
+        assert self._rpc.do_jobs_wait({"id": job})["state"] in ("cancelled", "done")
+        assert not os.path.exists(os.path.join(BACKUPS_DIR, "new-backup"))
+        # The job holds the lock as soon as it is started, what comes right
+        # after it is refused instead of getting in first.
+        started = self._rpc.call_async("do_backup", {"new": True, "du": False, "ls": False, "rm": False, "--background": True})
+        rm = self._rpc.call_async("do_backup", {"new": False, "du": False, "ls": False, "rm": True, "id": "1"})
+        assert self._rpc.do_jobs_wait({"id": started.result()["job"]})["state"] == "done"
+        assert isinstance(rm.exception(), jsc.client.SshRpcCallError)
+
+    def test_backup_retention(self):
+        self.add_env("env_assembly.json")
+        add_garbage()
+        backup = {"new": False, "du": False, "ls": False, "rm": False}
+        self._rpc.do_backup(dict(backup, retention=True, **{"--keep-last": "2"}))
+        for i in range(3):
+            touch_file(os.path.join(CODE_DIR, "garb", str(i)))
+            self._rpc.do_backup(dict(backup, new=True, **{"--full": True}))
+        assert [line.split(":")[0] for line in self._rpc.do_backup(dict(backup, ls=True))] == ["2", "3"]
+        self._rpc.do_backup(dict(backup, retention=True, **{"--keep-last": "1"}))
+        assert self._rpc.do_backup(dict(backup, prune=True, **{"--dry-run": True})) == ["would remove backups 2"]
+        self._rpc.do_backup(dict(backup, prune=True))
+        assert [line.split(":")[0] for line in self._rpc.do_backup(dict(backup, ls=True))] == ["3"]
+
     def test_do_deploy_reset_check(self):
         assert self._rpc.do_deploy_reset_check() is None
         add_garbage()
@@ -258,16 +408,88 @@ class TestClient(unittest.TestCase):
         # test for crashes
         self._rpc.do_status()
 
+    def test_call_async(self):
+        self.add_env("env_assembly.json")
+        with self._rpc.multiplexed():
+            check_init = self._rpc.call_async("do_check_init")
+            status = self._rpc.call_async("do_status")
+            env = self._rpc.call_async("do_env")
+            bad = self._rpc.call_async("do_nonexisting")
+            assert env.result()["ident"]["container"]["is_assembly"]
+            assert "total_backups" in status.result()
+            assert check_init.result()["needs_init"] is False
+            assert isinstance(bad.exception(), jsc.client.SshRpcCallError)
+
+    def test_call_batch(self):
+        self.add_env("env_assembly.json")
+        init, check_init, bad, env = self._rpc.call_batch([("do_init", None),
+                                                           ("do_check_init", None),
+                                                           ("do_nonexisting", None),
+                                                           ("do_env", None)])
+        assert init.result() is None
+        assert check_init.result()["needs_init"] is False
+        assert isinstance(bad.exception(), jsc.client.SshRpcCallError)
+        assert isinstance(env.result(), dict)
+
     def test_do_symlink(self):
         self._rpc.do_symlink({"path": "/app/code/sym_tmp", "target": "/tmp"})
 
     def test_do_mkdir(self):
         self._rpc.do_mkdir({"path": "/app/code/new_dir"})
 
+    def test_do_mktree(self):
+        self._rpc.do_mktree({"dirs": ["/app/code/new_dir", "/app/code/new_dir/sub"],
+                             "symlinks": [["/app/code/new_dir/sym_tmp", "/tmp"]]})
+        assert os.path.isdir("/app/code/new_dir/sub")
+        assert os.readlink("/app/code/new_dir/sym_tmp") == "/tmp"
+
     def test_do_file_append(self):
         self._rpc.do_file_append({"path": "/app/code/new_file", "content": "content1"})
         self._rpc.do_file_append({"path": "/app/code/new_file", "content": "content2"})
 
+    def test_do_file_stream(self):
+        content = os.urandom(2**18)
+        resp = self._rpc.call_stream("do_file_stream", {"path": "/app/code/new_file"}, [content[:1000], content[1000:]]).result()
+        assert resp["size"] == len(content)
+        with open("/app/code/new_file", "rb") as f:
+            assert f.read() == content
+        try:
+            self._rpc.call_stream("do_file_stream", {"path": "/app/code/no/such/dir"}, [content]).result()
+            # shouldn't reach this
+            assert False
+        except jsc.client.SshRpcCallError:
+            pass
+
+    def test_put_recipe_archive(self):
+        src = "/tmp/jsc_test_archive_src"
+        touch_dir(os.path.join(src, "dir"))
+        touch_file(os.path.join(src, "Jumpstart-Recipe"))
+        touch_file(os.path.join(src, "dir", "file"))
+        os.chmod(os.path.join(src, "dir", "file"), 0o750)
+        os.symlink("dir/file", os.path.join(src, "link"))
+        touch_file(os.path.join(src, "ignored"))
+        with open(os.path.join(src, ".jscignore"), "w") as f:
+            f.write("ignored\n")
+        self._rpc.do_deploy_reset_check()
+        jsc.client.rpc_put_recipe_archive(self._rpc, src, should_skip=jsc.client.get_filter(os.path.join(src, ".jscignore")))
+        assert os.path.isfile(NEW_RECIPE_SCRIPT)
+        assert os.stat(os.path.join(NEW_RECIPE_SRC, "dir", "file")).st_mode & 0o777 == 0o750
+        assert os.readlink(os.path.join(NEW_RECIPE_SRC, "link")) == "dir/file"
+        assert not os.path.exists(os.path.join(NEW_RECIPE_SRC, "ignored"))
+        shutil.rmtree(src)
+
+    def test_upload_cache_fetch(self):
+        content = os.urandom(2**12)
+        sha1 = hashlib.sha1(content).hexdigest()
+        self._rpc.call_stream("do_file_stream", {"path": "/app/code/new_file", "cache": True}, [content]).result()
+        fetched = self._rpc.do_upload_cache_fetch({"files": [["/app/code/dir/cached", sha1, 0o750],
+                                                             ["/app/code/dir/missing", hashlib.sha1("other").hexdigest(), 0o644]]})
+        assert fetched == ["/app/code/dir/cached"]
+        with open("/app/code/dir/cached", "rb") as f:
+            assert f.read() == content
+        assert os.stat("/app/code/dir/cached").st_mode & 0o7777 == 0o750
+        assert "upload cache: 1 files" in self._rpc.do_backup({"new": False, "du": True, "rm": False})[-1]
+
     # recipe functions
 
     def test_rc_name(self):
@@ -353,6 +575,28 @@ class TestClient(unittest.TestCase):
         with open(f_replace) as f:
             assert f.read() == original_content[::-1].replace(needle[::-1], (new_content+needle)[::-1], 1)[::-1]
 
+    def test_rc_run(self):
+        f_src = "{code_dir}/f_run_src".format(code_dir=CODE_DIR)
+        f_dst = "{code_dir}/f_run_dst".format(code_dir=CODE_DIR)
+        rec = "name test\nput {src} 'ran'\nrun cp {src} {dst}\nappend {dst} ' twice'".format(src=f_src, dst=f_dst)
+        state = jsc.recipe.run(self._rpc, rec, False, CODE_DIR)
+        assert state["name"] == "test"
+        with open(f_dst) as f:
+            assert f.read() == "ran twice"
+
+    def test_recipe_stops_at_error(self):
+        f_first = "{code_dir}/f_first".format(code_dir=CODE_DIR)
+        f_after = "{code_dir}/f_after".format(code_dir=CODE_DIR)
+        rec = "name test\nput {f} first\n\n# missing file\nreplace {code_dir}/missing a b\nput {after} after".format(
+            f=f_first, code_dir=CODE_DIR, after=f_after)
+        try:
+            jsc.recipe.run(self._rpc, rec, False)
+            assert False
+        except jsc.client.SshRpcCallError as e:
+            assert "line 5" in str(e)
+        assert os.path.isfile(f_first)
+        assert not os.path.exists(f_after)
+
 
 
 class TestRecipeParser(unittest.TestCase):
@@ -417,3 +661,315 @@ class TestRecipeParser(unittest.TestCase):
             assert False
         except pyparsing.ParseException:
             pass
+
+    def test_cache(self):
+        rec = "\n".join(self.recipe.keys())
+        expected = [list(stmt) for stmt in rp.parse(rec)]
+        cached = rp.parse(rec)
+        cached[0].pop()
+        cached.pop()
+        assert [list(stmt) for stmt in rp.parse(rec)] == expected
+
+    def test_lexer(self):
+        for cmd in self.recipe.keys():
+            assert list(jsc.rlexer.parse(cmd)) == [self.recipe[cmd]]
+        commands = list(self.recipe.keys())
+        assert list(jsc.rlexer.parse("\n".join(commands))) == [self.recipe[cmd] for cmd in commands]
+        self.assertRaises(pyparsing.ParseException, list, jsc.rlexer.parse("\n".join(self.should_fail)))
+
+    def test_lexer_fuzz(self):
+        # The lexer has to give what the grammar gives, for broken recipes
+        # as well.
+        rnd = random.Random(1)
+        starts = ["name", "package", "gd", "run", "install", "append", "put", "replace", "insert", "rinsert",
+                  "#", "", " ", "gd --depth=1", "gd -b x", "put a", "run  "]
+        pieces = ["a", "Z9", "_$", "/", "\\", " ", "  ", "\n", "\t", "\r", "\"", "'", "#", "-", "--", "=",
+                  "n", "\\ ", "\\n", "\\\"", "x y", "\\\\"]
+
+        def parse(parser, recipe):
+            try:
+                return [list(stmt) for stmt in parser.parse(recipe)]
+            except pyparsing.ParseException:
+                return None
+
+        for _ in range(2000):
+            lines = [rnd.choice(starts) + "".join(rnd.choice(pieces) for _ in range(rnd.randint(0, 12)))
+                     for _ in range(rnd.randint(1, 4))]
+            recipe = "\n".join(lines)
+            assert parse(jsc.rlexer, recipe) == parse(rp, recipe), repr(recipe)
+
+
+class TestDelta(unittest.TestCase):
+    basis_path = "/tmp/jsc_test_delta_basis"
+
+    def apply(self, basis, sig, patch):
+        out = []
+        i = 0
+        block_size = sig["block_size"]
+        while i < len(patch):
+            op, first, count = jsc.delta.OP_HEADER.unpack(patch[i:i + jsc.delta.OP_HEADER.size])
+            i += jsc.delta.OP_HEADER.size
+            if op == "C":
+                out.append(basis[first * block_size:(first + count) * block_size])
+            else:
+                out.append(patch[i:i + first])
+                i += first
+        return "".join(out)
+
+    def test_diff(self):
+        basis = os.urandom(2**20)
+        with open(self.basis_path, "wb") as f:
+            f.write(basis)
+        sig = jsc.delta.signature(self.basis_path)
+        read_size = jsc.delta.READ_SIZE
+        # Also with windows much smaller than the file.
+        for jsc.delta.READ_SIZE in (read_size, 5000):
+            for new in (basis,
+                        "prefix" + basis,
+                        basis[:1000] + "inserted" + basis[1000:],
+                        basis[:5000] + basis[9000:],
+                        basis[:-3],
+                        "",
+                        os.urandom(3000)):
+                patch = "".join(jsc.delta.diff(StringIO.StringIO(new), sig))
+                assert self.apply(basis, sig, patch) == new
+                if new.startswith(basis[:1000]):
+                    # Mostly copied from the basis.
+                    assert len(patch) < 2**12
+        jsc.delta.READ_SIZE = read_size
+        # Past the literal cap only whole blocks on the boundaries match.
+        new = os.urandom(jsc.delta.ROLL_LITERAL_MAX + 5) + basis
+        patch = "".join(jsc.delta.diff(StringIO.StringIO(new), sig))
+        assert self.apply(basis, sig, patch) == new
+        os.remove(self.basis_path)
+
+
+class TestJscIgnore(unittest.TestCase):
+    def test_is_ignored(self):
+        ignore = jsc.jscignore.JscIgnore("/", ["# comment",
+                                               "*.pyc",
+                                               "!keep.pyc",
+                                               "node_modules/",
+                                               "/build",
+                                               "**/foo/bar",
+                                               "lib/**",
+                                               "!lib/a.txt"])
+        for path, is_dir, ignored in (("a.pyc", False, True),
+                                      ("x/y/a.pyc", False, True),
+                                      ("x/keep.pyc", False, False),
+                                      ("x/node_modules", True, True),
+                                      ("x/node_modules", False, False),
+                                      ("build", True, True),
+                                      ("x/build", True, False),
+                                      ("foo/bar", False, True),
+                                      ("x/y/foo/bar", False, True),
+                                      ("lib", True, False),
+                                      ("lib/b.txt", False, True),
+                                      ("lib/a.txt", False, False),
+                                      ("# comment", False, False)):
+            assert ignore.is_ignored(path, is_dir) == ignored, path
+        # A walk passes what it knows, else the path is looked up.
+        assert ignore.should_skip("/x/node_modules", True)
+        assert not ignore.should_skip("/x/node_modules", False)
+        assert not ignore.should_skip("/x/node_modules")
+
+
+class TestChunkStore(unittest.TestCase):
+    def make_tar(self, files):
+        out = StringIO.StringIO()
+        tar = tarfile.open(fileobj=out, mode="w", format=tarfile.GNU_FORMAT)
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, StringIO.StringIO(content))
+        tar.close()
+        return out.getvalue()
+
+    def test_tar_chunks(self):
+        files = [("file{i}".format(i=i), os.urandom(1000)) for i in range(200)]
+        files.append(("big", os.urandom(4 * jsc.chunkstore.CHUNK_MAX)))
+        data = self.make_tar(files)
+        chunks = list(jsc.chunkstore.tar_chunks(StringIO.StringIO(data)))
+        assert "".join(chunks) == data
+        # Changing one small file and inserting into the big one keeps most
+        # chunks.
+        files[10] = ("file10", os.urandom(1000))
+        files[-1] = ("big", files[-1][1][:2**20] + "inserted" + files[-1][1][2**20:])
+        changed_data = self.make_tar(files)
+        changed_chunks = list(jsc.chunkstore.tar_chunks(StringIO.StringIO(changed_data)))
+        assert "".join(changed_chunks) == changed_data
+        new_size = sum(len(chunk) for chunk in set(changed_chunks) - set(chunks))
+        assert new_size < len(changed_data) / 2
+
+
+class TestArchive(unittest.TestCase):
+    def test_parallel_gzip(self):
+        blocks = [os.urandom(1000) * (i + 1) for i in range(20)]
+        members = list(jsc.archive.parallel_map(lambda block: jsc.archive.compress_block("gzip", block, 6), blocks, 4))
+        compressed = StringIO.StringIO("".join(members))
+        assert gzip.GzipFile(fileobj=compressed).read() == "".join(blocks)
+        assert jsc.archive.decompress_block("gzip", members[3]) == blocks[3]
+
+
+class TestDeltree(unittest.TestCase):
+    def test_delete_trees(self):
+        root = tempfile.mkdtemp()
+        outside = tempfile.mkdtemp()
+        touch_file(os.path.join(outside, "kept"))
+        for i in range(20):
+            touch_dir(os.path.join(root, "tree", str(i), "sub"))
+            touch_file(os.path.join(root, "tree", str(i), "sub", "file"))
+        os.symlink(outside, os.path.join(root, "tree", "link"))
+        touch_file(os.path.join(root, "file"))
+        counted = []
+        jsc.deltree.delete_trees([os.path.join(root, "tree"), os.path.join(root, "file")], progress=counted.append)
+        assert os.listdir(root) == []
+        assert os.listdir(outside) == ["kept"]
+        # 20 files, the link, the file and 41 dirs.
+        assert sum(counted) == 63
+        scandir, jsc.deltree.scandir = jsc.deltree.scandir, None
+        try:
+            touch_dir(os.path.join(root, "tree", "sub"))
+            touch_file(os.path.join(root, "tree", "sub", "file"))
+            jsc.deltree.delete_trees([os.path.join(root, "tree")])
+            assert os.listdir(root) == []
+        finally:
+            jsc.deltree.scandir = scandir
+        shutil.rmtree(root)
+        shutil.rmtree(outside)
+
+
+class TestOutputBuffer(unittest.TestCase):
+    def test_take(self):
+        output = jsc.server.OutputBuffer()
+        assert output.take() == "" and not output.due()
+        text = u"\xe9t\xe9 \u20ac".encode("utf-8")
+        # Cut inside the euro sign, the start of it has to wait for the rest.
+        output.add(text[:-1])
+        first = json.loads(output.take())["stdout"]
+        assert output.size == 2
+        output.add(text[-1:])
+        assert first + json.loads(output.take())["stdout"] == text.decode("utf-8")
+        assert output.take() == "" and output.wait() is None
+        output.add("x" * jsc.server.OUTPUT_FLUSH_SIZE)
+        assert output.due()
+        output.add("\xff")
+        assert json.loads(output.take(everything=True))["stdout"].endswith(u"\ufffd")
+
+
+class TestFraming(unittest.TestCase):
+    def test_lines(self):
+        buf = jsc.framing.InBuffer()
+        buf.feed("ab")
+        assert buf.readline() is None
+        buf.feed("c\nde")
+        assert buf.readline() == "abc"
+        assert buf.readline() is None
+        buf.feed("f\n3\nxyz\n")
+        assert buf.readline() == "def"
+        assert buf.readline() == "3"
+        assert buf.read(2) == "xy" and buf.read(5) == "z\n" and len(buf) == 0
+
+    def test_frames(self):
+        payloads = [(jsc.framing.FRAME_JSON, json.dumps({"id": 1})),
+                    (jsc.framing.FRAME_STREAM, os.urandom(10000)),
+                    (jsc.framing.FRAME_STREAM, "")]
+        data = "".join(jsc.framing.frame(kind, payload) for kind, payload in payloads)
+        buf = jsc.framing.InBuffer()
+        reader = jsc.framing.FrameReader()
+        frames = []
+        # Arrives in pieces that cut headers and payloads anywhere.
+        for i in range(0, len(data), 7):
+            buf.feed(data[i:i + 7])
+            frame = reader.read(buf)
+            while frame is not None:
+                frames.append(frame)
+                frame = reader.read(buf)
+        assert frames == payloads
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        msg = {"id": 3, "result": {"software_list": {"package": {"nginx": {"version": "1.9"}}},
+                                   "name": u"caf\xe9", "is_dev": False},
+               "error": None}
+        assert jsc.codec.available_codecs()[-1] == "json"
+        for name in jsc.codec.available_codecs():
+            codec = jsc.codec.codec(name)
+            assert codec.name == name
+            assert codec.loads(codec.dumps(msg)) == msg
+        assert jsc.codec.codec("unknown").name == "json"
+
+
+class TestDispatcher(unittest.TestCase):
+    def test_order(self):
+        dispatcher = jsc.server.Dispatcher(workers=2)
+        done = []
+        release = threading.Event()
+        # Exclusive work runs one at a time in the order it was submitted,
+        # shared work doesn't wait for it.
+        dispatcher.submit(lambda: release.wait(10) and done.append("slow"))
+        dispatcher.submit(done.append, "after slow")
+        dispatcher.submit_shared(done.append, "shared")
+        time.sleep(0.2)
+        assert done == ["shared"]
+        release.set()
+        dispatcher.drain()
+        assert done == ["shared", "slow", "after slow"]
+        assert jsc.server.is_shared("do_status") and not jsc.server.is_shared("do_backup")
+        assert not jsc.server.is_shared("do_nothing")
+
+
+class TestReclaim(unittest.TestCase):
+    def test_trash_while_reclaiming(self):
+        root = tempfile.mkdtemp()
+        trash_dirs = jsc.server.CODE_TRASH_DIR, jsc.server.STATE_TRASH_DIR
+        jsc.server.CODE_TRASH_DIR = os.path.join(root, "trash")
+        jsc.server.STATE_TRASH_DIR = os.path.join(root, "state-trash")
+        old_jobs = set(jsc.server.JOBS)
+        stdout = sys.stdout
+        # Where the jobs send their progress.
+        sys.stdout = StringIO.StringIO()
+        try:
+            for i in range(1000):
+                path = os.path.join(root, str(i))
+                os.makedirs(os.path.join(path, "sub"))
+                jsc.server.reclaim_start()
+                jsc.server.trash([path], jsc.server.CODE_TRASH_DIR)
+            jsc.server.reclaim_start()
+            for job_id in set(jsc.server.JOBS) - old_jobs:
+                assert jsc.server.JOBS[job_id].finished.wait(10)
+                assert jsc.server.JOBS[job_id].state == "done", jsc.server.JOBS[job_id].error
+        finally:
+            sys.stdout = stdout
+            jsc.server.CODE_TRASH_DIR, jsc.server.STATE_TRASH_DIR = trash_dirs
+        assert os.listdir(os.path.join(root, "trash")) == []
+        shutil.rmtree(root)
+
+
+class TestUploadCache(unittest.TestCase):
+    def test_evict(self):
+        root = tempfile.mkdtemp()
+        objects_dir = jsc.server.UPLOAD_CACHE_OBJECTS_DIR
+        jsc.server.UPLOAD_CACHE_OBJECTS_DIR = os.path.join(root, "objects")
+        try:
+            sha1s = []
+            for i in range(3):
+                path = os.path.join(root, str(i))
+                with open(path, "wb") as f:
+                    f.write(str(i) * 1000)
+                sha1s.append(jsc.delta.file_sha1(path))
+                jsc.server.upload_cache_insert(path, sha1s[-1])
+                # The mtime is the last use.
+                os.utime(jsc.server.upload_cache_path(sha1s[-1]), (i, i))
+            # Left by an insert that was interrupted.
+            with open(jsc.server.upload_cache_path(sha1s[0]) + ".tmp", "wb") as f:
+                f.write("x" * 5000)
+            assert sum(size for _, size, _ in jsc.server.upload_cache_objects()) == 3000
+            jsc.server.upload_cache_evict(2000)
+            assert sorted(obj_path for _, _, obj_path in jsc.server.upload_cache_objects()) == \
+                sorted(jsc.server.upload_cache_path(sha1) for sha1 in sha1s[1:])
+            assert not os.path.exists(jsc.server.upload_cache_path(sha1s[0]) + ".tmp")
+        finally:
+            jsc.server.UPLOAD_CACHE_OBJECTS_DIR = objects_dir
+            shutil.rmtree(root)